@@ -0,0 +1,93 @@
+# Wall time, API calls and peak memory of track.py, stage by stage, end to end
+# against offline.py's stand-ins for Coinbase, Sheets and Discord.
+#
+# Run from coinbase/:
+#   python -m benchmarks.end_to_end
+#   python -m benchmarks.end_to_end --transactions 10000 --latency 0.05 --rate 25
+#
+# Every portfolio size is run twice over the same store and sheets, as daemon.py
+# would: cold (nothing fetched or written yet) and warm (nothing new since). Times
+# come from runs without tracemalloc, which slows them down; peak memory is what
+# tracemalloc counts as allocated during a stage, in a second pair of runs. The fake
+# Coinbase server runs in a process of its own and isn't counted.
+import argparse
+import contextlib
+import io
+import time
+import tracemalloc
+
+import offline
+
+
+def calls(coinbase, replay):
+    # {kind: calls so far}, Coinbase requests by endpoint, Sheets calls and Discord posts
+    counts = dict(coinbase.stats())
+    counts.update(('sheets %s' % name, count) for name, count in replay.spreadsheet.calls.items())
+    counts['discord'] = len(replay.discord.posts)
+    return counts
+
+
+def measure(coinbase, replay, traced=False):
+    # [(stage, seconds, {kind: calls}, peak MB or None)] of one run
+    stages = []
+    result = None
+    for name in replay.STAGES:
+        before = calls(coinbase, replay)
+        if traced:
+            tracemalloc.start()
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = replay.stage(name)(result)
+        seconds = time.perf_counter() - start
+        peak = None
+        if traced:
+            peak = tracemalloc.get_traced_memory()[1] / 2 ** 20
+            tracemalloc.stop()
+        after = calls(coinbase, replay)
+        stages.append((name, seconds, {kind: after[kind] - before.get(kind, 0) for kind in after
+                                       if after[kind] != before.get(kind, 0)}, peak))
+    return stages
+
+
+def benchmark(fixture, latency, rate):
+    # {run: [(stage, seconds, calls, peak MB)]} of a cold and a warm run
+    with offline.FakeCoinbase(fixture, latency, rate) as coinbase:
+        runs = {}
+        for traced in (False, True):
+            replay = offline.Replay(coinbase)
+            try:
+                for run in ('cold', 'warm'):
+                    stages = measure(coinbase, replay, traced)
+                    if traced:
+                        runs[run] = [timed[:3] + (memory[3],) for timed, memory in zip(runs[run], stages)]
+                    else:
+                        runs[run] = stages
+            finally:
+                replay.close()
+    return runs
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--transactions', type=int, nargs='+', default=[100, 1000, 10000])
+    parser.add_argument('--currencies', type=int, default=10)
+    parser.add_argument('--latency', type=float, default=0.01)
+    parser.add_argument('--rate', type=float, default=0)
+    args = parser.parse_args(argv)
+
+    for transactions in args.transactions:
+        fixture = offline.generate_portfolio(transactions, args.currencies)
+        print('\n%d transactions, %d currencies, %gs latency, %s' % (
+            transactions, args.currencies, args.latency,
+            '%g requests/s' % args.rate if args.rate else 'no rate limit'))
+        print('%-5s %-8s %9s %9s  %s' % ('run', 'stage', 'seconds', 'peak MB', 'calls'))
+        for run, stages in benchmark(fixture, args.latency, args.rate).items():
+            for name, seconds, counts, peak in stages:
+                print('%-5s %-8s %9.3f %9.1f  %s' % (run, name, seconds, peak, ', '.join(
+                    '%s %d' % (kind, count) for kind, count in sorted(counts.items()))))
+            print('%-5s %-8s %9.3f' % (run, 'total', sum(stage[1] for stage in stages)))
+    return 0
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+# Time and peak memory of the cost basis of a big order history: the per-order dicts
+# and loop track.py used to have, against cost_basis with each method.
+#
+# Run from coinbase/:
+#   python -m benchmarks.order_basis
+#   python -m benchmarks.order_basis --orders 1000000 --currencies 20
+#
+# Orders are DCA-bot like: mostly buys, a sale now and then, and the odd currency
+# sold out and bought back. Each run is timed in two stages: keeping the orders as
+# they're read, and working out their basis and the order of the order sheet. Memory
+# is what tracemalloc counts for the kept orders.
+import argparse
+import datetime
+import random
+import time
+import tracemalloc
+
+import cost_basis
+
+START = datetime.datetime(2015, 1, 1)
+
+
+def generate_orders(count, currencies, seed=0):
+    # [(symbol, buy, datetime, amount, total, subtotal, fee)], newest first per
+    # currency, as the transaction listing has them
+    rng = random.Random(seed)
+    orders = []
+    for currency in range(currencies):
+        symbol = 'C%d' % currency
+        held = 0
+        history = []
+        for index in range(count // currencies):
+            created_at = (START + datetime.timedelta(hours=index)).strftime('%Y-%m-%dT%H:%M:%SZ')
+            if held > 0 and rng.random() < 0.1:
+                amount = -held if rng.random() < 0.05 else -held * rng.uniform(0.01, 0.5)
+                subtotal = -amount * rng.uniform(50, 150)
+                history.append((symbol, False, created_at, amount, subtotal - 0.5, subtotal, 0.5))
+            else:
+                amount = rng.uniform(0.001, 0.1)
+                subtotal = amount * rng.uniform(50, 150)
+                history.append((symbol, True, created_at, amount, subtotal + 0.5, subtotal, 0.5))
+            held += amount
+        orders.extend(reversed(history))
+    return orders
+
+
+def order_dicts(rows):
+    # How pull_cb_account_info() used to keep orders
+    currencies = {}
+    for symbol, buy, datetime, amount, total, subtotal, fee in rows:
+        if buy:
+            order = {'type': 'buy', 'datetime': datetime, 'symbol': symbol, 'amount': amount, 'cost': total,
+                     'invested': subtotal, 'spot_price': subtotal / amount, 'total_fee': fee}
+        else:
+            order = {'type': 'sell', 'datetime': datetime, 'symbol': symbol, 'amount': amount, 'earned': total,
+                     'sell_total': subtotal, 'spot_price': -subtotal / amount, 'total_fee': fee}
+        currencies.setdefault(symbol, []).append(order)
+    return currencies
+
+
+def dict_basis(currencies):
+    # The weighted average loop of pull_cb_account_info() and the sort of
+    # generate_order_details()
+    for symbol, orders in currencies.items():
+        orders = currencies[symbol] = sorted(orders, key=lambda k: k['datetime'])
+        quantity = 0
+        price = 0
+        for order in orders:
+            if order['type'] == 'buy':
+                price = float((quantity * price + order['amount'] * order['spot_price']) / (quantity + order['amount']))
+                quantity += order['amount']
+                order['original_worth'] = 'N/A'
+            else:
+                order['original_worth'] = -(order['amount'] * price)
+                quantity += order['amount']
+                if quantity == 0:
+                    price = 0
+    return sorted((order for orders in currencies.values() for order in orders), key=lambda k: k['datetime'])
+
+
+def order_columns(rows):
+    log = cost_basis.OrderLog()
+    for row in rows:
+        log.add(*row)
+    return log.orders()
+
+
+def column_basis(orders, method):
+    basis = cost_basis.cost_basis(orders, method)
+    return basis, orders.by_time(orders.symbols)
+
+
+def measure(build, basis, rows, *args):
+    # Seconds to keep the orders and to work out their basis, and the MB the orders
+    # take once kept. The times are the best of three runs without tracemalloc,
+    # which slows them down.
+    timings = []
+    for _ in range(3):
+        start = time.perf_counter()
+        orders = build(rows)
+        built = time.perf_counter()
+        basis(orders, *args)
+        timings.append((built - start, time.perf_counter() - built))
+        del orders
+    tracemalloc.start()
+    orders = build(rows)
+    kept = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return min(build for build, basis in timings), min(basis for build, basis in timings), kept / 2 ** 20
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--orders', type=int, default=100000)
+    parser.add_argument('--currencies', type=int, default=10)
+    args = parser.parse_args(argv)
+
+    rows = generate_orders(args.orders, args.currencies)
+    print('%d orders, %d currencies' % (len(rows), args.currencies))
+    print('%-20s %9s %9s %9s' % ('run', 'keep s', 'basis s', 'kept MB'))
+    runs = [('dicts, average', order_dicts, dict_basis, ())]
+    runs += [('columns, %s' % method, order_columns, column_basis, (method,)) for method in cost_basis.METHODS]
+    for name, build, basis, args_ in runs:
+        print('%-20s %9.3f %9.3f %9.1f' % ((name,) + measure(build, basis, rows, *args_)))
+    return 0
+
+
+if __name__ == '__main__':
+    main()
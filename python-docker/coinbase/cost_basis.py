@@ -0,0 +1,205 @@
+# Cost basis of every currency's orders for track.py, over compact order columns.
+#
+# pull_cb_account_info() used to keep each order as a dict of ten or so keys, sort
+# every currency's list, walk it in Python for the weighted average price, and then
+# generate_order_details() sorted all of them again. An OrderLog keeps one list per
+# column while orders are read, and Orders turns them into NumPy arrays sorted once,
+# by currency and time (ties keep the order they were read in).
+#
+# cost_basis() works out, for every currency at once, the average price of what is
+# held, the realized gain and each sale's original worth, by one of CB_COST_BASIS:
+#
+# average  the weighted average buy price, as track.py always had it: a buy moves it,
+#          a sale doesn't, and selling everything resets it
+# fifo     sales use up the oldest bought lots first
+# lifo     sales use up the newest bought lots first
+#
+# Lots cost their buy's spot price (subtotal / amount, fees left out), as the average
+# does. What's sold beyond the lots there are (coins received rather than bought)
+# costs nothing. The average price of fifo and lifo is that of the lots left.
+#
+# Orders of nothing (an amount of 0) have no spot price and move neither holdings nor
+# prices, so they're left out.
+import collections
+import os
+
+import numpy as np
+
+AVERAGE = 'average'
+FIFO = 'fifo'
+LIFO = 'lifo'
+METHODS = (AVERAGE, FIFO, LIFO)
+
+METHOD = os.environ.get('CB_COST_BASIS', AVERAGE)
+
+
+class OrderLog(object):
+
+    def __init__(self):
+        self.symbols = []
+        self._currencies = {}
+        self.currency = []
+        self.buy = []
+        self.datetime = []
+        # Signed, sales are negative
+        self.amount = []
+        # Buys: cost and invested, sales: earned and sell_total
+        self.total = []
+        self.subtotal = []
+        self.fee = []
+
+    def currency_index(self, symbol):
+        index = self._currencies.get(symbol)
+        if index is None:
+            index = self._currencies[symbol] = len(self.symbols)
+            self.symbols.append(symbol)
+        return index
+
+    def add(self, symbol, buy, datetime, amount, total, subtotal, fee):
+        if amount == 0:
+            return
+        index = self._currencies.get(symbol)
+        self.currency.append(self.currency_index(symbol) if index is None else index)
+        self.buy.append(buy)
+        self.datetime.append(datetime)
+        self.amount.append(amount)
+        self.total.append(total)
+        self.subtotal.append(subtotal)
+        self.fee.append(fee)
+
+    def orders(self):
+        return Orders(self)
+
+
+class Orders(object):
+
+    def __init__(self, log):
+        self.symbols = list(log.symbols)
+        # As bytes, a quarter of the size of str arrays
+        datetime = np.array(log.datetime, dtype=bytes)
+        currency = np.array(log.currency, dtype=np.intc)
+        order = np.lexsort((datetime, currency))
+        self.currency = currency[order]
+        self.datetime = datetime[order]
+        self.buy = np.array(log.buy, dtype=bool)[order]
+        self.amount = np.array(log.amount, dtype=float)[order]
+        self.total = np.array(log.total, dtype=float)[order]
+        self.subtotal = np.array(log.subtotal, dtype=float)[order]
+        self.fee = np.array(log.fee, dtype=float)[order]
+        self.spot_price = np.where(self.buy, self.subtotal, -self.subtotal) / self.amount
+        # Each currency's orders are self.currency[starts[i]:starts[i + 1]]
+        self.starts = np.searchsorted(self.currency, np.arange(len(self.symbols) + 1))
+        # Filled in by cost_basis(), nan for buys
+        self.original_worth = np.full(len(self), np.nan)
+
+    def __len__(self):
+        return len(self.currency)
+
+    def by_time(self, symbols):
+        # Indices of the orders sorted by time, ties by the order of their currency in
+        # symbols and then as read
+        rank = np.full(len(self.symbols), len(symbols))
+        for position, symbol in enumerate(symbols):
+            if symbol in self.symbols:
+                rank[self.symbols.index(symbol)] = position
+        return np.lexsort((rank[self.currency], self.datetime))
+
+    def row(self, index):
+        # One order as the dict track.py used to keep
+        buy = bool(self.buy[index])
+        order = {'type': 'buy' if buy else 'sell',
+                 'datetime': self.datetime[index].decode('ascii'),
+                 'symbol': self.symbols[self.currency[index]],
+                 'amount': float(self.amount[index]),
+                 'spot_price': float(self.spot_price[index]),
+                 'total_fee': float(self.fee[index])}
+        if buy:
+            order.update(cost=float(self.total[index]), invested=float(self.subtotal[index]),
+                         original_worth='N/A')
+        else:
+            order.update(earned=float(self.total[index]), sell_total=float(self.subtotal[index]),
+                         original_worth=float(self.original_worth[index]))
+        return order
+
+
+class Basis(object):
+    # Per currency index: average_price, realized_gain_loss and sell_original_worth,
+    # as lists of floats
+
+    def __init__(self, orders, average_price):
+        sell = ~orders.buy
+        worth = np.where(sell, orders.original_worth, 0)
+        # Summed in order, as the loop did
+        sums = lambda weights: np.bincount(orders.currency, weights, minlength=len(orders.symbols)).tolist()
+        self.average_price = average_price.tolist()
+        self.sell_original_worth = sums(worth)
+        self.realized_gain_loss = sums(np.where(sell, orders.subtotal - worth, 0))
+
+
+def cost_basis(orders, method=METHOD):
+    if method not in METHODS:
+        raise ValueError('cost basis method must be one of %s, not %r' % (', '.join(METHODS), method))
+    if method == AVERAGE:
+        average_price = _average(orders)
+    else:
+        average_price = np.zeros(len(orders.symbols))
+        for currency in range(len(orders.symbols)):
+            average_price[currency] = _lots(orders, orders.starts[currency], orders.starts[currency + 1],
+                                            method == FIFO)
+    return Basis(orders, average_price)
+
+
+def _lots(orders, start, end, fifo):
+    # Fills in the original worth of a currency's sales from a queue of [amount,
+    # price] lots, returns the average price of the lots left
+    lots = collections.deque()
+    for index, buy, amount, price in zip(range(start, end), orders.buy[start:end].tolist(),
+                                         orders.amount[start:end].tolist(),
+                                         orders.spot_price[start:end].tolist()):
+        if buy:
+            lots.append([amount, price])
+            continue
+        remaining = -amount
+        worth = 0
+        while remaining > 0 and lots:
+            lot = lots[0] if fifo else lots[-1]
+            used = min(remaining, lot[0])
+            worth += used * lot[1]
+            remaining -= used
+            lot[0] -= used
+            if lot[0] <= 0:
+                if fifo:
+                    lots.popleft()
+                else:
+                    lots.pop()
+        orders.original_worth[index] = worth
+    held = sum(amount for amount, price in lots)
+    return sum(amount * price for amount, price in lots) / held if held > 0 else 0
+
+
+def _average(orders):
+    # The weighted average of every currency, order by order
+    average_price = np.zeros(len(orders.symbols))
+    for currency in range(len(orders.symbols)):
+        average_price[currency] = _average_loop(orders, orders.starts[currency], orders.starts[currency + 1])
+    return average_price
+
+
+def _average_loop(orders, start, end):
+    # The weighted average order by order, as track.py had it. A buy that leaves
+    # nothing held resets the price rather than dividing by zero.
+    quantity = 0
+    price = 0
+    for index, buy, amount, spot_price in zip(range(start, end), orders.buy[start:end].tolist(),
+                                              orders.amount[start:end].tolist(),
+                                              orders.spot_price[start:end].tolist()):
+        if buy:
+            den = quantity + amount
+            price = float((quantity * price + amount * spot_price) / den) if den else 0
+            quantity += amount
+        else:
+            orders.original_worth[index] = -(amount * price)
+            quantity += amount
+            if quantity == 0:
+                price = 0
+    return price
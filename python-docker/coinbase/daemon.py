@@ -0,0 +1,259 @@
+# track.py on a schedule, in one long-running process.
+#
+#   python daemon.py
+#
+# Running track.py once per refresh pays a container start, the imports, new TLS
+# connections to Coinbase and Google and their authentication every time. The
+# daemon keeps the Coinbase client (and its pooled connections), the price cache,
+# the transaction store and the Google connection between runs, and runs
+# track.py's pipeline every CB_INTERVAL seconds, give or take CB_JITTER of that so
+# that several trackers don't hit the APIs in step. Runs are scheduled from when the
+# previous one started; one that overruns the interval is followed straight away.
+#
+# Sheets only get the cells that changed (see sheets.py), so a run where nothing did
+# makes no Sheets calls, and Discord is only posted to when its message changed.
+# Google is connected to again every CB_SHEETS_RECONNECT seconds, before its access
+# token expires, and after a run whose write failed. A run that fails is logged and
+# the next one goes ahead as scheduled. SIGTERM and SIGINT stop the daemon between
+# runs.
+#
+# How the runs went is kept in CB_STATUS (JSON, written after every run) and served
+# on CB_HEALTH_PORT (0 turns it off): GET /health answers 200 while the last good
+# run finished less than CB_STALE seconds ago (3 intervals by default), 503
+# otherwise, with the status as its body.
+import json
+import os
+import random
+import signal
+import threading
+import time
+import traceback
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import fetch
+import history
+import pipeline
+import track
+from history import DailyPrices, History
+from prices import CoinbaseRates, PriceCache
+from sheets import SheetSink
+from store import Store
+
+INTERVAL = float(os.environ.get('CB_INTERVAL', '60'))
+# Fraction of the interval runs are moved by, either way
+JITTER = float(os.environ.get('CB_JITTER', '0.1'))
+SHEETS_RECONNECT = float(os.environ.get('CB_SHEETS_RECONNECT', '1800'))
+STATUS = os.environ.get('CB_STATUS', './data/status.json')
+HEALTH_PORT = int(os.environ.get('CB_HEALTH_PORT', '8080'))
+STALE = float(os.environ.get('CB_STALE', '0')) or 3 * INTERVAL
+
+
+def timestamp(seconds):
+    return datetime.utcfromtimestamp(seconds).strftime('%Y-%m-%dT%H:%M:%SZ') if seconds else None
+
+
+def next_start(started, interval=INTERVAL, jitter=JITTER):
+    return started + interval * (1 + random.uniform(-jitter, jitter))
+
+
+class Status(object):
+    # How the daemon's runs went, for the status file and /health
+
+    def __init__(self, path=STATUS, stale=STALE, clock=time.time):
+        self.path = path
+        self.stale = stale
+        self.clock = clock
+        self._lock = threading.Lock()
+        self.started_at = clock()
+        self.runs = 0
+        self.failures = 0
+        self.last_success = None
+        # The last run's dict, see Tracker.run()
+        self.last_run = None
+
+    def record(self, run):
+        with self._lock:
+            self.runs += 1
+            if run['ok']:
+                self.last_success = run['finished_at']
+            else:
+                self.failures += 1
+            self.last_run = run
+        self._save()
+
+    def healthy(self):
+        # Before the first good run, for as long as one may take to come
+        now = self.clock()
+        return now - (self.last_success or self.started_at) < self.stale
+
+    def as_dict(self):
+        with self._lock:
+            last_run = dict(self.last_run or {})
+            for key in ('started_at', 'finished_at'):
+                if key in last_run:
+                    last_run[key] = timestamp(last_run[key])
+            return {'healthy': self.healthy(),
+                    'started_at': timestamp(self.started_at),
+                    'runs': self.runs,
+                    'failures': self.failures,
+                    'last_success': timestamp(self.last_success),
+                    'last_run': last_run or None}
+
+    def _save(self):
+        if not self.path:
+            return
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + '.tmp', 'w') as status_file:
+            json.dump(self.as_dict(), status_file, indent=2)
+        os.replace(self.path + '.tmp', self.path)
+
+
+def serve_health(status, port=HEALTH_PORT):
+    # A thread answering GET /health, or None if port is 0
+    if not port:
+        return None
+
+    class HealthHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path.rstrip('/') not in ('/health', ''):
+                self.send_error(404)
+                return
+            body = json.dumps(status.as_dict()).encode('utf-8')
+            self.send_response(200 if status.healthy() else 503)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # Health checks every few seconds would drown out the runs
+            pass
+
+    server = ThreadingHTTPServer(('', port), HealthHandler)
+    thread = threading.Thread(target=server.serve_forever, name='health', daemon=True)
+    thread.start()
+    return server
+
+
+class Tracker(object):
+    # track.py's pipeline, with its clients kept between runs. Clients are made on
+    # the first run that needs them, so one that can't connect is tried again on the
+    # next run rather than stopping the daemon.
+
+    def __init__(self, sheets_reconnect=SHEETS_RECONNECT, clock=time.monotonic):
+        self.sheets_reconnect = sheets_reconnect
+        self.clock = clock
+        self.fetcher = None
+        self.price_cache = None
+        self.transaction_store = None
+        self.history = History()
+        self.daily_prices = None
+        self.sheet_sink = None
+        self._sheets_at = None
+        self._discord_urls = None
+        self._last_message = None
+
+    def _coinbase(self):
+        if self.fetcher is None:
+            key, scrt = track.read_cb_credentials(track.CB_CREDS)
+            self.fetcher = fetch.Fetcher(track.create_coinbase_client(key, scrt))
+            self.price_cache = PriceCache(CoinbaseRates(self.fetcher))
+            self.transaction_store = Store()
+            self.daily_prices = DailyPrices(self.fetcher, self.transaction_store)
+        # Calls are counted per run
+        self.fetcher.stats = fetch.CallStats()
+        return self.fetcher
+
+    def _sheets(self):
+        if self.sheet_sink is None or self.clock() - self._sheets_at >= self.sheets_reconnect:
+            spreadsheet = track.connect_to_google_ss(track.GOOGLE_CREDS, track.SPREADSHEET)
+            self.sheet_sink = SheetSink(spreadsheet)
+            self._sheets_at = self.clock()
+        return self.sheet_sink
+
+    def _discord(self, my_coinbase):
+        # Whether the message was posted; it isn't when it's the one posted last
+        message_content = track.discord_message(my_coinbase)
+        if message_content == self._last_message:
+            return False
+        if self._discord_urls is None:
+            self._discord_urls = track.read_discord_urls(track.DISCORD_WEBHOOKS)
+        track.post_to_discord(self._discord_urls, message_content)
+        self._last_message = message_content
+        return True
+
+    def run(self):
+        # {'ok', 'started_at', 'finished_at', 'seconds', 'cells_written',
+        #  'history_days', 'history_error', 'discord_posted', 'current_value', 'error'}
+        # of one run. A run whose history failed is still ok.
+        started = time.time()
+        run = {'ok': False, 'started_at': started, 'cells_written': None, 'history_days': None,
+               'history_error': None, 'discord_posted': False}
+        try:
+            fetcher = self._coinbase()
+            # Google is connected to (when it has to be) and past prices are looked
+            # up while Coinbase is fetched
+            sheet_sink = pipeline.background('sheets', self._sheets)
+            history_prices = pipeline.Worker('history prices', lambda item: history.prefetch(
+                self.history, self.daily_prices, *item))
+            try:
+                my_coinbase = track.pull_cb_account_info(fetcher, self.transaction_store, self.price_cache,
+                                                         lambda *item: history_prices.put(item))
+                run['current_value'] = my_coinbase['current_value']
+                try:
+                    run['cells_written'] = track.write_sheets(my_coinbase, sheet_sink.result())
+                except Exception:
+                    # Connect again next time, in case it was the connection
+                    self.sheet_sink = None
+                    raise
+            finally:
+                history_prices.close()
+            try:
+                run['history_days'] = track.update_history(my_coinbase, self.history, self.daily_prices)
+            except Exception as error:
+                # The sheets are written all the same; the days are added next run
+                run['history_error'] = repr(error)
+                traceback.print_exc()
+            try:
+                run['discord_posted'] = self._discord(my_coinbase)
+            except Exception:
+                print('Something went wrong trying to post to discord!')
+                traceback.print_exc()
+            run['ok'] = True
+        except Exception as error:
+            run['error'] = repr(error)
+            traceback.print_exc()
+        run['finished_at'] = time.time()
+        run['seconds'] = round(run['finished_at'] - started, 3)
+        return run
+
+
+def main():
+    stop = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda signum, frame: stop.set())
+
+    status = Status()
+    server = serve_health(status)
+    tracker = Tracker()
+    print("Refreshing every %gs (+/- %d%%)%s" % (INTERVAL, JITTER * 100,
+          ", health on port %d" % HEALTH_PORT if server else ""))
+    while not stop.is_set():
+        started = time.time()
+        print("\n~~~~~ Run %d at %s ~~~~~" % (status.runs + 1, timestamp(started)))
+        run = tracker.run()
+        status.record(run)
+        print("~~~~~ Run %s in %.1fs ~~~~~" % ('done' if run['ok'] else 'failed', run['seconds']))
+        stop.wait(max(0, next_start(started) - time.time()))
+    if server is not None:
+        server.shutdown()
+    if tracker.transaction_store is not None:
+        tracker.transaction_store.close()
+    return 0
+
+
+if __name__ == '__main__':
+    main()
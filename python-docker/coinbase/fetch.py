@@ -0,0 +1,273 @@
+# Concurrent Coinbase fetching for track.py.
+#
+# pull_cb_account_info() needs, per account, the list of transactions and then the
+# buy or sell behind every one of them: one request each. Made one after
+# the other that takes minutes for a few dozen wallets with some history. A Fetcher
+# makes them on a pool of CB_CONCURRENCY threads (1 makes them one at a time again),
+# over the client's own requests session, with enough pooled keep-alive connections
+# for every thread.
+#
+# Calls that are rate limited (429), fail on the server side (5xx) or never get an
+# answer are retried up to CB_RETRIES times, with exponential backoff and jitter. A
+# 429 pauses every thread, for at least as long as its Retry-After asks. A call that
+# still fails fails its account only. Calls, retries and failures are counted per
+# kind of call, see CallStats.
+#
+# A Fetcher can also keep to CB_RATE calls a second (0, the default, for no limit),
+# ahead of any 429, and share its connection pool with other Fetchers (see
+# connection_pool()); portfolios.py runs one per portfolio on both.
+#
+# Accounts are handed on as soon as they're fetched (stream_accounts()), so what
+# comes after can start on them while the rest are still being fetched.
+#
+# Listings are read page by page to the end (the API returns 25 items unless asked
+# for more). Transactions and buys and sells go through a store.Store: only
+# transactions after an account's cursor are fetched, and only the buys and sells
+# behind those, or ones that aren't stored yet.
+import collections
+import os
+import queue
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from coinbase.wallet.error import APIError
+from requests.adapters import HTTPAdapter
+
+from store import detail_id
+
+CONCURRENCY = int(os.environ.get('CB_CONCURRENCY', '8'))
+RETRIES = int(os.environ.get('CB_RETRIES', '5'))
+# Seconds before the first retry, doubling with every one after it
+BACKOFF = float(os.environ.get('CB_BACKOFF', '0.5'))
+MAX_BACKOFF = 60
+# Calls a second a Fetcher keeps to, 0 for no limit
+RATE = float(os.environ.get('CB_RATE', '0'))
+# Items per page of a listing, the most the API allows
+PAGE_SIZE = 100
+
+
+def retryable(error):
+    if isinstance(error, APIError):
+        return error.status_code == 429 or error.status_code >= 500
+    # Connection errors, timeouts and error pages that aren't JSON
+    return isinstance(error, requests.RequestException)
+
+
+def retry_after(error):
+    # Seconds a rate limited response asks to wait, 0 where it doesn't say
+    response = getattr(error, 'response', None)
+    try:
+        return max(0, float(response.headers.get('Retry-After', 0)))
+    except (AttributeError, TypeError, ValueError):
+        return 0
+
+
+def connection_pool(size):
+    # An adapter keeping up to size keep-alive connections per host. Mounted on
+    # several clients' sessions, they take their connections from the same pool.
+    return HTTPAdapter(pool_connections=1, pool_maxsize=max(10, size))
+
+
+def pool_connections(client, size, adapter=None):
+    # requests keeps 10 connections per host by default; threads beyond that would
+    # each open and drop a connection of their own per call
+    adapter = adapter or connection_pool(size)
+    client.session.mount('https://', adapter)
+    client.session.mount('http://', adapter)
+
+
+class CallStats(object):
+    # Calls, retries and failures per kind of call ('spot_price', 'transactions', ...)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = collections.Counter()
+        self.retries = collections.Counter()
+        self.failures = collections.Counter()
+
+    def count(self, counter, name):
+        with self._lock:
+            counter[name] += 1
+
+    def summary(self):
+        return ', '.join('%s: %d calls, %d retries, %d failed'
+                         % (name, self.calls[name], self.retries[name], self.failures[name])
+                         for name in sorted(self.calls))
+
+
+class RateLimit(object):
+    # A token bucket: calls go ahead at rate a second on average, in bursts of up to
+    # rate at once
+
+    def __init__(self, rate, clock=time.monotonic):
+        self.rate = rate
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._burst = max(1.0, rate)
+        self._tokens = self._burst
+        self._at = clock()
+
+    def wait(self):
+        while True:
+            with self._lock:
+                now = self.clock()
+                self._tokens = min(self._burst, self._tokens + (now - self._at) * self.rate)
+                self._at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
+
+
+class Fetcher(object):
+
+    def __init__(self, client, concurrency=CONCURRENCY, retries=RETRIES, backoff=BACKOFF, rate=RATE,
+                 adapter=None):
+        self.client = client
+        self.concurrency = max(1, concurrency)
+        self.retries = retries
+        self.backoff = backoff
+        self.stats = CallStats()
+        self._lock = threading.Lock()
+        # time.monotonic() until which rate limiting has every thread wait
+        self._resume_at = 0
+        self._rate_limit = RateLimit(rate) if rate > 0 else None
+        # Whether a call has been answered yet, that is whether the client works
+        self.connected = False
+        pool_connections(client, self.concurrency, adapter)
+
+    def _wait_for_rate_limit(self):
+        while True:
+            with self._lock:
+                delay = self._resume_at - time.monotonic()
+            if delay <= 0:
+                return
+            time.sleep(delay)
+
+    def call(self, name, fn, *args, **kwargs):
+        attempt = 0
+        while True:
+            self._wait_for_rate_limit()
+            if self._rate_limit is not None:
+                self._rate_limit.wait()
+            self.stats.count(self.stats.calls, name)
+            try:
+                result = fn(*args, **kwargs)
+                self.connected = True
+                return result
+            except Exception as error:
+                if attempt >= self.retries or not retryable(error):
+                    self.stats.count(self.stats.failures, name)
+                    raise
+                delay = min(MAX_BACKOFF, self.backoff * 2 ** attempt) * random.uniform(0.5, 1)
+                if getattr(error, 'status_code', None) == 429:
+                    delay = max(delay, retry_after(error))
+                    with self._lock:
+                        self._resume_at = max(self._resume_at, time.monotonic() + delay)
+            self.stats.count(self.stats.retries, name)
+            attempt += 1
+            time.sleep(delay)
+
+    def pages(self, name, fn, cursor=None, **params):
+        # Each page of a listing, as a list of its items, from the item after cursor on
+        while True:
+            if cursor is not None:
+                params['starting_after'] = cursor
+            page = self.call(name, fn, limit=PAGE_SIZE, **params)
+            items = page['data']
+            yield items
+            if not items or not (page.pagination and page.pagination.get('next_uri')):
+                return
+            cursor = items[-1]['id']
+
+    def _sync(self, account, store):
+        # Stores the account's transactions after its cursor, and returns their ids
+        fetched = set()
+        cursor = store.cursor(account['id'])
+        for items in self.pages('transactions', account.get_transactions, cursor, order='asc'):
+            store.add_transactions(account['id'], items)
+            fetched.update(transaction['id'] for transaction in items)
+        # Everything after the cursor was listed again, so pending ones that weren't
+        # are gone
+        store.prune_pending(account['id'], cursor, fetched)
+        return fetched
+
+    def _detail(self, account, transaction, store):
+        if transaction['type'] == 'buy':
+            detail = self.call('buy', account.get_buy, transaction['buy']['id'])
+        else:
+            detail = self.call('sell', account.get_sell, transaction['sell']['id'])
+        store.add_detail(detail)
+        return detail
+
+    def _fetch_details(self, executor, account, fetched_ids, store):
+        # (transactions, {id: stored buy or sell}, [future buy or sell]) of a synced
+        # account, fetching the buys and sells behind transactions fetched just now
+        # or missing from the store
+        transactions = store.transactions(account['id'])
+        ids = [detail_id(transaction) for transaction in transactions]
+        stored = store.details(id_ for id_ in ids if id_ is not None)
+        futures = [executor.submit(self._detail, account, transaction, store)
+                   for transaction, id_ in zip(transactions, ids)
+                   if id_ is not None and (transaction['id'] in fetched_ids or id_ not in stored)]
+        return transactions, stored, futures
+
+    def _collect(self, transactions, stored, futures):
+        # The fetched dict of an account whose buys and sells are all in, or the
+        # exception one of them failed with
+        try:
+            stored.update((detail['id'], detail) for detail in (future.result() for future in futures))
+        except Exception as error:
+            return error
+        return {'transactions': transactions,
+                'details': [stored.get(detail_id(transaction)) for transaction in transactions]}
+
+    def _synced(self, executor, index, account, sync, store, done):
+        # Once an account is synced, fetches its buys and sells and puts (index,
+        # account, fetched) in done once they're all in
+        try:
+            transactions, stored, futures = self._fetch_details(executor, account, sync.result(), store)
+        except Exception as error:
+            done.put((index, account, error))
+            return
+        if not futures:
+            done.put((index, account, self._collect(transactions, stored, futures)))
+            return
+        remaining = [len(futures)]
+        lock = threading.Lock()
+
+        def detail_done(_):
+            with lock:
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+            done.put((index, account, self._collect(transactions, stored, futures)))
+
+        for future in futures:
+            future.add_done_callback(detail_done)
+
+    def stream_accounts(self, accounts, store):
+        # (index, account, fetched) of each of accounts (any iterable, read as it
+        # goes) as soon as it's fetched, index being its place in accounts. fetched
+        # is a dict of all the account's 'transactions', newest first, and their
+        # 'details', the buy or sell behind each transaction (or None), or the
+        # exception that fetching it failed with.
+        done = queue.Queue()
+        pending = 0
+        with ThreadPoolExecutor(self.concurrency) as executor:
+            for index, account in enumerate(accounts):
+                pending += 1
+                executor.submit(self._sync, account, store).add_done_callback(
+                    lambda sync, index=index, account=account: self._synced(executor, index, account, sync,
+                                                                            store, done))
+                # Hand on what's done while accounts are still coming
+                while not done.empty():
+                    pending -= 1
+                    yield done.get()
+            while pending:
+                pending -= 1
+                yield done.get()
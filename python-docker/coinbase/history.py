@@ -0,0 +1,315 @@
+# Daily portfolio value and P&L history for track.py, kept in memory-mapped columns.
+#
+# pull_cb_account_info() only knows today. update() works out, from the order
+# stream, what was held of each currency at the end of every day and what it cost,
+# prices it at that day's price, and appends the days since the last run to a
+# History: one row per day and currency held. A run with one new day does one day's
+# work. The holdings and average price it ended on are kept with the columns, so
+# only orders after the last day stored are looked at (found by binary search, the
+# orders being sorted by currency and time) and only the new days' prices are
+# needed.
+#
+# Holdings are what the orders add up to, so coins sent or received outside of buys
+# and sells aren't in them. What they cost is by the weighted average, as the sheets
+# have it by default. Only whole days (UTC) are stored, up to yesterday. Should
+# orders turn up for days already stored (a late or back-dated one), the history is
+# built again from the start, with the prices already looked up.
+#
+# DailyPrices looks up past prices (the spot price on a date, one call per currency
+# and day, concurrently through the fetcher) and keeps them in the Store, as they
+# don't change. A backfill of years of history takes a while once. Days with no
+# price take the last price before them. prefetch() looks a currency's up as soon
+# as its orders are in; what it fails to get, update() looks up again.
+#
+# A History is a directory (CB_HISTORY) of one raw file per column and meta.json,
+# the number of rows and the state to carry on from. Rows are appended to the
+# files before meta.json is replaced, so a run that dies halfway leaves rows past
+# the count that the next append writes over. Reads memory-map the files;
+# range() and totals() find a span of days by binary search over the day column.
+import datetime
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from coinbase.wallet.error import APIError
+
+from fetch import retryable
+
+PATH = os.environ.get('CB_HISTORY', './data/history')
+
+# (column, dtype), day is days since 1970-01-01
+COLUMNS = (('day', np.int32), ('currency', np.int16), ('quantity', np.float64), ('price', np.float64),
+           ('value', np.float64), ('cost', np.float64))
+
+
+def day_number(day):
+    # Days since 1970-01-01 of a date or 'YYYY-MM-DD'
+    return int(np.datetime64(day, 'D').astype(np.int64))
+
+
+def day_string(number):
+    return str(np.datetime64(int(number), 'D'))
+
+
+def yesterday():
+    return day_number(datetime.datetime.utcnow().date()) - 1
+
+
+class History(object):
+
+    def __init__(self, path=PATH):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.meta = self._load()
+        self._maps = {}
+
+    def _load(self):
+        try:
+            with open(os.path.join(self.path, 'meta.json')) as meta_file:
+                return json.load(meta_file)
+        except (IOError, ValueError):
+            # symbols: currency index -> symbol; state: symbol -> [quantity,
+            # average price] at the end of last_day; counted: symbol -> orders up
+            # to last_day
+            return {'rows': 0, 'last_day': None, 'symbols': [], 'state': {}, 'counted': {}}
+
+    def _save(self):
+        path = os.path.join(self.path, 'meta.json')
+        with open(path + '.tmp', 'w') as meta_file:
+            json.dump(self.meta, meta_file)
+        os.replace(path + '.tmp', path)
+
+    def __len__(self):
+        return self.meta['rows']
+
+    @property
+    def last_day(self):
+        return self.meta['last_day']
+
+    def currency_index(self, symbol):
+        if symbol not in self.meta['symbols']:
+            self.meta['symbols'].append(symbol)
+        return self.meta['symbols'].index(symbol)
+
+    def column(self, name):
+        # The whole column, memory-mapped read only
+        rows = len(self)
+        if self._maps.get(name, (None, -1))[1] != rows:
+            dtype = dict(COLUMNS)[name]
+            if rows:
+                column = np.memmap(os.path.join(self.path, name), dtype=dtype, mode='r', shape=(rows,))
+            else:
+                column = np.zeros(0, dtype=dtype)
+            self._maps[name] = (column, rows)
+        return self._maps[name][0]
+
+    def append(self, columns, last_day, state, counted):
+        # Appends rows ({column: array}, in day order) and records the state after
+        # last_day
+        rows = len(self)
+        added = len(columns['day'])
+        for name, dtype in COLUMNS:
+            with open(os.path.join(self.path, name), 'ab') as column_file:
+                # Past the count are rows of a run that didn't finish
+                column_file.truncate(rows * np.dtype(dtype).itemsize)
+                column_file.write(np.ascontiguousarray(columns[name], dtype=dtype).tobytes())
+        self.meta.update(rows=rows + added, last_day=last_day, state=state, counted=counted)
+        self._save()
+
+    def clear(self):
+        self.meta = {'rows': 0, 'last_day': None, 'symbols': [], 'state': {}, 'counted': {}}
+        self._maps = {}
+        self._save()
+
+    def _span(self, first, last):
+        days = self.column('day')
+        first = days[0] if first is None or not len(days) else day_number(first)
+        last = days[-1] if last is None or not len(days) else day_number(last)
+        return np.searchsorted(days, first, 'left'), np.searchsorted(days, last, 'right')
+
+    def range(self, first=None, last=None):
+        # {column: array} of the rows from day first to last (dates or 'YYYY-MM-DD',
+        # None for either end), with day as datetime64[D] and pnl, value - cost.
+        # Currencies are indices into self.meta['symbols'].
+        start, end = self._span(first, last)
+        rows = {name: np.array(self.column(name)[start:end]) for name, dtype in COLUMNS}
+        rows['day'] = rows['day'].astype('datetime64[D]')
+        rows['pnl'] = rows['value'] - rows['cost']
+        return rows
+
+    def totals(self, first=None, last=None):
+        # {'day', 'value', 'cost', 'pnl'} of the whole portfolio per day stored from
+        # first to last. Currencies with no price yet count as worth nothing.
+        start, end = self._span(first, last)
+        days = np.array(self.column('day')[start:end])
+        if not len(days):
+            return {'day': days.astype('datetime64[D]'), 'value': np.zeros(0), 'cost': np.zeros(0),
+                    'pnl': np.zeros(0)}
+        starts = np.flatnonzero(np.r_[True, days[1:] != days[:-1]])
+        value = np.add.reduceat(np.nan_to_num(self.column('value')[start:end]), starts)
+        cost = np.add.reduceat(np.array(self.column('cost')[start:end]), starts)
+        return {'day': days[starts].astype('datetime64[D]'), 'value': value, 'cost': cost, 'pnl': value - cost}
+
+
+class DailyPrices(object):
+
+    def __init__(self, fetcher, store):
+        self.fetcher = fetcher
+        self.store = store
+
+    def _lookup(self, symbol, day):
+        try:
+            return day, float(self.fetcher.call('historic_price', self.fetcher.client.get_spot_price,
+                                                currency_pair=symbol + '-USD', date=day)['amount'])
+        except APIError as error:
+            # No price that day (not listed yet, say): stored, so not asked again.
+            # Anything worth retrying is left for the next run.
+            if retryable(error):
+                raise
+            return day, None
+
+    def prices(self, symbol, first, last):
+        # USD prices of symbol from day first to last (day numbers), as an array,
+        # nan before any is known
+        days = [day_string(day) for day in range(first, last + 1)]
+        known = self.store.daily_prices(symbol, days[0], days[-1])
+        missing = [day for day in days if day not in known]
+        if missing:
+            found = []
+            with ThreadPoolExecutor(self.fetcher.concurrency) as executor:
+                for lookup in [executor.submit(self._lookup, symbol, day) for day in missing]:
+                    try:
+                        found.append(lookup.result())
+                    except Exception as error:
+                        print("   No price for %s on a day: %r" % (symbol, error))
+            self.store.add_daily_prices(symbol, found)
+            known.update(found)
+        # Carried forward over days without one, from before first if need be
+        before = self.store.last_daily_price(symbol, days[0]) if known.get(days[0]) is None else None
+        prices = np.array([before] + [known.get(day) for day in days], dtype=float)
+        last_known = np.where(np.isnan(prices), 0, np.arange(len(prices)))
+        np.maximum.accumulate(last_known, out=last_known)
+        return prices[last_known][1:]
+
+
+def _days(datetimes):
+    # Day numbers of order datetimes
+    return datetimes.astype('S10').astype('datetime64[D]').astype(np.int64)
+
+
+def _before(orders, start, end, day):
+    # Index of the first of orders[start:end] on day or after. Their datetimes are
+    # sorted, so this is a binary search, with no need to parse any.
+    return start + int(np.searchsorted(orders.datetime[start:end], day_string(day).encode('ascii'), 'left'))
+
+
+def _stale(history, orders):
+    # Whether orders turned up for days already stored. Currencies missing from
+    # orders (track.py leaves out accounts that are empty or failed to fetch) are
+    # taken to have had none since.
+    if history.last_day is None:
+        return False
+    counted = history.meta['counted']
+    for currency, symbol in enumerate(orders.symbols):
+        start, end = orders.starts[currency], orders.starts[currency + 1]
+        if _before(orders, start, end, history.last_day + 1) - start != counted.get(symbol, 0):
+            return True
+    return False
+
+
+def prefetch(history, daily_prices, symbol, first_order, until=None):
+    # Looks up ahead of update() the prices it will need for symbol, whose first
+    # order was at first_order (as the API has it, None if it has none), while other
+    # currencies are still being fetched
+    if first_order is None:
+        return
+    until = yesterday() if until is None else until
+    first = day_number(first_order[:10])
+    if history.last_day is not None:
+        first = max(first, history.last_day + 1)
+    if first <= until:
+        try:
+            daily_prices.prices(symbol, first, until)
+        except Exception as error:
+            # update() looks up what's still missing
+            print("   Looking up past prices of %s failed: %r" % (symbol, error))
+
+
+def update(history, orders, daily_prices, until=None):
+    # Appends the days after history's last day up to until (a day number,
+    # yesterday by default), returns how many days were added
+    until = yesterday() if until is None else until
+    if _stale(history, orders):
+        print("   Orders turned up for days already in the history, building it again")
+        history.clear()
+    if history.last_day is None:
+        if not len(orders):
+            return 0
+        # Each currency's first order is its oldest
+        first = int(_days(orders.datetime[orders.starts[:-1][orders.starts[:-1] < orders.starts[1:]]]).min())
+    else:
+        first = history.last_day + 1
+    if first > until:
+        return 0
+
+    state = dict(history.meta['state'])
+    counted = dict(history.meta['counted'])
+    span = np.arange(first, until + 1)
+    columns = {name: [] for name, dtype in COLUMNS}
+    for symbol in list(orders.symbols) + [symbol for symbol in state if symbol not in orders.symbols]:
+        start = end = 0
+        if symbol in orders.symbols:
+            currency = orders.symbols.index(symbol)
+            start, end = orders.starts[currency], orders.starts[currency + 1]
+        # The orders after the last day stored, up to until
+        new_start = _before(orders, start, end, first)
+        new_end = _before(orders, start, end, until + 1)
+        quantity, price = state.get(symbol, (0, 0))
+        # Holdings and average price before the new orders and after each of them,
+        # the weighted average order by order as cost_basis._average_loop() has it
+        held = np.empty(new_end - new_start + 1)
+        average = np.empty(new_end - new_start + 1)
+        held[0], average[0] = quantity, price
+        for index, buy, amount, spot_price in zip(range(1, new_end - new_start + 1),
+                                                  orders.buy[new_start:new_end].tolist(),
+                                                  orders.amount[new_start:new_end].tolist(),
+                                                  orders.spot_price[new_start:new_end].tolist()):
+            if buy:
+                den = quantity + amount
+                price = float((quantity * price + amount * spot_price) / den) if den else 0
+                quantity += amount
+            else:
+                quantity += amount
+                if quantity == 0:
+                    price = 0
+            held[index], average[index] = quantity, price
+        # Each day ends on its last order, or the day before's holdings
+        last_order = np.searchsorted(_days(orders.datetime[new_start:new_end]), span, 'right')
+        day_held = held[last_order]
+        day_average = average[last_order]
+        state[symbol] = [quantity, price]
+        counted[symbol] = counted.get(symbol, 0) + int(new_end - new_start)
+
+        kept = day_held != 0
+        if not kept.any():
+            continue
+        # Prices from the first day anything was held
+        held_from = int(np.argmax(kept))
+        day_price = daily_prices.prices(symbol, first + held_from, until)[kept[held_from:]]
+        columns['day'].append(span[kept])
+        columns['currency'].append(np.full(kept.sum(), history.currency_index(symbol)))
+        columns['quantity'].append(day_held[kept])
+        columns['price'].append(day_price)
+        columns['value'].append(day_held[kept] * day_price)
+        columns['cost'].append(day_held[kept] * day_average[kept])
+
+    if columns['day']:
+        merged = {name: np.concatenate(values) for name, values in columns.items()}
+        # Day by day, currencies in the order they were first stored
+        order = np.lexsort((merged['currency'], merged['day']))
+        merged = {name: values[order] for name, values in merged.items()}
+    else:
+        merged = {name: np.zeros(0, dtype=dtype) for name, dtype in COLUMNS}
+    history.append(merged, until, state, counted)
+    return until - first + 1
@@ -0,0 +1,459 @@
+# track.py without Coinbase, Google or Discord: local stand-ins for all three.
+#
+#   python offline.py                                   1000 made-up transactions
+#   python offline.py --transactions 10000 --latency 0.05 --rate 10
+#   python offline.py --fixture portfolio.json          one saved with --save-fixture
+#   python offline.py --from-store ./data/coinbase.sqlite3
+#
+# FakeCoinbase serves the parts of the Coinbase v2 API track.py uses (accounts,
+# transactions, buys, sells, exchange rates and spot prices, today's or on a date)
+# over HTTP from a fixture, in a process of its own, so the real client,
+# fetch.Fetcher and its connection pool are what get exercised. Every response can be held back by a
+# latency, and past a rate of requests a second it answers 429, as Coinbase does.
+# Requests are counted per endpoint, see FakeCoinbase.stats().
+#
+# A fixture is a dict of
+#   accounts      [account], as the API lists them
+#   transactions  {account id: [transaction]}, newest first
+#   details       {buy or sell id: buy or sell}
+#   prices        {symbol: USD price}
+# made up by generate_portfolio(), read from JSON, or taken from the store of a real
+# run (fixture_from_store(), with prices from the accounts' balances).
+#
+# FakeSpreadsheet and FakeDiscord keep what would have been written to Sheets and
+# posted to Discord in memory. Replay runs track.py's stages against all three.
+import argparse
+import collections
+import datetime
+import json
+import math
+import multiprocessing
+import random
+import tempfile
+import threading
+import time
+import warnings
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlparse
+
+import requests
+from gspread.utils import a1_to_rowcol
+
+import fetch
+import history
+import pipeline
+import track
+from prices import CoinbaseRates, PriceCache
+from sheets import SheetSink
+from store import Store, detail_id
+
+# Default and largest page of a listing, as the API has them
+PAGE_LIMIT = 25
+MAX_PAGE_LIMIT = 100
+
+
+def generate_portfolio(transactions, currencies=10, seed=0, end=None):
+    # A fixture of about transactions transactions over currencies accounts, plus a
+    # USD wallet: buys mostly, sales now and then, and some coins sent in. Every
+    # account has one an hour, the last at end (the start of today, UTC, by default).
+    rng = random.Random(seed)
+    end = end or datetime.datetime.combine(datetime.datetime.utcnow().date(), datetime.time())
+    fixture = {'accounts': [], 'transactions': {}, 'details': {}, 'prices': {}}
+    for currency in range(currencies + 1):
+        symbol = 'USD' if currency == currencies else 'C%d' % currency
+        account_id = 'account-%s' % symbol
+        price = 1.0 if symbol == 'USD' else round(rng.uniform(0.1, 50000), 2)
+        history = []
+        held = 0
+        count = 0 if symbol == 'USD' else transactions // currencies + (currency < transactions % currencies)
+        for index in range(count):
+            created_at = (end - datetime.timedelta(hours=count - 1 - index)).strftime('%Y-%m-%dT%H:%M:%SZ')
+            transaction_id = '%s-%d' % (account_id, index)
+            spot_price = price * rng.uniform(0.5, 1.5)
+            kind = rng.random()
+            if held > 0 and kind < 0.1:
+                kind, amount = 'sell', -held * rng.uniform(0.01, 0.5)
+            elif kind < 0.15:
+                kind, amount = 'send', rng.uniform(0.001, 0.1)
+            else:
+                kind, amount = 'buy', rng.uniform(0.001, 0.1)
+            held += amount
+            transaction = {'id': transaction_id, 'type': kind, 'status': 'completed', 'created_at': created_at,
+                           'amount': {'amount': '%.8f' % amount, 'currency': symbol},
+                           'native_amount': {'amount': '%.2f' % (amount * spot_price), 'currency': 'USD'}}
+            if kind != 'send':
+                subtotal = abs(amount) * spot_price
+                fee = round(subtotal * 0.015, 2)
+                transaction[kind] = {'id': 'detail-' + transaction_id, 'resource': kind}
+                fixture['details']['detail-' + transaction_id] = {
+                    'id': 'detail-' + transaction_id, 'resource': kind, 'status': 'completed',
+                    'subtotal': {'amount': '%.2f' % subtotal, 'currency': 'USD'},
+                    'total': {'amount': '%.2f' % (subtotal + fee if kind == 'buy' else subtotal - fee),
+                              'currency': 'USD'},
+                    'fees': [{'type': 'coinbase', 'amount': {'amount': '%.2f' % fee, 'currency': 'USD'}}]}
+            history.append(transaction)
+        if symbol == 'USD':
+            held = round(rng.uniform(0, 1000), 2)
+        fixture['accounts'].append({'id': account_id, 'resource': 'account', 'type': 'wallet',
+                                    'currency': symbol, 'name': '%s Wallet' % symbol,
+                                    'balance': {'amount': '%.8f' % held, 'currency': symbol},
+                                    'native_balance': {'amount': '%.2f' % (held * price), 'currency': 'USD'}})
+        fixture['transactions'][account_id] = history[::-1]
+        fixture['prices'][symbol] = price
+    return fixture
+
+
+def fixture_from_store(store):
+    # A fixture of what a real run left in its store
+    fixture = {'accounts': store.accounts(), 'transactions': {}, 'details': {}, 'prices': {}}
+    for account in fixture['accounts']:
+        transactions = fixture['transactions'][account['id']] = store.transactions(account['id'])
+        ids = [detail_id(transaction) for transaction in transactions]
+        fixture['details'].update(store.details(id_ for id_ in ids if id_ is not None))
+        quantity = float(account['balance']['amount'])
+        if quantity > 0:
+            fixture['prices'][account['balance']['currency']] = float(account['native_balance']['amount']) / quantity
+    return fixture
+
+
+class RateLimit(object):
+    # A token bucket of rate requests a second, a second's worth deep
+
+    def __init__(self, rate, clock=time.monotonic):
+        self.rate = rate
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._tokens = rate
+        self._at = clock()
+
+    def take(self):
+        # 0 if the request may go ahead, else the seconds until one may
+        with self._lock:
+            now = self.clock()
+            self._tokens = min(self.rate, self._tokens + (now - self._at) * self.rate)
+            self._at = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self.rate
+
+
+class CoinbaseHandler(BaseHTTPRequestHandler):
+    # Keep-alive, as the API has it, so the client's pooled connections get reused
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, blob, headers=()):
+        body = json.dumps(blob).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for header in headers:
+            self.send_header(*header)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _error(self, status, error_id, message, headers=()):
+        self._send(status, {'errors': [{'id': error_id, 'message': message}]}, headers)
+
+    def do_GET(self):
+        server = self.server
+        url = urlparse(self.path)
+        parts = url.path.strip('/').split('/')
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        if parts == ['_stats']:
+            with server.lock:
+                self._send(200, dict(server.calls))
+            return
+        endpoint, handler = server.route(parts)
+        with server.lock:
+            server.calls[endpoint] += 1
+        if server.latency:
+            time.sleep(server.latency)
+        if server.rate_limit is not None:
+            wait = server.rate_limit.take()
+            if wait:
+                with server.lock:
+                    server.calls['rate_limited'] += 1
+                self._error(429, 'rate_limit_exceeded', 'Too many requests',
+                            [('Retry-After', str(int(math.ceil(wait))))])
+                return
+        if handler is None:
+            self._error(404, 'not_found', 'Not found')
+            return
+        try:
+            self._send(200, handler(url.path, params))
+        except KeyError:
+            self._error(404, 'not_found', 'Not found')
+
+
+class CoinbaseServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, fixture, latency=0, rate=0):
+        ThreadingHTTPServer.__init__(self, ('127.0.0.1', 0), CoinbaseHandler)
+        self.fixture = fixture
+        self.latency = latency
+        self.rate_limit = RateLimit(rate) if rate else None
+        self.lock = threading.Lock()
+        self.calls = collections.Counter()
+        self.accounts = {account['id']: account for account in fixture['accounts']}
+
+    def route(self, parts):
+        # (endpoint, handler(path, params) -> response blob, or None)
+        if parts[:1] != ['v2']:
+            return 'unknown', None
+        parts = parts[1:]
+        if parts == ['accounts']:
+            return 'accounts', lambda path, params: self._page(path, params, self.fixture['accounts'])
+        if len(parts) == 3 and parts[0] == 'accounts' and parts[2] == 'transactions':
+            return 'transactions', lambda path, params: self._page(path, params,
+                                                                   self.fixture['transactions'][parts[1]])
+        if len(parts) == 4 and parts[0] == 'accounts' and parts[2] in ('buys', 'sells'):
+            return parts[2][:-1], lambda path, params: {'data': self.fixture['details'][parts[3]]}
+        if parts == ['exchange-rates']:
+            return 'exchange_rates', self._exchange_rates
+        if len(parts) == 3 and parts[0] == 'prices' and parts[2] == 'spot':
+            return 'spot_price', lambda path, params: self._spot_price(parts[1], params.get('date'))
+        return 'unknown', None
+
+    def _page(self, path, params, items):
+        # Newest first unless asked for order=asc, from the item after starting_after
+        if params.get('order') == 'asc':
+            items = items[::-1]
+        limit = min(MAX_PAGE_LIMIT, int(params.get('limit', PAGE_LIMIT)))
+        start = 0
+        if 'starting_after' in params:
+            start = [item['id'] for item in items].index(params['starting_after']) + 1
+        data = items[start:start + limit]
+        next_uri = None
+        if start + limit < len(items):
+            next_uri = '%s?%s' % (path, urlencode(dict(params, limit=limit, starting_after=data[-1]['id'])))
+        return {'pagination': {'limit': limit, 'order': params.get('order', 'desc'),
+                               'starting_after': params.get('starting_after'), 'ending_before': None,
+                               'previous_uri': None, 'next_uri': next_uri},
+                'data': data}
+
+    def _exchange_rates(self, path, params):
+        rates = {symbol: '%.12g' % (1 / price) for symbol, price in self.fixture['prices'].items() if price > 0}
+        return {'data': {'currency': 'USD', 'rates': rates}}
+
+    def _spot_price(self, pair, date=None):
+        # On a date, the price drifts around today's by day
+        base, currency = pair.split('-')
+        price = self.fixture['prices'][base]
+        if date:
+            price *= 1 + 0.2 * math.sin(datetime.date.fromisoformat(date).toordinal() / 17.0)
+        return {'data': {'base': base, 'currency': currency, 'amount': '%.2f' % price}}
+
+
+def _serve(fixture, latency, rate, connection):
+    server = CoinbaseServer(fixture, latency, rate)
+    connection.send(server.server_address[1])
+    server.serve_forever()
+
+
+class FakeCoinbase(object):
+    # A CoinbaseServer in a process of its own, so neither its threads nor its
+    # memory count against the client's
+
+    def __init__(self, fixture, latency=0, rate=0):
+        self.fixture = fixture
+        self.latency = latency
+        self.rate = rate
+        self.uri = None
+        self._process = None
+
+    def start(self):
+        parent, child = multiprocessing.Pipe()
+        self._process = multiprocessing.Process(target=_serve, args=(self.fixture, self.latency, self.rate, child),
+                                                daemon=True)
+        self._process.start()
+        self.uri = 'http://127.0.0.1:%d/' % parent.recv()
+        return self
+
+    def stop(self):
+        if self._process is not None:
+            self._process.terminate()
+            self._process.join()
+            self._process = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def stats(self):
+        # {endpoint: requests} so far, 'rate_limited' counting those answered with a 429
+        return requests.get(self.uri + '_stats').json()
+
+
+class FakeWorksheet(object):
+
+    def __init__(self, title, index):
+        self.title = title
+        self.index = index
+        # (row, column) -> value, both from 1
+        self.cells = {}
+
+    def rows(self):
+        # The worksheet as rows from A1, '' where nothing was written
+        if not self.cells:
+            return []
+        height = max(row for row, column in self.cells)
+        width = max(column for row, column in self.cells)
+        return [[self.cells.get((row, column), '') for column in range(1, width + 1)]
+                for row in range(1, height + 1)]
+
+
+class FakeSpreadsheet(object):
+    # The calls of a gspread Spreadsheet that SheetSink makes, counted in calls
+
+    def __init__(self, titles=('Portfolio', 'Wallets', 'Orders'), id='offline'):
+        self.id = id
+        self.sheets = [FakeWorksheet(title, index) for index, title in enumerate(titles)]
+        self.calls = collections.Counter()
+        self.cells_written = 0
+
+    def worksheets(self):
+        self.calls['worksheets'] += 1
+        return list(self.sheets)
+
+    def get_worksheet(self, index):
+        return self.sheets[index]
+
+    def values_batch_update(self, body):
+        self.calls['values_batch_update'] += 1
+        titles = {sheet.title: sheet for sheet in self.sheets}
+        for update in body['data']:
+            title, cells = update['range'].rsplit('!', 1)
+            sheet = titles[title.strip("'").replace("''", "'")]
+            top, left = a1_to_rowcol(cells.split(':')[0])
+            for row, values in enumerate(update['values']):
+                for column, value in enumerate(values):
+                    sheet.cells[top + row, left + column] = value
+                self.cells_written += len(values)
+        return {'totalUpdatedCells': self.cells_written}
+
+
+class FakeDiscord(object):
+
+    def __init__(self):
+        # [(urls, message)]
+        self.posts = []
+
+    def post(self, urls, message_content):
+        # As track.post_to_discord()
+        self.posts.append((urls, message_content))
+
+
+class Replay(object):
+    # One run of track.py after another, against the stand-ins, keeping the client,
+    # store, sheet snapshot and history between runs as daemon.py does. Its stages
+    # can be run one at a time, in STAGES order, each taking what the one before
+    # returned.
+    STAGES = ('connect', 'pull', 'sheets', 'history', 'discord')
+
+    def __init__(self, coinbase, spreadsheet=None, discord=None, store_path=':memory:'):
+        self.coinbase = coinbase
+        self.spreadsheet = spreadsheet or FakeSpreadsheet()
+        self.discord = discord or FakeDiscord()
+        self.store_path = store_path
+        self._snapshots = tempfile.TemporaryDirectory()
+        self.sheet_sink = SheetSink(self.spreadsheet, self._snapshots.name + '/sheets.json', full=False)
+        self.history = history.History(self._snapshots.name + '/history')
+        self.fetcher = None
+
+    def connect(self, _=None):
+        if self.fetcher is None:
+            with warnings.catch_warnings():
+                # It's plain HTTP, on purpose
+                warnings.simplefilter('ignore')
+                client = track.create_coinbase_client('offline', 'offline', self.coinbase.uri)
+            self.fetcher = fetch.Fetcher(client)
+            self.price_cache = PriceCache(CoinbaseRates(self.fetcher))
+            self.transaction_store = Store(self.store_path)
+            self.daily_prices = history.DailyPrices(self.fetcher, self.transaction_store)
+        self.fetcher.stats = fetch.CallStats()
+
+    def pull(self, _=None):
+        # Past prices are looked up as currencies come in, up to the history stage
+        self.history_prices = pipeline.Worker('history prices', lambda item: history.prefetch(
+            self.history, self.daily_prices, *item))
+        return track.pull_cb_account_info(self.fetcher, self.transaction_store, self.price_cache,
+                                          lambda *item: self.history_prices.put(item))
+
+    def sheets(self, my_coinbase):
+        track.write_sheets(my_coinbase, self.sheet_sink)
+        return my_coinbase
+
+    def update_history(self, my_coinbase):
+        self.history_prices.close()
+        track.update_history(my_coinbase, self.history, self.daily_prices)
+        return my_coinbase
+
+    def post(self, my_coinbase):
+        self.discord.post(['offline'], track.discord_message(my_coinbase))
+        return my_coinbase
+
+    def stage(self, name):
+        return {'connect': self.connect, 'pull': self.pull, 'sheets': self.sheets, 'history': self.update_history,
+                'discord': self.post}[name]
+
+    def run(self):
+        result = None
+        for name in self.STAGES:
+            result = self.stage(name)(result)
+        return result
+
+    def close(self):
+        if self.fetcher is not None:
+            self.transaction_store.close()
+        self._snapshots.cleanup()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--transactions', type=int, default=1000)
+    parser.add_argument('--currencies', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--fixture', help='a fixture saved as JSON, in place of a made-up one')
+    parser.add_argument('--from-store', help="a transaction store of real runs, in place of a made-up fixture")
+    parser.add_argument('--save-fixture', help='save the fixture as JSON here')
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds every response is held back')
+    parser.add_argument('--rate', type=float, default=0, help='requests a second before 429s, 0 for no limit')
+    parser.add_argument('--runs', type=int, default=1)
+    args = parser.parse_args(argv)
+
+    if args.fixture:
+        with open(args.fixture) as fixture_file:
+            fixture = json.load(fixture_file)
+    elif args.from_store:
+        store = Store(args.from_store)
+        fixture = fixture_from_store(store)
+        store.close()
+    else:
+        fixture = generate_portfolio(args.transactions, args.currencies, args.seed)
+    if args.save_fixture:
+        with open(args.save_fixture, 'w') as fixture_file:
+            json.dump(fixture, fixture_file)
+
+    with FakeCoinbase(fixture, args.latency, args.rate) as coinbase:
+        replay = Replay(coinbase)
+        try:
+            for run in range(args.runs):
+                started = time.perf_counter()
+                replay.run()
+                print("Run %d: %.2fs, Coinbase requests %s, Sheets calls %s, Discord: %r"
+                      % (run + 1, time.perf_counter() - started, coinbase.stats(),
+                         dict(replay.spreadsheet.calls), replay.discord.posts[-1][1]))
+        finally:
+            replay.close()
+    return 0
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+# Stages of track.py running side by side, handing their results on through bounded
+# queues.
+#
+# track.py used to finish every step before the next began: all accounts fetched,
+# then all of them worked out, then Google connected to, then the sheets written.
+# stage() runs a generator in a thread of its own and hands its items to whatever
+# iterates the Channel it returns, as they come, holding at most CB_QUEUE_SIZE of
+# them: a stage that gets ahead waits for the next to catch up, so nothing is held
+# in memory for longer than it takes to be used. An exception in a stage comes out
+# of the Channel at the point it happened.
+#
+# background() runs a call in a thread (connecting to Google, say) while the rest
+# goes on; Worker calls a function on every item put to it, in a thread, for sinks
+# that needn't hold anything up.
+import os
+import queue
+import threading
+from concurrent.futures import Future
+
+QUEUE_SIZE = int(os.environ.get('CB_QUEUE_SIZE', '16'))
+
+
+# Marks the end of a Channel's items
+_END = object()
+
+
+class Cancelled(Exception):
+    # Raised in a stage whose Channel is no longer being read
+    pass
+
+
+class Channel(object):
+
+    def __init__(self, size=QUEUE_SIZE):
+        self._queue = queue.Queue(size)
+        self._cancelled = threading.Event()
+
+    def _put(self, entry):
+        # Waits for room, unless the Channel stopped being read
+        while not self._cancelled.is_set():
+            try:
+                self._queue.put(entry, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+        raise Cancelled()
+
+    def put(self, item):
+        self._put((item, None))
+
+    def close(self, error=None):
+        # The end of the items, or the exception they ended with
+        try:
+            self._put((_END, error))
+        except Cancelled:
+            pass
+
+    def __iter__(self):
+        try:
+            while True:
+                item, error = self._queue.get()
+                if item is not _END:
+                    yield item
+                elif error is not None:
+                    raise error
+                else:
+                    return
+        finally:
+            # Read to the end or given up on, either way the stage can stop
+            self._cancelled.set()
+
+
+def stage(name, items, size=QUEUE_SIZE):
+    # A Channel of items (a generator, say), run in a thread of its own
+    channel = Channel(size)
+
+    def run():
+        try:
+            for item in items:
+                channel.put(item)
+        except Cancelled:
+            pass
+        except BaseException as error:
+            channel.close(error)
+        else:
+            channel.close()
+
+    threading.Thread(target=run, name=name, daemon=True).start()
+    return channel
+
+
+def background(name, fn, *args, **kwargs):
+    # A Future of fn(*args, **kwargs), called in a thread of its own
+    future = Future()
+
+    def run():
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as error:
+            future.set_exception(error)
+
+    threading.Thread(target=run, name=name, daemon=True).start()
+    return future
+
+
+class Worker(object):
+    # Calls fn(item) for every item put, one after the other, in a thread. close()
+    # waits for the ones put to be done and raises the first exception, if any; items
+    # after it are dropped.
+
+    def __init__(self, name, fn, size=QUEUE_SIZE):
+        self._channel = Channel(size)
+        self._done = background(name, self._run, fn)
+
+    def _run(self, fn):
+        for item in self._channel:
+            fn(item)
+
+    def put(self, item):
+        try:
+            self._channel.put(item)
+        except Cancelled:
+            # fn failed, close() will tell
+            pass
+
+    def close(self):
+        self._channel.close()
+        return self._done.result()
@@ -0,0 +1,252 @@
+# Many portfolios tracked at once, in one process.
+#
+#   python portfolios.py [manifest or directory]
+#
+# Tracking a portfolio per container pays the interpreter start, the imports, and
+# connections and price lookups of its own for every one. portfolios.py reads
+# credential sets from CB_PORTFOLIOS: either a directory of JSON files, one per
+# portfolio and named after it, or one JSON manifest, {"portfolios": [...]}. Each has
+# the 'key' and 'scrt' of cb_credentials.json, and may have:
+#   name          what its data goes under (the file's name in a directory)
+#   spreadsheet   the Google spreadsheet it's written to, "Coinbase Portfolio <name>"
+#                 by default
+#   discord       webhook urls to post its gains to, none by default
+#   rate          Coinbase calls a second, CB_TENANT_RATE by default
+#   base_api_uri  another Coinbase API (offline.py's, say)
+#
+# Up to CB_PORTFOLIO_CONCURRENCY portfolios run at once, each through track.py's
+# pipeline. They share the pool of connections to Coinbase, the price cache (looked
+# up through any portfolio that has connected, prices being the same for everyone),
+# the past daily prices of the history and one Google authorization.
+# Coinbase rate limits by API key, so each portfolio has a Fetcher of its own, with
+# its own rate limit and its own pause after a 429; its store, sheet snapshot and
+# history are kept under CB_PORTFOLIO_DATA/<name>/. A portfolio that fails is
+# reported at the end and the others carry on.
+#
+# Progress is printed as it comes, the portfolios' lines mixed together. At the end
+# come how each portfolio went and the throughput, in portfolios a minute.
+import argparse
+import json
+import os
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from coinbase.wallet.client import Client
+
+import fetch
+import history
+import pipeline
+import track
+from history import DailyPrices, History
+from prices import CoinbaseRates, PriceCache
+from sheets import SheetSink
+from store import Store
+
+PORTFOLIOS = os.environ.get('CB_PORTFOLIOS', './credentials/portfolios')
+DATA = os.environ.get('CB_PORTFOLIO_DATA', './data/portfolios')
+CONCURRENCY = int(os.environ.get('CB_PORTFOLIO_CONCURRENCY', '4'))
+# Coinbase calls a second per portfolio, under Coinbase's own limit per API key
+TENANT_RATE = float(os.environ.get('CB_TENANT_RATE', '10'))
+
+
+def load_portfolios(path=PORTFOLIOS):
+    # [{'name', 'key', 'scrt', 'spreadsheet', 'discord', 'rate', 'base_api_uri'}] of
+    # a directory or manifest. Credentials are only checked when a portfolio runs,
+    # so one that's wrong fails alone.
+    if os.path.isdir(path):
+        entries = []
+        for filename in sorted(os.listdir(path)):
+            if filename.endswith('.json'):
+                with open(os.path.join(path, filename)) as portfolio_file:
+                    entry = json.load(portfolio_file)
+                entry.setdefault('name', filename[:-len('.json')])
+                entries.append(entry)
+    else:
+        with open(path) as manifest_file:
+            entries = json.load(manifest_file)['portfolios']
+
+    portfolios = []
+    for entry in entries:
+        name = entry.get('name')
+        # Names are directories under CB_PORTFOLIO_DATA
+        if not name or name.startswith('.') or os.path.basename(name) != name:
+            raise ValueError("Portfolio name %r won't do as a directory name" % name)
+        if name in [portfolio['name'] for portfolio in portfolios]:
+            raise ValueError("There are two portfolios named %r" % name)
+        portfolios.append({'name': name,
+                           'key': entry.get('key'),
+                           'scrt': entry.get('scrt'),
+                           'spreadsheet': entry.get('spreadsheet', '%s %s' % (track.SPREADSHEET, name)),
+                           'discord': entry.get('discord', []),
+                           'rate': float(entry.get('rate', TENANT_RATE)),
+                           'base_api_uri': entry.get('base_api_uri')})
+    return portfolios
+
+
+class SharedRates(object):
+    # CoinbaseRates through any of the fetchers offered that has connected. Prices
+    # are the same for everyone, and a portfolio only looks them up once it has
+    # listed its accounts, so its own fetcher is one by then. A fetcher whose lookup
+    # gets no answer, or is turned away, is dropped and the next one tried.
+
+    def __init__(self):
+        self._fetchers = []
+        self._lock = threading.Lock()
+
+    def offer(self, fetcher):
+        with self._lock:
+            self._fetchers.append(fetcher)
+
+    def _lookup(self, lookup):
+        while True:
+            with self._lock:
+                connected = [fetcher for fetcher in self._fetchers if fetcher.connected]
+            if not connected:
+                raise LookupError('No portfolio has connected to Coinbase')
+            try:
+                return lookup(CoinbaseRates(connected[0]))
+            except Exception as error:
+                # A symbol with no price says nothing against the fetcher
+                if not (fetch.retryable(error) or getattr(error, 'status_code', None) in (401, 403)):
+                    raise
+                with self._lock:
+                    if connected[0] in self._fetchers:
+                        self._fetchers.remove(connected[0])
+
+    def bulk(self):
+        return self._lookup(lambda rates: rates.bulk())
+
+    def price(self, symbol):
+        return self._lookup(lambda rates: rates.price(symbol))
+
+
+class FanOut(object):
+    # Runs portfolios through track.py's pipeline, concurrency at a time, with what
+    # they can share shared. open_spreadsheet(name) opens a spreadsheet, by default
+    # through one Google authorization.
+
+    def __init__(self, portfolios, data=DATA, concurrency=CONCURRENCY, open_spreadsheet=None,
+                 google_creds=track.GOOGLE_CREDS):
+        self.portfolios = portfolios
+        self.data = data
+        self.concurrency = max(1, concurrency)
+        # Each portfolio fetches accounts and past prices on a pool of threads each
+        self.adapter = fetch.connection_pool(2 * self.concurrency * fetch.CONCURRENCY)
+        self.rates = SharedRates()
+        self.price_cache = PriceCache(self.rates)
+        os.makedirs(data, exist_ok=True)
+        self.price_store = Store(os.path.join(data, 'prices.sqlite3'))
+        self.open_spreadsheet = open_spreadsheet or self._open_google
+        self.google_creds = google_creds
+        self._google = None
+        self._google_lock = threading.Lock()
+
+    def _open_google(self, name):
+        with self._google_lock:
+            if self._google is None:
+                print("3. Connecting to Google Sheets...")
+                self._google = track.authorize_google(self.google_creds)
+        return self._google.open(name)
+
+    def run_portfolio(self, portfolio):
+        # {'name', 'ok', 'seconds', 'calls', 'cells_written', 'history_days',
+        #  'history_error', 'discord_posted', 'current_value', 'error'} of one
+        # portfolio's run. One whose history failed is still ok.
+        started = time.time()
+        run = {'name': portfolio['name'], 'ok': False, 'calls': 0, 'cells_written': None,
+               'history_days': None, 'history_error': None, 'discord_posted': False}
+        data = os.path.join(self.data, portfolio['name'])
+        fetcher = transaction_store = None
+        try:
+            spreadsheet = pipeline.background('google', self.open_spreadsheet, portfolio['spreadsheet'])
+            # Not checked with a call of its own as create_coinbase_client() does:
+            # listing the accounts is the first call, and it goes through the
+            # shared pool
+            client = Client(portfolio['key'], portfolio['scrt'], portfolio['base_api_uri'])
+            fetcher = fetch.Fetcher(client, rate=portfolio['rate'], adapter=self.adapter)
+            self.rates.offer(fetcher)
+            transaction_store = Store(os.path.join(data, 'coinbase.sqlite3'))
+            portfolio_history = History(os.path.join(data, 'history'))
+            daily_prices = DailyPrices(fetcher, self.price_store)
+            history_prices = pipeline.Worker('history prices', lambda item: history.prefetch(
+                portfolio_history, daily_prices, *item))
+            try:
+                my_coinbase = track.pull_cb_account_info(fetcher, transaction_store, self.price_cache,
+                                                         lambda *item: history_prices.put(item))
+                run['current_value'] = my_coinbase['current_value']
+                sheet_sink = SheetSink(spreadsheet.result(), os.path.join(data, 'sheets.json'))
+                run['cells_written'] = track.write_sheets(my_coinbase, sheet_sink)
+            finally:
+                history_prices.close()
+            try:
+                run['history_days'] = track.update_history(my_coinbase, portfolio_history, daily_prices)
+            except Exception as error:
+                # The sheets are written all the same; the days are added next run
+                print("History of %s failed:" % portfolio['name'])
+                traceback.print_exc()
+                run['history_error'] = repr(error)
+            if portfolio['discord']:
+                try:
+                    track.post_to_discord(portfolio['discord'], track.discord_message(my_coinbase))
+                    run['discord_posted'] = True
+                except Exception:
+                    print('Something went wrong trying to post to discord for %s!' % portfolio['name'])
+                    traceback.print_exc()
+            run['ok'] = True
+        except Exception as error:
+            print("Portfolio %s failed:" % portfolio['name'])
+            traceback.print_exc()
+            run['error'] = repr(error)
+        finally:
+            if transaction_store is not None:
+                transaction_store.close()
+        if fetcher is not None:
+            run['calls'] = sum(fetcher.stats.calls.values())
+        run['seconds'] = round(time.time() - started, 3)
+        return run
+
+    def run(self):
+        # The run dict of every portfolio, in order
+        with ThreadPoolExecutor(self.concurrency) as executor:
+            return list(executor.map(self.run_portfolio, self.portfolios))
+
+    def close(self):
+        self.price_store.close()
+
+
+def report(runs, seconds):
+    print("\n=====Portfolios=====\n")
+    for run in runs:
+        if run['ok']:
+            print("%-24s ok     %7.1fs  %4d calls  $%.2f, %d cells written, %s"
+                  % (run['name'], run['seconds'], run['calls'], run['current_value'], run['cells_written'],
+                     'history failed: %s' % run['history_error'] if run['history_error']
+                     else '%d new days' % run['history_days']))
+        else:
+            print("%-24s failed %7.1fs  %4d calls  %s" % (run['name'], run['seconds'], run['calls'], run['error']))
+    failed = sum(not run['ok'] for run in runs)
+    print("\n%d portfolios (%d failed) in %.1fs: %.1f portfolios a minute"
+          % (len(runs), failed, seconds, 60 * len(runs) / seconds if seconds else 0))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('portfolios', nargs='?', default=PORTFOLIOS,
+                        help='a directory of credential files or a manifest')
+    parser.add_argument('--concurrency', type=int, default=CONCURRENCY, help='portfolios run at once')
+    args = parser.parse_args(argv)
+
+    fan_out = FanOut(load_portfolios(args.portfolios), concurrency=args.concurrency)
+    try:
+        started = time.perf_counter()
+        runs = fan_out.run()
+        report(runs, time.perf_counter() - started)
+    finally:
+        fan_out.close()
+    return 0
+
+
+if __name__ == '__main__':
+    main()
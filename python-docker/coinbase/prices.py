@@ -0,0 +1,87 @@
+# USD prices for track.py, looked up in bulk and cached.
+#
+# pull_cb_account_info() used to ask for one spot price per account. A PriceCache
+# asks its backend for every price it has in one go (CoinbaseRates: one
+# exchange-rates call), keeps them for CB_PRICE_TTL seconds, and only looks up prices
+# one by one for symbols the bulk lookup didn't have. One cache is meant to be shared
+# by everything that needs prices in a process, so they're looked up once per TTL.
+#
+# A backend is anything with:
+#   bulk()          {symbol: USD price} of every symbol it can price at once
+#   price(symbol)   the USD price of one symbol, raising if there is none
+# StaticPrices is one over a fixed dict, for tests and benchmarks.
+import os
+import threading
+import time
+
+TTL = float(os.environ.get('CB_PRICE_TTL', '60'))
+
+
+class CoinbaseRates(object):
+
+    def __init__(self, fetcher):
+        # Calls go through the fetcher for its retries and call counts
+        self.fetcher = fetcher
+
+    def bulk(self):
+        # The rates are per USD (0.00002 BTC to the dollar), so a price is 1 / rate
+        rates = self.fetcher.call('exchange_rates', self.fetcher.client.get_exchange_rates, currency='USD')['rates']
+        return {symbol: 1 / float(rate) for symbol, rate in rates.items() if float(rate) > 0}
+
+    def price(self, symbol):
+        return float(self.fetcher.call('spot_price', self.fetcher.client.get_spot_price,
+                                       currency_pair=symbol + '-USD')['amount'])
+
+
+class StaticPrices(object):
+
+    def __init__(self, prices):
+        self.prices = dict(prices)
+
+    def bulk(self):
+        return dict(self.prices)
+
+    def price(self, symbol):
+        return self.prices[symbol]
+
+
+class PriceCache(object):
+
+    def __init__(self, backend, ttl=TTL, clock=time.monotonic):
+        self.backend = backend
+        self.ttl = ttl
+        self.clock = clock
+        # Lookups hold the lock, so threads asking at once share one bulk lookup
+        self._lock = threading.Lock()
+        # symbol -> (price, clock() when looked up)
+        self._prices = {}
+        self._bulk_at = None
+
+    def _fresh(self, symbol, now):
+        cached = self._prices.get(symbol)
+        return cached is not None and now - cached[1] < self.ttl
+
+    def prices(self, symbols):
+        # {symbol: USD price} of those of symbols there is a price for
+        with self._lock:
+            now = self.clock()
+            stale = [symbol for symbol in symbols if not self._fresh(symbol, now)]
+            if stale and (self._bulk_at is None or now - self._bulk_at >= self.ttl):
+                try:
+                    bulk = self.backend.bulk()
+                except Exception as error:
+                    print("   Bulk price lookup failed, looking prices up one by one: %r" % error)
+                else:
+                    self._bulk_at = now
+                    self._prices.update((symbol, (price, now)) for symbol, price in bulk.items())
+            for symbol in stale:
+                if self._fresh(symbol, now):
+                    continue
+                try:
+                    self._prices[symbol] = (self.backend.price(symbol), now)
+                except Exception as error:
+                    print("   No price for %s: %r" % (symbol, error))
+            return {symbol: self._prices[symbol][0] for symbol in symbols if self._fresh(symbol, now)}
+
+    def price(self, symbol):
+        return self.prices([symbol]).get(symbol)
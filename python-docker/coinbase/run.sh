@@ -1 +1 @@
-sudo docker run -it coinbase-tracker
+sudo docker run -it -v "$(pwd)/data:/app/data" coinbase-tracker
\ No newline at end of file
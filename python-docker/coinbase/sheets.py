@@ -0,0 +1,104 @@
+# Delta-only writes of track.py's worksheets.
+#
+# The generate_*() functions used to read a range of each worksheet (one round trip),
+# set every cell and write it all back with update_cells (another), about six calls a
+# run, with the order sheet rewritten from its first row every time. A SheetSink
+# takes blocks of rows instead, each anchored at a cell of a worksheet, and compares
+# them with a local snapshot of what it last wrote (CB_SHEETS_SNAPSHOT). Only cells
+# that changed are sent, in one values batch update for all worksheets; new orders
+# at the bottom of the order sheet are sent as one range of new rows. Rows a block
+# no longer has are cleared. Nothing is sent when nothing changed.
+#
+# The snapshot is kept per spreadsheet, and only updated once a batch went through.
+# Cells edited by hand aren't noticed: delete the snapshot (or set CB_SHEETS_FULL=1)
+# to write everything again.
+import json
+import os
+
+from gspread.utils import a1_to_rowcol, absolute_range_name, rowcol_to_a1
+
+SNAPSHOT = os.environ.get('CB_SHEETS_SNAPSHOT', './data/sheets.json')
+FULL = os.environ.get('CB_SHEETS_FULL', '') == '1'
+
+
+def changed_ranges(anchor, old_rows, new_rows):
+    # [(A1 range, rows of values)] of the cells of new_rows that differ from old_rows,
+    # both blocks anchored at the same cell. Rows changed over the same columns are
+    # sent as one range.
+    top, left = a1_to_rowcol(anchor)
+    spans = []
+    for index in range(max(len(old_rows), len(new_rows))):
+        old = old_rows[index] if index < len(old_rows) else []
+        new = new_rows[index] if index < len(new_rows) else []
+        width = max(len(old), len(new))
+        # Cells a row no longer has are cleared
+        new = list(new) + [''] * (width - len(new))
+        changed = [column for column in range(width)
+                   if column >= len(old) or old[column] != new[column]]
+        if changed:
+            spans.append((index, changed[0], changed[-1], new[changed[0]:changed[-1] + 1]))
+
+    ranges = []
+    for index, first, last, values in spans:
+        if ranges and ranges[-1][1:4] == [index - 1, first, last]:
+            ranges[-1][1] = index
+            ranges[-1][4].append(values)
+        else:
+            ranges.append([index, index, first, last, [values]])
+    return [('%s:%s' % (rowcol_to_a1(top + start, left + first), rowcol_to_a1(top + end, left + last)), values)
+            for start, end, first, last, values in ranges]
+
+
+class SheetSink(object):
+
+    def __init__(self, spreadsheet, snapshot_path=SNAPSHOT, full=FULL):
+        self.spreadsheet = spreadsheet
+        self.snapshot_path = snapshot_path
+        snapshots = self._load()
+        self.snapshot = {} if full else snapshots.get(spreadsheet.id, {})
+        self._titles = None
+        # 'sheet index!anchor' -> rows, staged for the next flush()
+        self._staged = {}
+
+    def _load(self):
+        try:
+            with open(self.snapshot_path) as snapshot_file:
+                return json.load(snapshot_file)
+        except (IOError, ValueError):
+            return {}
+
+    def _save(self):
+        snapshots = self._load()
+        snapshots[self.spreadsheet.id] = self.snapshot
+        if os.path.dirname(self.snapshot_path):
+            os.makedirs(os.path.dirname(self.snapshot_path), exist_ok=True)
+        with open(self.snapshot_path + '.tmp', 'w') as snapshot_file:
+            json.dump(snapshots, snapshot_file)
+        os.replace(self.snapshot_path + '.tmp', self.snapshot_path)
+
+    def title(self, sheet):
+        # Titles of all worksheets come with one metadata call, the first time
+        if self._titles is None:
+            self._titles = [worksheet.title for worksheet in self.spreadsheet.worksheets()]
+        return self._titles[sheet]
+
+    def stage(self, sheet, anchor, rows):
+        # rows of values for the worksheet at index sheet, from the cell at anchor on
+        self._staged['%d!%s' % (sheet, anchor)] = [list(row) for row in rows]
+
+    def flush(self):
+        # Sends what changed since the last flush, returns the number of cells sent
+        data = []
+        cells = 0
+        for key, rows in self._staged.items():
+            sheet, anchor = key.split('!')
+            for range_name, values in changed_ranges(anchor, self.snapshot.get(key, []), rows):
+                data.append({'range': absolute_range_name(self.title(int(sheet)), range_name), 'values': values})
+                cells += sum(len(row) for row in values)
+        if data:
+            self.spreadsheet.values_batch_update({'valueInputOption': 'RAW', 'data': data})
+        self.snapshot.update(self._staged)
+        self._staged = {}
+        if data:
+            self._save()
+        return cells
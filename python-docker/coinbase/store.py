@@ -0,0 +1,157 @@
+# Local SQLite store of Coinbase accounts, transactions and the buys and sells behind
+# them, so track.py only has to fetch what's new since its last run.
+#
+# Transactions are fetched oldest first and stored in that order (seq). The cursor
+# of an account is the newest transaction with nothing pending up to it. A sync asks
+# for the transactions after it, so transactions that were still pending are fetched
+# again until they settle (or are dropped, once a sync no longer lists them), and a
+# backfill that failed halfway picks up where it left off. Buys and sells are stored
+# by id, as they were last fetched. Past daily prices, which don't change, are kept
+# for history.py.
+#
+# Everything is stored as the JSON the API returned. One connection is shared by the
+# fetching threads, behind a lock.
+import json
+import os
+import sqlite3
+import threading
+
+PATH = os.environ.get('CB_STORE', './data/coinbase.sqlite3')
+
+# Statuses a transaction can still move on from
+PENDING = ('pending', 'waiting_for_signature', 'waiting_for_clearing')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS accounts (id TEXT PRIMARY KEY, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS transactions (
+    id TEXT PRIMARY KEY,
+    account_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    status TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS transactions_by_account ON transactions (account_id, seq);
+CREATE TABLE IF NOT EXISTS details (id TEXT PRIMARY KEY, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS daily_prices (symbol TEXT NOT NULL, day TEXT NOT NULL, price REAL,
+                                         PRIMARY KEY (symbol, day));
+'''
+
+
+def detail_id(transaction):
+    # Id of the buy or sell behind a transaction, None for other transactions
+    kind = transaction['type']
+    if kind in ('buy', 'sell'):
+        return transaction[kind]['id']
+    return None
+
+
+class Store(object):
+
+    def __init__(self, path=PATH):
+        if path != ':memory:' and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._db:
+            self._db.executescript(SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def save_accounts(self, accounts):
+        with self._lock, self._db:
+            self._db.executemany('INSERT OR REPLACE INTO accounts (id, data) VALUES (?, ?)',
+                                 [(account['id'], json.dumps(account)) for account in accounts])
+
+    def accounts(self):
+        with self._lock:
+            rows = self._db.execute('SELECT data FROM accounts ORDER BY rowid').fetchall()
+        return [json.loads(data) for data, in rows]
+
+    def cursor(self, account_id):
+        # Id of the transaction to fetch the account's transactions after, None to
+        # fetch them all
+        pending = ', '.join('?' * len(PENDING))
+        with self._lock:
+            row = self._db.execute(
+                'SELECT id FROM transactions WHERE account_id = ? AND seq < COALESCE('
+                '(SELECT MIN(seq) FROM transactions WHERE account_id = ? AND status IN (%s)), '
+                '(SELECT MAX(seq) + 1 FROM transactions WHERE account_id = ?)) '
+                'ORDER BY seq DESC LIMIT 1' % pending,
+                (account_id, account_id) + PENDING + (account_id,)).fetchone()
+        return row[0] if row else None
+
+    def add_transactions(self, account_id, transactions):
+        # Transactions, oldest first, after the account's cursor. Ones already stored
+        # are updated in place.
+        with self._lock, self._db:
+            seq = self._db.execute('SELECT COALESCE(MAX(seq), -1) FROM transactions WHERE account_id = ?',
+                                   (account_id,)).fetchone()[0]
+            for transaction in transactions:
+                seq += 1
+                self._db.execute(
+                    'INSERT INTO transactions (id, account_id, seq, status, data) VALUES (?, ?, ?, ?, ?) '
+                    'ON CONFLICT (id) DO UPDATE SET status = excluded.status, data = excluded.data',
+                    (transaction['id'], account_id, seq, transaction.get('status'), json.dumps(transaction)))
+
+    def prune_pending(self, account_id, cursor, fetched_ids):
+        # Drops the account's pending transactions after cursor that a sync from it
+        # didn't list again (cancelled ones, which the API forgets), so they neither
+        # hold the cursor back nor count as buys or sells
+        pending = ', '.join('?' * len(PENDING))
+        fetched_ids = set(fetched_ids)
+        with self._lock, self._db:
+            rows = self._db.execute(
+                'SELECT id FROM transactions WHERE account_id = ? AND status IN (%s) AND seq > COALESCE('
+                '(SELECT seq FROM transactions WHERE id = ?), -1)' % pending,
+                (account_id,) + PENDING + (cursor,)).fetchall()
+            gone = [(id_,) for id_, in rows if id_ not in fetched_ids]
+            self._db.executemany('DELETE FROM transactions WHERE id = ?', gone)
+        return len(gone)
+
+    def transactions(self, account_id):
+        # Newest first, as the API lists them
+        with self._lock:
+            rows = self._db.execute('SELECT data FROM transactions WHERE account_id = ? ORDER BY seq DESC',
+                                    (account_id,)).fetchall()
+        return [json.loads(data) for data, in rows]
+
+    def add_detail(self, detail):
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO details (id, data) VALUES (?, ?)',
+                             (detail['id'], json.dumps(detail)))
+
+    def details(self, ids):
+        # {id: buy or sell} of those of ids that are stored
+        ids = list(ids)
+        found = {}
+        with self._lock:
+            # SQLite allows 999 parameters per statement on older builds
+            for start in range(0, len(ids), 900):
+                chunk = ids[start:start + 900]
+                rows = self._db.execute('SELECT id, data FROM details WHERE id IN (%s)' % ', '.join('?' * len(chunk)),
+                                        chunk).fetchall()
+                found.update((id_, json.loads(data)) for id_, data in rows)
+        return found
+
+    def daily_prices(self, symbol, first, last):
+        # {'YYYY-MM-DD': USD price, None where there is none} of the days stored
+        # from first to last
+        with self._lock:
+            rows = self._db.execute('SELECT day, price FROM daily_prices WHERE symbol = ? AND day BETWEEN ? AND ?',
+                                    (symbol, first, last)).fetchall()
+        return dict(rows)
+
+    def last_daily_price(self, symbol, before):
+        # The USD price of the last day before before that has one, None if none does
+        with self._lock:
+            row = self._db.execute('SELECT price FROM daily_prices WHERE symbol = ? AND day < ? '
+                                   'AND price IS NOT NULL ORDER BY day DESC LIMIT 1', (symbol, before)).fetchone()
+        return row[0] if row else None
+
+    def add_daily_prices(self, symbol, prices):
+        # prices: [('YYYY-MM-DD', USD price or None)]
+        with self._lock, self._db:
+            self._db.executemany('INSERT OR REPLACE INTO daily_prices (symbol, day, price) VALUES (?, ?, ?)',
+                                 [(symbol, day, price) for day, price in prices])
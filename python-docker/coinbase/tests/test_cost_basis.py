@@ -0,0 +1,53 @@
+import math
+
+import pytest
+
+import cost_basis
+from benchmarks.order_basis import dict_basis, generate_orders, order_columns, order_dicts
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_average_matches_the_old_loop(seed):
+    rows = generate_orders(2000, 4, seed)
+    old = dict_basis(order_dicts(rows))
+    orders = order_columns(rows)
+    basis = cost_basis.cost_basis(orders, cost_basis.AVERAGE)
+
+    # The order sheet's order and each sale's original worth
+    new = [orders.row(index) for index in orders.by_time(orders.symbols)]
+    assert [(order['datetime'], order['symbol']) for order in new] == \
+        [(order['datetime'], order['symbol']) for order in old]
+    for old_order, new_order in zip(old, new):
+        if old_order['type'] == 'sell':
+            assert math.isclose(new_order['original_worth'], old_order['original_worth'], rel_tol=1e-12)
+
+    worth = {}
+    for order in old:
+        if order['type'] == 'sell':
+            worth[order['symbol']] = worth.get(order['symbol'], 0) + order['original_worth']
+    for index, symbol in enumerate(orders.symbols):
+        assert math.isclose(basis.sell_original_worth[index], worth.get(symbol, 0), rel_tol=1e-9, abs_tol=1e-9)
+
+
+def test_fifo_and_lifo_use_up_lots():
+    log = cost_basis.OrderLog()
+    log.add('BTC', True, '2021-01-01T00:00:00Z', 1.0, 101, 100, 1)
+    log.add('BTC', True, '2021-01-02T00:00:00Z', 1.0, 201, 200, 1)
+    log.add('BTC', False, '2021-01-03T00:00:00Z', -1.5, 449, 450, 1)
+    fifo = cost_basis.cost_basis(log.orders(), cost_basis.FIFO)
+    assert fifo.sell_original_worth == [200.0]
+    assert fifo.average_price == [200.0]
+    lifo = cost_basis.cost_basis(log.orders(), cost_basis.LIFO)
+    assert lifo.sell_original_worth == [250.0]
+    assert lifo.average_price == [100.0]
+
+
+def test_orders_of_nothing_are_left_out():
+    log = cost_basis.OrderLog()
+    log.add('BTC', True, '2021-01-01T00:00:00Z', 1.0, 101, 100, 1)
+    log.add('BTC', True, '2021-01-02T00:00:00Z', 0.0, 1, 0, 1)
+    orders = log.orders()
+    assert len(orders) == 1
+    basis = cost_basis.cost_basis(orders, cost_basis.AVERAGE)
+    assert basis.average_price == [100.0]
+    assert all(math.isfinite(price) for price in orders.spot_price)
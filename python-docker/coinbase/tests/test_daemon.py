@@ -0,0 +1,40 @@
+import warnings
+
+import pytest
+from coinbase.wallet.client import Client
+
+import daemon
+import offline
+import track
+from store import Store
+
+
+@pytest.fixture(scope='module')
+def coinbase():
+    with offline.FakeCoinbase(offline.generate_portfolio(60, 3)) as server:
+        yield server
+
+
+def test_history_failure_is_reported_apart(coinbase, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    spreadsheet = offline.FakeSpreadsheet()
+    posts = []
+
+    def fail(*args):
+        raise RuntimeError('history broke')
+
+    monkeypatch.setattr(track, 'read_cb_credentials', lambda filename: ('key', 'secret'))
+    monkeypatch.setattr(track, 'create_coinbase_client', lambda key, scrt: Client(key, scrt, coinbase.uri))
+    monkeypatch.setattr(track, 'connect_to_google_ss', lambda filename, name: spreadsheet)
+    monkeypatch.setattr(track, 'read_discord_urls', lambda filename: ['url'])
+    monkeypatch.setattr(track, 'post_to_discord', lambda urls, message: posts.append(message))
+    monkeypatch.setattr(track, 'update_history', fail)
+    monkeypatch.setattr(daemon, 'Store', lambda: Store(':memory:'))
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        run = daemon.Tracker().run()
+    assert run['ok']
+    assert run['history_error'] == repr(RuntimeError('history broke'))
+    assert run['cells_written'] > 0
+    assert run['discord_posted'] and len(posts) == 1
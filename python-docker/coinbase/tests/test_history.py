@@ -0,0 +1,14 @@
+import history
+
+
+class FailingPrices(object):
+
+    def prices(self, symbol, first, last):
+        raise ConnectionError('no route to Coinbase')
+
+
+def test_prefetch_leaves_failed_lookups_to_update(tmp_path, capsys):
+    portfolio_history = history.History(str(tmp_path / 'history'))
+    history.prefetch(portfolio_history, FailingPrices(), 'BTC', '2021-01-01T00:00:00Z',
+                     until=history.day_number('2021-01-05'))
+    assert 'Looking up past prices of BTC failed' in capsys.readouterr().out
@@ -0,0 +1,60 @@
+import functools
+import warnings
+
+import pytest
+
+import fetch
+import offline
+import portfolios
+import track
+
+
+@pytest.fixture(scope='module')
+def coinbase():
+    with offline.FakeCoinbase(offline.generate_portfolio(60, 3)) as server:
+        yield server
+
+
+def fan_out(tmp_path, entries, **kwargs):
+    spreadsheets = {}
+
+    def open_spreadsheet(name):
+        spreadsheets[name] = offline.FakeSpreadsheet(id=name)
+        return spreadsheets[name]
+
+    portfolio_list = [dict({'key': 'key', 'scrt': 'secret', 'spreadsheet': entry['name'], 'discord': [],
+                            'rate': 0, 'base_api_uri': None}, **entry) for entry in entries]
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        fan = portfolios.FanOut(portfolio_list, data=str(tmp_path / 'data'), open_spreadsheet=open_spreadsheet,
+                                **kwargs)
+        try:
+            return fan.run(), spreadsheets
+        finally:
+            fan.close()
+
+
+def test_history_failure_is_reported_apart(coinbase, tmp_path, monkeypatch):
+    def fail(*args):
+        raise RuntimeError('history broke')
+
+    monkeypatch.setattr(track, 'update_history', fail)
+    (run,), spreadsheets = fan_out(tmp_path, [{'name': 'only', 'base_api_uri': coinbase.uri}])
+    assert run['ok']
+    assert run['history_error'] == repr(RuntimeError('history broke'))
+    assert run['cells_written'] > 0
+    assert spreadsheets['only'].sheets[0].rows()
+
+
+def test_a_dead_portfolio_first_doesnt_hold_up_the_next(coinbase, tmp_path, monkeypatch):
+    # Nothing listens on port 9
+    monkeypatch.setattr(fetch, 'Fetcher', functools.partial(fetch.Fetcher, retries=1, backoff=0.01))
+    runs, spreadsheets = fan_out(tmp_path, [{'name': 'dead', 'base_api_uri': 'http://127.0.0.1:9/'},
+                                            {'name': 'good', 'base_api_uri': coinbase.uri}], concurrency=1)
+    dead, good = runs
+    assert not dead['ok']
+    assert good['ok'], good['error']
+    assert good['seconds'] < 5
+    # Every currency was priced
+    assert len(spreadsheets['good'].sheets[0].rows()) > 2
+    assert good['current_value'] > 0
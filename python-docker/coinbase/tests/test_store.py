@@ -0,0 +1,27 @@
+from store import Store
+
+
+def transaction(id_, status='completed'):
+    return {'id': id_, 'type': 'send', 'status': status}
+
+
+def test_pending_transaction_no_longer_listed_is_pruned():
+    store = Store(':memory:')
+    store.add_transactions('a', [transaction('1'), transaction('2', 'pending'), transaction('3')])
+    cursor = store.cursor('a')
+    assert cursor == '1'
+    # The sync from the cursor lists 3 again, but not the cancelled 2
+    store.add_transactions('a', [transaction('3')])
+    assert store.prune_pending('a', cursor, {'3'}) == 1
+    assert [stored['id'] for stored in store.transactions('a')] == ['3', '1']
+    assert store.cursor('a') == '3'
+
+
+def test_pending_transaction_still_listed_is_kept():
+    store = Store(':memory:')
+    store.add_transactions('a', [transaction('1', 'pending')])
+    cursor = store.cursor('a')
+    store.add_transactions('a', [transaction('1', 'pending')])
+    assert store.prune_pending('a', cursor, {'1'}) == 0
+    assert [stored['id'] for stored in store.transactions('a')] == ['1']
+    assert store.cursor('a') is None
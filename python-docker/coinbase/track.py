@@ -5,197 +5,186 @@ from coinbase.wallet.client import Client
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
 import json
+import traceback
+
+import fetch
+import history
+import pipeline
+from cost_basis import OrderLog, cost_basis
+from history import DailyPrices, History
+from prices import CoinbaseRates, PriceCache
+from sheets import SheetSink
+from store import Store
 
-# Opening JSON file
-cb_file = open('./credentials/cb_credentials.json')
-  
-# returns JSON object as 
-# a dictionary
-cb_credentials = json.load(cb_file)
 # CREDENTIALS
-key = cb_credentials['key']
-scrt = cb_credentials['scrt']
+CB_CREDS = './credentials/cb_credentials.json'
 GOOGLE_CREDS = './credentials/g_credentials.json'
+DISCORD_WEBHOOKS = './credentials/discord_webhooks.json'
+SPREADSHEET = "Coinbase Portfolio"
 
 # ALL FUNCTIONS
-def create_coinbase_client(key,scrt):
+def read_cb_credentials(cb_creds_filename):
+    # Opening JSON file, returns (key, secret)
+    with open(cb_creds_filename) as cb_file:
+        cb_credentials = json.load(cb_file)
+    return cb_credentials['key'], cb_credentials['scrt']
+
+def create_coinbase_client(key,scrt,base_api_uri=None):
     print("1. Connecting to Coinbase...")
     try:
-        client = Client(key, scrt)
+        # base_api_uri None is the real API, see offline.py for another
+        client = Client(key, scrt, base_api_uri)
         client.get_accounts()
         return client
     except:
         raise Exception("Failed to connect to client. Please make sure key"\
                         " and secret are correct.")
 
-def pull_cb_account_info(client):
-    list_of_accounts = client.get_accounts()['data']
-
+def list_accounts(fetcher, transaction_store):
+    # Every account that isn't a USD account, page by page, the API lists 25 at a
+    # time by default
+    for page in fetcher.pages('accounts', fetcher.client.get_accounts):
+        transaction_store.save_accounts(page)
+        for account in page:
+            if not ((account['currency'] == 'USD')
+                    | (float(account['balance']['amount']) == 0)):
+                yield account
+
+def enrich_accounts(fetched_accounts, price_cache, order_log):
+    # (index, currency_dict, datetime of the first order) per fetched account, as
+    # they come; their orders go into order_log
+    for index, account, fetched in fetched_accounts:
+        if isinstance(fetched, Exception):
+            print("   Skipping %s, fetching it failed: %r"
+                  % (account['balance']['currency'], fetched))
+            continue
+        # One bulk lookup for all of them, kept for a while
+        current_price = price_cache.price(account['balance']['currency'])
+        if current_price is None:
+            print("   Skipping %s, it has no price"
+                  % account['balance']['currency'])
+            continue
+
+        # Get current amount of currency and your totals
+        currency_name = account['balance']['currency']
+        current_quantity = float(account['balance']['amount'])
+        current_total = float(account['native_balance']['amount'])
+
+        currency_dict = {
+            'symbol': currency_name,
+            'quantity': current_quantity,
+            'current_price': current_price,
+            'current_total': current_total,
+            'average_price': 0,
+            'original_worth': 0,
+            'sell_original_worth': 0,
+            'realized_gain_loss': 0,
+            'unrealized_gain_loss': 0,
+            'current_performance': 0,
+            'realized_gain_performance': 0,
+            'all_time_invested': 0,
+            'all_time_costs': 0,
+            'all_time_fees': 0
+        }
+        first_order = None
+
+        order_log.currency_index(currency_name)
+
+        # Go over the transactions, with the buy or sell behind each
+        for transaction, detail in zip(fetched['transactions'],
+                                       fetched['details']):
+            # For buys
+            if transaction['type'] == 'buy':
+                # Get currency amount, date transacted
+                amount = float(transaction['amount']['amount'])
+                datetime = transaction['created_at']
+
+                # Get buy price and fee
+                buy_cost = float(detail['total']['amount'])
+                buy_subtotal = float(detail['subtotal']['amount'])
+                total_fee = 0
+                for fee in detail['fees']:
+                    total_fee += float(fee['amount']['amount'])
+
+                order_log.add(currency_name, True, datetime, amount,
+                              buy_cost, buy_subtotal, total_fee)
+                currency_dict['all_time_invested'] += buy_subtotal
+                currency_dict['all_time_costs'] += buy_cost
+                currency_dict['all_time_fees'] += total_fee
+                first_order = datetime
+
+            elif transaction['type'] == 'sell':
+                # Get currency amount, date transacted
+                amount = float(transaction['amount']['amount'])
+                datetime = transaction['created_at']
+
+                # Get sell price and fee
+                sell_earned = float(detail['total']['amount'])
+                sell_total = float(detail['subtotal']['amount'])
+                total_fee = 0
+                for fee in detail['fees']:
+                    total_fee += float(fee['amount']['amount'])
+
+                order_log.add(currency_name, False, datetime, amount,
+                              sell_earned, sell_total, total_fee)
+                currency_dict['all_time_fees'] += total_fee
+                first_order = datetime
+
+        yield index, currency_dict, first_order
+
+def pull_cb_account_info(fetcher, transaction_store, price_cache, on_currency=None):
     my_coinbase = {'current_value': 0,
                    'current_unrealized_gain': 0,
                    'current_performance': 0,
                    'currencies': []}
 
     print("2. Gathering Coinbase account information...")
-    # Iterate over each account that isn't a USD account
-    for account in list_of_accounts:
+    # Accounts are listed, fetched and gone over at the same time, each handed on
+    # as soon as it's ready. on_currency(symbol, datetime of its first order) is
+    # called for every currency as it comes.
+    order_log = OrderLog()
+    accounts = pipeline.stage('accounts', list_accounts(fetcher, transaction_store))
+    fetched_accounts = pipeline.stage('transactions', fetcher.stream_accounts(accounts, transaction_store))
+    currencies = []
+    for index, currency_dict, first_order in pipeline.stage(
+            'orders', enrich_accounts(fetched_accounts, price_cache, order_log)):
+        currencies.append((index, currency_dict))
+        if on_currency is not None:
+            on_currency(currency_dict['symbol'], first_order)
+    # In the order the accounts are listed
+    my_coinbase['currencies'] = [currency_dict for index, currency_dict in sorted(currencies, key=lambda k: k[0])]
+
+    print("   " + fetcher.stats.summary())
+
+    # Average buy price, realized gains and what each sale was worth when bought,
+    # for every currency at once
+    orders = order_log.orders()
+    basis = cost_basis(orders)
+    for currency_dict in my_coinbase['currencies']:
+        index = order_log.currency_index(currency_dict['symbol'])
         try:
-            if (account['currency'] == 'USD')\
-            | (float(account['balance']['amount']) == 0):
-                pass
-            else:
-                # Get current amount of currency and your totals
-                currency_name = account['balance']['currency']
-                current_quantity = float(account['balance']['amount'])
-                current_total = float(account['native_balance']['amount'])
-                current_price = float(client.get_spot_price(currency_pair
-                                                      = currency_name +
-                                                      '-USD')['amount'])
-
-                currency_dict = {
-                    'symbol': currency_name,
-                    'quantity': current_quantity,
-                    'current_price': current_price,
-                    'current_total': current_total,
-                    'average_price': 0,
-                    'original_worth': 0,
-                    'sell_original_worth': 0,
-                    'realized_gain_loss': 0,
-                    'unrealized_gain_loss': 0,
-                    'current_performance': 0,
-                    'realized_gain_performance': 0,
-                    'all_time_invested': 0,
-                    'all_time_costs': 0,
-                    'all_time_fees': 0,
-                    'orders': []
-                }
-
-                my_coinbase['currencies'].append(currency_dict)
-
-                # Get list of transactions
-                for transaction in account.get_transactions()['data']:
-                    # For buys
-                    if transaction['type'] == 'buy':
-                        # Get currency name, currency amount, date transacted
-                        symbol = transaction['amount']['currency']
-                        amount = float(transaction['amount']['amount'])
-                        datetime = transaction['created_at']
-
-                        # Get buy price and fee
-                        buy = account.get_buy(transaction['buy']['id'])
-                        buy_cost = float(buy['total']['amount'])
-                        buy_subtotal = float(buy['subtotal']['amount'])
-                        total_fee = 0
-                        for fee in buy['fees']:
-                            total_fee += float(fee['amount']['amount'])
-
-                        order_dict = {
-                            'type': 'buy',
-                            'datetime': datetime,
-                            'symbol': symbol,
-                            'amount': amount,
-                            'cost': buy_cost,
-                            'invested': buy_subtotal,
-                            'spot_price': buy_subtotal/amount,
-                            'total_fee': total_fee
-                        }
-
-                        currency_dict['all_time_invested'] += buy_subtotal
-                        currency_dict['all_time_costs'] += buy_cost
-                        currency_dict['all_time_fees'] += total_fee
-                        currency_dict['orders'].append(order_dict)
-
-                    elif transaction['type'] == 'sell':
-                        # Get currency name, currency amount, date transacted
-                        symbol = transaction['amount']['currency']
-                        amount = float(transaction['amount']['amount'])
-                        datetime = transaction['created_at']
-
-                        # Get buy price and fee
-                        sell = account.get_sell(transaction['sell']['id'])
-                        sell_earned = float(sell['total']['amount'])
-                        sell_total = float(sell['subtotal']['amount'])
-                        total_fee = 0
-                        for fee in sell['fees']:
-                            total_fee += float(fee['amount']['amount'])
-                        order_dict = {
-                            'type': 'sell',
-                            'datetime': datetime,
-                            'symbol': symbol,
-                            'amount': amount,
-                            'earned': sell_earned,
-                            'sell_total': sell_total,
-                            'spot_price': -sell_total/amount,
-                            'total_fee': total_fee
-                        }
-
-                        currency_dict['all_time_fees'] += total_fee
-                        currency_dict['orders'].append(order_dict)
-
-                # sort all orders by date
-                currency_dict['orders'] = sorted(currency_dict['orders'],
-                                                 key = lambda k:k['datetime'],
-                                                 reverse=False)
-
-                # Store running quantity of currency
-                total_currency_quantity = 0
-                # Store weighted average price of currency
-                weighted_currency_price = 0
-
-                # Store total invested
-                total_invested = 0
-
-                for order in currency_dict['orders']:
-                    if order['type'] == 'buy':
-                        # calculate current quantity and weighted avg price
-                        num = ((total_currency_quantity * weighted_currency_price)
-                               + (order['amount'] * order['spot_price']))
-                        den = (total_currency_quantity + order['amount'])
-                        weighted_currency_price = float(num/den)
-                        total_currency_quantity += order['amount']
-
-                        order['original_worth'] = 'N/A'
-
-                    elif order['type'] == 'sell':
-                        # calculate realized gain/loss on sale
-                        # use average buy price to calculate sale return
-                        investment_value = ((-order['amount'])
-                                            *weighted_currency_price)
-
-                        # save original worth of the sale quantity
-                        # i.e. amount * avg buy price up until now
-                        order['original_worth'] = (-(order['amount']
-                                                     *weighted_currency_price))
-                        currency_dict['sell_original_worth'] += order['original_worth']
-                        currency_dict['realized_gain_loss'] += ((order['sell_total'])
-                                                                - (investment_value))
-
-                        # subtract quantity sold from existing amount
-                        total_currency_quantity += order['amount']
-                        if total_currency_quantity == 0:
-                            weighted_currency_price = 0
-                        else:
-                            pass
-
-                    else:
-                        pass
-                currency_dict['average_price'] = weighted_currency_price
-                currency_dict['original_worth'] = (currency_dict['quantity']
-                                                   *weighted_currency_price)
-                currency_dict['unrealized_gain_loss'] = (currency_dict['current_total']
-                                                         - currency_dict['original_worth'])
-                currency_dict['current_performance'] = (currency_dict['unrealized_gain_loss']
-                                                        /currency_dict['original_worth'])
-                # Calculate realized gain performance if something has been sold
-                if currency_dict['realized_gain_loss'] != 0:
-                    currency_dict['realized_gain_performance'] = (currency_dict['realized_gain_loss']
-                                                                  /currency_dict['sell_original_worth'])
-
-                # Add in currency totals to full account dictionary
-                my_coinbase['current_value'] += currency_dict['current_total']
-                my_coinbase['current_unrealized_gain'] += currency_dict['unrealized_gain_loss']
-
-        except:
+            currency_dict['sell_original_worth'] = basis.sell_original_worth[index]
+            currency_dict['realized_gain_loss'] = basis.realized_gain_loss[index]
+            currency_dict['average_price'] = basis.average_price[index]
+            currency_dict['original_worth'] = (currency_dict['quantity']
+                                               *currency_dict['average_price'])
+            currency_dict['unrealized_gain_loss'] = (currency_dict['current_total']
+                                                     - currency_dict['original_worth'])
+            currency_dict['current_performance'] = (currency_dict['unrealized_gain_loss']
+                                                    /currency_dict['original_worth'])
+            # Calculate realized gain performance if something has been sold
+            if currency_dict['realized_gain_loss'] != 0:
+                currency_dict['realized_gain_performance'] = (currency_dict['realized_gain_loss']
+                                                              /currency_dict['sell_original_worth'])
+
+            # Add in currency totals to full account dictionary
+            my_coinbase['current_value'] += currency_dict['current_total']
+            my_coinbase['current_unrealized_gain'] += currency_dict['unrealized_gain_loss']
+
+        except ZeroDivisionError:
+            # Nothing bought (all of it received, say), so no original worth to
+            # measure performance against. The currency stays listed but isn't
+            # counted in the totals, as before.
             pass
 
     my_coinbase['current_performance'] = (my_coinbase['current_unrealized_gain']
@@ -205,12 +194,14 @@ def pull_cb_account_info(client):
     my_coinbase['currencies'] = sorted(my_coinbase['currencies'],
                                        key = lambda k:float(k['current_total']),
                                        reverse=True)
+    # All orders, by date, and by the order of the currencies where dates tie
+    my_coinbase['orders'] = orders
+    my_coinbase['order_rows'] = orders.by_time([currency['symbol'] for currency
+                                                in my_coinbase['currencies']])
     print("\n=====Coinbase account information gathered=====\n")
     return my_coinbase
 
-def connect_to_google_ss(google_creds_filename, ss_name):
-    print("3. Connecting to Google Sheets...")
-
+def authorize_google(google_creds_filename):
     scope = ['https://spreadsheets.google.com/feeds',
              'https://www.googleapis.com/auth/drive']
 
@@ -218,243 +209,226 @@ def connect_to_google_ss(google_creds_filename, ss_name):
                    .from_json_keyfile_name(google_creds_filename,
                                            scope)
                   )
-    gc = gspread.authorize(credentials)
+    return gspread.authorize(credentials)
+
+def connect_to_google_ss(google_creds_filename, ss_name):
+    print("3. Connecting to Google Sheets...")
+    gc = authorize_google(google_creds_filename)
     spreadsheet = gc.open(ss_name)
     return spreadsheet
 
-def generate_portfolio_overview(mycoinbase,spreadsheet):
+def generate_portfolio_overview(my_coinbase,sheet_sink):
     # Fill first worksheet
-    # open portfolio overview worksheet from file
-    wks1 = spreadsheet.get_worksheet(0)
-
     # ADD PORTFOLIO OVERVIEW DETAILS INTO SPREADSHEET
-    currency_count = len(my_coinbase['currencies'])
-
-    currency_cell_list = wks1.range('B3:G' + str(2 + currency_count))
-    # Iterate over each currency
-    for idx, currency in enumerate(my_coinbase['currencies']):
-        cell = 0 + (idx*6)
-        wks_row_num = str(3 + idx)
-        # Symbols
-        currency_cell_list[cell].value = currency['symbol']
-        cell += 1
-        # Current Price
-        currency_cell_list[cell].value = currency['current_price']
-        cell += 1
-        # Current Quantity
-        currency_cell_list[cell].value = currency['quantity']
-        cell += 1
-        # Current Total
-        currency_cell_list[cell].value = currency['current_total']
-        cell += 1
-        # Unrealized Gain/Loss
-        currency_cell_list[cell].value = currency['unrealized_gain_loss']
-        cell += 1
-        # Portfolio performance
-        currency_cell_list[cell].value = currency['current_performance']
-        cell += 1
-
-    print("4. Writing information to sheet 1...")
-    # Update spreadsheet with currency overview
-    wks1.update_cells(currency_cell_list)
+    print("4. Preparing sheet 1...")
+    currency_rows = []
+    # One row per currency
+    for currency in my_coinbase['currencies']:
+        currency_rows.append([
+            # Symbols
+            currency['symbol'],
+            # Current Price
+            currency['current_price'],
+            # Current Quantity
+            currency['quantity'],
+            # Current Total
+            currency['current_total'],
+            # Unrealized Gain/Loss
+            currency['unrealized_gain_loss'],
+            # Portfolio performance
+            currency['current_performance'],
+        ])
+    # Currency overview from B3 down
+    sheet_sink.stage(0, 'B3', currency_rows)
 
     # Include Totals
-    # final_row = currency_count + 3
-    totals_cell_list = wks1.range('I3:K3')
-    # Set cell values with totals
-    # totals_cell_list[0].value = 'Total'
-    totals_cell_list[0].value = my_coinbase['current_value']
-    totals_cell_list[1].value = my_coinbase['current_unrealized_gain']
-    totals_cell_list[2].value = my_coinbase['current_performance']
-
-    # Update spreadsheet with totals
-    wks1.update_cells(totals_cell_list)
-
-def generate_wallet_details(my_coinbase,spreadsheet):
-    # Fill second worksheet
-    # open currency details worksheet from file
-    wks2 = spreadsheet.get_worksheet(1)
+    sheet_sink.stage(0, 'I3', [[my_coinbase['current_value'],
+                                my_coinbase['current_unrealized_gain'],
+                                my_coinbase['current_performance']]])
 
+def generate_wallet_details(my_coinbase,sheet_sink):
+    # Fill second worksheet
     # ADD CURRENCY OVERVIEW DETAILS INTO SPREADSHEET
-    currency_count = len(my_coinbase['currencies'])
-    currency_cell_list = wks2.range('B3:M' + str(2 + currency_count))
-    # Iterate over each currency
-    for idx, currency in enumerate(my_coinbase['currencies']):
-        cell = 0 + (idx*12)
-        wks_row_num = str(3 + idx)
-        # Symbols
-        currency_cell_list[cell].value = currency['symbol']
-        cell += 1
-        # Current Price
-        currency_cell_list[cell].value = currency['current_price']
-        cell += 1
-        # Current Quantity
-        currency_cell_list[cell].value = currency['quantity']
-        cell += 1
-        # Average Buy Price
-        currency_cell_list[cell].value = currency['average_price']
-        cell += 1
-        # Original worth of current quantity
-        currency_cell_list[cell].value = currency['original_worth']
-        cell += 1
-        # Current Total
-        currency_cell_list[cell].value = currency['current_total']
-        cell += 1
-        # Unrealized Gain/Loss
-        currency_cell_list[cell].value = currency['unrealized_gain_loss']
-        cell += 1
-        # Portfolio performance
-        currency_cell_list[cell].value = currency['current_performance']
-        cell += 1
-        # Realized Gain
-        currency_cell_list[cell].value = currency['realized_gain_loss']
-        cell += 1
-        # Historical Cost
-        currency_cell_list[cell].value = currency['all_time_costs']
-        cell += 1
-        # Historical Fees
-        currency_cell_list[cell].value = currency['all_time_fees']
-        cell += 1
-        # Historical Investment
-        currency_cell_list[cell].value = currency['all_time_invested']
-
-    print("5. Writing information to sheet 2...")
-    # Update spreadsheet with currency overview
-    wks2.update_cells(currency_cell_list)
-
-def generate_order_details(my_coinbase,spreadsheet):
-    # ADD ORDERS INTO SPREADSHEET
-    # Get all orders sorted by date
-    all_orders = []
-
+    print("5. Preparing sheet 2...")
+    currency_rows = []
+    # One row per currency
     for currency in my_coinbase['currencies']:
-        all_orders.extend(currency['orders'])
-
-    all_orders = sorted(all_orders, key = lambda k:k['datetime'])
-
-    # open orders worksheet from file
-    wks3 = spreadsheet.get_worksheet(2)
-
-    order_count = len(all_orders)
-    order_cell_list = wks3.range('B3:K' + str(2 + order_count))
-    for idx, order in enumerate(all_orders):
-        cell = 0 + (idx*10)
-        wks_row_num = str(3 + idx)
-        # Date
-        order_cell_list[cell].value = order['datetime'].split('T')[0]
-        cell += 1
-        # Order Type
-        order_cell_list[cell].value = order['type']
-        cell += 1
-        # Symbol
-        order_cell_list[cell].value = order['symbol']
-        cell += 1
-        # Price
-        order_cell_list[cell].value = order['spot_price']
-        cell += 1
-        # Amount
-        order_cell_list[cell].value = order['amount']
-        cell += 1
-        # Cost
+        currency_rows.append([
+            # Symbols
+            currency['symbol'],
+            # Current Price
+            currency['current_price'],
+            # Current Quantity
+            currency['quantity'],
+            # Average Buy Price
+            currency['average_price'],
+            # Original worth of current quantity
+            currency['original_worth'],
+            # Current Total
+            currency['current_total'],
+            # Unrealized Gain/Loss
+            currency['unrealized_gain_loss'],
+            # Portfolio performance
+            currency['current_performance'],
+            # Realized Gain
+            currency['realized_gain_loss'],
+            # Historical Cost
+            currency['all_time_costs'],
+            # Historical Fees
+            currency['all_time_fees'],
+            # Historical Investment
+            currency['all_time_invested'],
+        ])
+    # Currency details from B3 down
+    sheet_sink.stage(1, 'B3', currency_rows)
+
+def generate_order_details(my_coinbase,sheet_sink):
+    # ADD ORDERS INTO SPREADSHEET
+    print("6. Preparing sheet 3...")
+    # Get all orders sorted by date, one at a time
+    orders = my_coinbase['orders']
+    order_rows = []
+    for index in my_coinbase['order_rows']:
+        order = orders.row(index)
+        order_row = [
+            # Date
+            order['datetime'].split('T')[0],
+            # Order Type
+            order['type'],
+            # Symbol
+            order['symbol'],
+            # Price
+            order['spot_price'],
+            # Amount
+            order['amount'],
+        ]
+        # Cost, Fee, Price & for sales: original worth, net profit
         if order['type'] == 'buy':
-            order_cell_list[cell].value = order['cost']
+            order_row += [order['cost'], order['total_fee'],
+                          order['invested'], 'N/A', 'N/A']
         else:
-            order_cell_list[cell].value = order['sell_total']
-        cell += 1
-        # Fee
-        order_cell_list[cell].value = order['total_fee']
-        cell += 1
-        # Price & for sales: original worth, net profit
-        if order['type'] == 'buy':
-            order_cell_list[cell].value = order['invested']
-            cell += 1
-            order_cell_list[cell].value = 'N/A'
-            cell += 1
-            order_cell_list[cell].value = 'N/A'
-            cell += 1
+            order_row += [order['sell_total'], order['total_fee'],
+                          order['earned'],
+                          # Original Worth
+                          order['original_worth'],
+                          # Net Profit
+                          order['earned'] - order['original_worth']]
+        order_rows.append(order_row)
+    # Orders from B3 down; new ones end up at the bottom, so only they are sent
+    sheet_sink.stage(2, 'B3', order_rows)
+
+def write_sheets(my_coinbase, sheet_sink):
+    # Filling out first sheet, portfolio overview
+    generate_portfolio_overview(my_coinbase, sheet_sink)
+    # Filling out second sheet, wallet details
+    generate_wallet_details(my_coinbase, sheet_sink)
+    # Filling out third sheet, order details
+    generate_order_details(my_coinbase, sheet_sink)
+    # Writes only what changed since the last run, all sheets at once
+    print("7. Writing changed cells to the sheets...")
+    cells = sheet_sink.flush()
+    print("   %d cells written" % cells)
+    return cells
+
+def update_history(my_coinbase, portfolio_history, daily_prices):
+    # Adds the days since the last run to the daily value history
+    print("8. Updating portfolio history...")
+    days = history.update(portfolio_history, my_coinbase['orders'], daily_prices)
+    print("   %d new days, %d rows" % (days, len(portfolio_history)))
+    return days
+
+def read_discord_urls(discord_webhooks_filename):
+    print('Opening webhook urls json...')
+    # Opening JSON file
+    with open(discord_webhooks_filename) as webhook_url_json:
+        webhook_urls = json.load(webhook_url_json)
+    return webhook_urls['urls']
+
+def discord_message(my_coinbase):
+    gain_losses = my_coinbase['current_unrealized_gain']
+    gain_losses_int = int(gain_losses)
+    message_prefix = ''
+    if (gain_losses_int >= 0):
+        if (gain_losses_int > 2000):
+            message_prefix = 'OMFG...'
+        elif (gain_losses_int > 1000):
+            message_prefix = 'Im gonna be a milionare...'
+        elif (gain_losses_int > 500):
+            message_prefix = 'Oh yeah baby, drinks on me...'
+        elif (gain_losses_int > 100):
+            message_prefix = 'Hell yeah...'
         else:
-            order_cell_list[cell].value = order['earned']
-            cell += 1
-            # Original Worth
-            order_cell_list[cell].value = order['original_worth']
-            cell += 1
-            # Net Profit
-            order_cell_list[cell].value = (order['earned']
-                                           - order['original_worth'])
-
-    print("6. Writing information to sheet 3...")
-    # Update spreadsheet with orders
-    wks3.update_cells(order_cell_list)
-
-# FULL CODE
-# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-# Connect to coinbase and pull down all account info
-# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-# Creating client to connect to coinbase
-client = create_coinbase_client(key, scrt)
-# Getting coinbase account info
-my_coinbase = pull_cb_account_info(client)
-
-# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-# Connect to google spreadsheets and fill info
-# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-spreadsheet = connect_to_google_ss(GOOGLE_CREDS,"Coinbase Portfolio")
-# Filling out first sheet, portfolio overview
-generate_portfolio_overview(my_coinbase, spreadsheet)
-# Filling out second sheet, wallet details
-generate_wallet_details(my_coinbase, spreadsheet)
-# Filling out third sheet, order details
-generate_order_details(my_coinbase, spreadsheet)
-
-# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-# Displaying results to user
-# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-# Get spreadsheet url
-spreadsheet_url = "https://docs.google.com/spreadsheets/d/%s" % spreadsheet.id
-# Let user know process has been completed
-print("\n=====Process completed, worksheets filled=====\n"
-      "\nTo see results please visit:", spreadsheet_url)
-
-
-# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-# Post to discord
-# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-try:
-  print('Opening webhook urls json...')
-  # Opening JSON file
-  webhook_url_json = open('./credentials/discord_webhooks.json')
-  # returns JSON object as 
-  # a dictionary
-  webhook_urls = json.load(webhook_url_json)
-  # CREDENTIALS
-  urls = webhook_urls['urls']
-  gain_losses = my_coinbase['current_unrealized_gain']
-  gain_losses_int = int(gain_losses)
-  message_prefix = ''
-  message_content = ''
-  if (gain_losses_int >= 0):
-    if (gain_losses_int > 2000):
-        message_prefix = 'OMFG...'
-    elif (gain_losses_int > 1000):
-        message_prefix = 'Im gonna be a milionare...'
-    elif (gain_losses_int > 500):
-        message_prefix = 'Oh yeah baby, drinks on me...'
-    elif (gain_losses_int > 100):
-        message_prefix = 'Hell yeah...'
-    else:
-        message_prefix = 'Woohoo...'
-    message_content = "{} ${}".format(message_prefix, str(round(float(gain_losses), 2)))
-  else:
+            message_prefix = 'Woohoo...'
+        return "{} ${}".format(message_prefix, str(round(float(gain_losses), 2)))
     if (gain_losses_int < -1000):
         message_prefix = '@$#! CRYPTO...'
     elif (gain_losses_int < -100):
         message_prefix = 'This is BS...'
     else:
-        message_prefix = 'Shit...'  
-    message_content = "{} -${}".format(message_prefix, str(abs(round(float(gain_losses), 2))))
-  webhook = DiscordWebhook(url=urls, content=message_content)
-  print('Posting gains/losses to Discord...')
-  response = webhook.execute()
-  print('Discord post success!')
-except:
-  print('Something went wrong trying to post to discord!')
+        message_prefix = 'Shit...'
+    return "{} -${}".format(message_prefix, str(abs(round(float(gain_losses), 2))))
+
+def post_to_discord(urls, message_content):
+    webhook = DiscordWebhook(url=urls, content=message_content)
+    print('Posting gains/losses to Discord...')
+    response = webhook.execute()
+    print('Discord post success!')
+    return response
+
+def main():
+    # FULL CODE, one run; daemon.py keeps running it
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    # Connect to coinbase and pull down all account info
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    # Creating client to connect to coinbase
+    key, scrt = read_cb_credentials(CB_CREDS)
+    client = create_coinbase_client(key, scrt)
+    # Coinbase calls go through the fetcher, for retries
+    fetcher = fetch.Fetcher(client)
+    # Prices are looked up all at once and kept for a while
+    price_cache = PriceCache(CoinbaseRates(fetcher))
+    # Opening the local store of transactions fetched on earlier runs
+    transaction_store = Store()
+    # Past prices for the history are looked up as each currency comes in
+    portfolio_history = History()
+    daily_prices = DailyPrices(fetcher, transaction_store)
+    history_prices = pipeline.Worker('history prices', lambda item: history.prefetch(
+        portfolio_history, daily_prices, *item))
+    # Connecting to google spreadsheets while Coinbase is fetched
+    spreadsheet = pipeline.background('google', connect_to_google_ss, GOOGLE_CREDS, SPREADSHEET)
+    # Getting coinbase account info
+    my_coinbase = pull_cb_account_info(fetcher, transaction_store, price_cache,
+                                       lambda *item: history_prices.put(item))
+
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    # Fill info into google spreadsheets
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    spreadsheet = spreadsheet.result()
+    write_sheets(my_coinbase, SheetSink(spreadsheet))
+    history_prices.close()
+    # The sheets are written, so a history that can't be updated doesn't stop the rest
+    try:
+        update_history(my_coinbase, portfolio_history, daily_prices)
+    except:
+        print('Something went wrong trying to update the history!')
+        traceback.print_exc()
+
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    # Displaying results to user
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    # Get spreadsheet url
+    spreadsheet_url = "https://docs.google.com/spreadsheets/d/%s" % spreadsheet.id
+    # Let user know process has been completed
+    print("\n=====Process completed, worksheets filled=====\n"
+          "\nTo see results please visit:", spreadsheet_url)
+
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    # Post to discord
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    try:
+        post_to_discord(read_discord_urls(DISCORD_WEBHOOKS), discord_message(my_coinbase))
+    except:
+        print('Something went wrong trying to post to discord!')
+
+if __name__ == '__main__':
+    main()
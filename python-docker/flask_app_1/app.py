@@ -1,9 +1,21 @@
 # https://felipefaria.medium.com/running-a-simple-flask-application-inside-a-docker-container-b83bf3e07dd5
-from flask import Flask, request, jsonify, make_response
-from deepdiff import DeepDiff
-from re import search, split
+import time
+
+from flask import Flask, Response, g, request, jsonify, make_response, stream_with_context
+import baselines
+import cache
+import codec
+import compare
+import metrics
+import serving
+import spans
+import stream_compare
 
 app = Flask(__name__)
+app.json = codec.FastJSONProvider(app)
+app.wsgi_app = codec.DecompressRequestMiddleware(app.wsgi_app)
+result_cache = cache.from_env()
+baseline_store = baselines.from_env()
 
 def _build_cors_preflight_response():
     response = make_response()
@@ -14,8 +26,46 @@ def _build_cors_preflight_response():
 
 def _corsify_actual_response(response):
     response.headers.add("Access-Control-Allow-Origin", "*")
+    # Let browser clients read the ETag for If-None-Match
+    response.headers.add('Access-Control-Expose-Headers', "ETag")
     return response
 
+# Timing and metrics for the compare endpoints, see metrics.py
+_MEASURED = { '/compare': 'compare', '/compare/batch': 'batch', '/compare/stream': 'stream' }
+
+@app.before_request
+def start_spans():
+    if request.path in _MEASURED and request.method == 'POST':
+        g.spans = spans.Spans()
+        g.spans_token = spans.activate(g.spans)
+        g.started = time.perf_counter()
+
+# Registered before compress_response, so it runs after it and sees the final body.
+# A streamed body is timed until it has all been sent, and its size isn't known:
+# working it out would read the whole stream before the first byte went out.
+@app.after_request
+def observe_request(response):
+    if 'started' in g:
+        endpoint, status, started, request_spans = _MEASURED[request.path], response.status_code, g.started, g.spans
+        request_size = request.content_length
+        if response.is_streamed:
+            response.call_on_close(lambda: metrics.observe(endpoint, status, time.perf_counter() - started,
+                                                           request_size, None, request_spans))
+        else:
+            metrics.observe(endpoint, status, time.perf_counter() - started, request_size,
+                            response.calculate_content_length(), request_spans)
+    return response
+
+@app.teardown_request
+def stop_spans(exc):
+    if 'spans_token' in g:
+        spans.deactivate(g.pop('spans_token'))
+
+@app.after_request
+def compress_response(response):
+    with spans.stage('compress'):
+        return codec.compress_response(response, request.accept_encodings)
+
 @app.route('/')
 def hello_world():
     return 'Hey, we have Flask in a Docker container!'
@@ -25,324 +75,184 @@ def add_message():
     if request.method == "OPTIONS": # CORS preflight
         return _build_cors_preflight_response()
     elif request.method == "POST": # The actual request following the preflight
-        post_data = request.json
+        with spans.stage('parse'):
+            post_data = request.json
         
-        original_structure = post_data['original_structure']
         modified_structure = post_data['modified_structure']
+        # The original is either sent in full or a stored baseline revision, see baselines.py
+        if 'baseline_id' in post_data:
+            version = post_data.get('baseline_version')
+            with spans.stage('baseline'):
+                baseline = baseline_store.get(str(post_data['baseline_id']), None if version is None else str(version))
+            if baseline is None:
+                return _corsify_actual_response(make_response(jsonify({ 'error': 'Unknown baseline {}'.format(post_data['baseline_id']) }), 404))
+            original_structure = baseline.structure
+            original_digest = baseline.digest
+        else:
+            baseline = None
+            original_structure = post_data['original_structure']
+            with spans.stage('digest'):
+                original_digest = cache.structure_digest(original_structure)
 
-        # Skip over changes in FIELD UUID { fields: 0: { uuid: 123-6543-2332 } } --- root['fields']['0']['uuid']
-        field_uuid_pattern = '^root\[\'fields\'\]\[\'(\d+)\'\]\[\'uuid\'\]$'
-
-        def exclude_obj_callback(obj, path):
-            return True if search(field_uuid_pattern, path) else False
-
-        diff = DeepDiff(original_structure, modified_structure, view='tree', get_deep_distance=True, exclude_obj_callback=exclude_obj_callback)
-
-        distance = diff.get('deep_distance') or 0
-
-        field_changes = {}
-        form_changes = {}
-        removed_fields = []
-        added_fields = []
-
-        # Just get the changes from the diff object in a tree structure so we can traverse/manipulate it
-        dic_items_added = diff.get('dictionary_item_added') or []
-        dic_items_removed = diff.get('dictionary_item_removed') or []
-        dic_items_changed = diff.get('values_changed') or []
-        arr_items_added = diff.get('iterable_item_added') or []
-        arr_items_removed = diff.get('iterable_item_removed') or []
-        types_changed = diff.get('type_changes') or []
-
-        # path deconstructor pattern
-        path_deconstructor_pattern = r"[^a-zA-Z0-9-_]+"
+        try:
+            # Diff engine, see compare.ENGINES - lets callers A/B the field-aware engine
+            # changeDistance mode: exact, approximate or none, see distance.py
+            engine, distance_mode = compare.resolve_options(post_data.get('engine') or request.args.get('engine'),
+                                                            post_data.get('distance') or request.args.get('distance'))
+            # Rules lined up by position or by ruleId/content, see field_diff.RULE_ALIGNMENTS
+            rule_alignment = compare.resolve_rule_alignment(engine, post_data.get('rule_alignment') or request.args.get('rule_alignment'))
+            # Response format: changes (fieldChanges) or patch (JSON Patch), see patch.py
+            output_format, old_values = compare.resolve_format(post_data.get('format') or request.args.get('format'),
+                                                               post_data.get('old_values', request.args.get('old_values')))
+        except compare.CompareOptionError as e:
+            return _corsify_actual_response(make_response(jsonify({ 'error': str(e) }), 400))
 
-        # Patterns to match what changed
-        field_pattern = '^root\[\'fields\'\]\[\'(\d+)\'\]'
-        field_root_pattern = '^root\[\'fields\'\]\[\'(\d+)\'\]$'
-        field_setting_changed_pattern = '^root\[\'fields\'\]\[\'(\d+)\'\]\[\'([a-zA-Z0-9-_]+)\'\]$'
-        field_properties_changed_pattern = '^root\[\'fields\'\]\[\'(\d+)\'\]\[\'properties\'\]\[\'([a-z\-?\d?A-Z09]+)\'\]$'
-        field_rules_changed_pattern = '^root\[\'fields\'\]\[\'(\d+)\'\]\[\'rules\'\]\[(\d+)\]\[\'([a-zA-Z09]+)\'\]$'
-        field_rules_add_pattern = '^root\[\'fields\'\]\[\'(\d+)\'\]\[\'rules\'\]\[(\d+)\]$'
+        # The ETag is the cache key, so a client that already has this result gets a 304.
+        # It's weak because the body may be sent with different Content-Encodings.
+        with spans.stage('digest'):
+            etag = cache.cache_key(original_digest, cache.structure_digest(modified_structure), engine, distance_mode,
+                                   rule_alignment, output_format, old_values)
+        spans.tag('engine', engine)
+        spans.tag('distance', distance_mode)
+        spans.tag('rule_alignment', rule_alignment)
+        spans.tag('format', output_format)
+        if request.if_none_match.contains_weak(etag):
+            spans.tag('cache', 'not_modified')
+            response = make_response('', 304)
+            response.set_etag(etag, weak=True)
+            return _corsify_actual_response(response)
 
-        # if its not in the original structure, its in the modified one
-        def getField(f_index):
+        with spans.stage('cache'):
+            body = result_cache.get(etag) if result_cache else None
+        if result_cache:
+            spans.tag('cache', 'miss' if body is None else 'hit')
+        if body is None:
+            # The diff runs on serving's process pool, see serving.py
             try:
-                return original_structure['fields'][f_index]
-            except:
-                return modified_structure['fields'][f_index]
-
-
-        def populate_field_changes_object(f_index):
-            field = getField(f_index)
-            field_changes[f_index] = {
-                'name': field.get('name'),
-                'fieldType': field.get('fieldType'),
-                'index': f_index,
-                'fieldId': field.get('fieldId')
-            }
+                body = serving.compare_body(baseline, original_structure, modified_structure, engine, distance_mode,
+                                            rule_alignment, output_format, old_values)
+            except serving.Saturated as e:
+                response = make_response(jsonify({ 'error': str(e) }), 503)
+                response.headers['Retry-After'] = '1'
+                return _corsify_actual_response(response)
+            except serving.DiffTimeout as e:
+                return _corsify_actual_response(make_response(jsonify({ 'error': str(e) }), 504))
+            except serving.BaselineGone as e:
+                return _corsify_actual_response(make_response(jsonify({ 'error': str(e) }), 404))
+            if result_cache:
+                with spans.stage('cache'):
+                    result_cache.set(etag, body)
+        response = app.response_class(body, mimetype=app.json.mimetype)
+        response.set_etag(etag, weak=True)
+        return _corsify_actual_response(response)
+    else:
+        raise RuntimeError("Weird - don't know how to handle method {}".format(request.method))
 
-        def getRule(r_index, f_index):
-            field = getField(f_index)
-            rule_index = int(r_index)
-            return field['rules'][rule_index]
+@app.route('/compare/batch', methods=["POST", "OPTIONS"])
+def compare_batch():
+    if request.method == "OPTIONS": # CORS preflight
+        return _build_cors_preflight_response()
+    # { pairs: [{ id?, original_structure, modified_structure, engine?, distance?, rule_alignment?, format?, old_values? }],
+    #   engine?, distance?, rule_alignment?, format?, old_values? }
+    post_data = request.json
+    pairs = post_data.get('pairs') if isinstance(post_data, dict) else None
+    if not isinstance(pairs, list):
+        return _corsify_actual_response(make_response(jsonify({ 'error': 'Expected a list of pairs' }), 400))
+    engine = post_data.get('engine') or request.args.get('engine')
+    distance_mode = post_data.get('distance') or request.args.get('distance')
+    rule_alignment = post_data.get('rule_alignment') or request.args.get('rule_alignment')
+    output_format = post_data.get('format') or request.args.get('format')
+    old_values = post_data.get('old_values', request.args.get('old_values'))
+    try:
+        compare.resolve_rule_alignment(compare.resolve_options(engine, distance_mode)[0], rule_alignment)
+        compare.resolve_format(output_format, old_values)
+    except compare.CompareOptionError as e:
+        return _corsify_actual_response(make_response(jsonify({ 'error': str(e) }), 400))
 
-        # Added iterable Items
-        for arr_add in arr_items_added:
-            path = arr_add.path()
-            # Check if it's a form field value
-            field_match = search(field_pattern, path)
-            if (field_match):
-                # Get the field index
-                field_index = field_match.group(1)
-                # Populate some useful field info into field_changes object
-                if field_index not in field_changes:
-                    populate_field_changes_object(field_index)
-                field_rules_add_match = search(field_rules_add_pattern, path)
-                if (field_rules_add_match):
-                    # Add a addedRules arr if the field does not have it
-                    if ('addedRules' not in field_changes[field_index]):
-                        field_changes[field_index]['addedRules'] = []
-                    # Get the rule details
-                    rule_index = field_rules_add_match.group(2)
-                    field_changes[field_index]['addedRules'].append({ 'ruleIndex': rule_index, 'rule': arr_add.t2 })
-                else:
-                    # Not a rule? Add it to 'iterableAdded'
-                    if ('iterableAdded' not in field_changes[field_index]):
-                        field_changes[field_index]['iterableAdded'] = []
-                    # No match we found in field setting, field properties, field rules - return to the client the full path
-                    path_split = split(path_deconstructor_pattern, path)
-                    path_arr = path_split[1:-1]
-                    field_changes[field_index]['iterableAdded'].append({ 'propertyName': path, 'value': arr_add.t2, 'action': 'ADDED', 'pathArray': path_arr })
-            else:
-                # This is a form setting
-                if ('iterableAdded' not in form_changes):
-                    form_changes['iterableAdded'] = []
-                path_split = split(path_deconstructor_pattern, path)
-                path_arr = path_split[1:-1]
-                form_changes['iterableAdded'].append({ 'propertyName': path, 'value': arr_add.t2, 'pathArray': path_arr })
+    # One JSON result per line, in the order the pairs finish. The pairs count against
+    # the cap on diffs in flight, see serving.py
+    def generate():
+        for result in serving.run_batch(pairs, engine, distance_mode, rule_alignment, output_format, old_values):
+            yield app.json.dumps(result) + '\n'
 
-        # Removed iterable Items
-        for arr_remove in arr_items_removed:
-            path = arr_remove.path()
-            # Check if it's a form field value
-            field_match = search(field_pattern, path)
-            if (field_match):
-                # Get the field index
-                field_index = field_match.group(1)
-                # Populate some useful field info into field_changes object
-                if field_index not in field_changes:
-                    populate_field_changes_object(field_index)
-                field_rules_add_match = search(field_rules_add_pattern, path)
-                if (field_rules_add_match):
-                    # Add a removedRules arr if the field does not have it
-                    if ('removedRules' not in field_changes[field_index]):
-                        field_changes[field_index]['removedRules'] = []
-                    # Get the rule details
-                    rule_index = field_rules_add_match.group(2)
-                    field_changes[field_index]['removedRules'].append({ 'ruleIndex': rule_index, 'rule': arr_remove.t1 })
-                else:
-                    # Could not parse rules? add it to iterableRemoved
-                    if ('iterableRemoved' not in field_changes[field_index]):
-                        field_changes[field_index]['iterableRemoved'] = []
-                    # No match we found in field setting, field properties, field rules - return to the client the full path
-                    path_split = split(path_deconstructor_pattern, path)
-                    path_arr = path_split[1:-1]
-                    field_changes[field_index]['iterableRemoved'].append({ 'propertyName': path, 'value': arr_remove.t1, 'action': 'REMOVED', 'pathArray': path_arr })
-            else:
-                # This is a form setting
-                if ('iterableRemoved' not in form_changes):
-                    form_changes['iterableRemoved'] = []
-                path_split = split(path_deconstructor_pattern, path)
-                path_arr = path_split[1:-1]
-                form_changes['iterableRemoved'].append({ 'propertyName': path, 'value': arr_remove.t1, 'pathArray': path_arr })
+    return _corsify_actual_response(app.response_class(stream_with_context(generate()), mimetype='application/x-ndjson'))
 
-        # Removed Field Properties
-        for remove in dic_items_removed:
-            path = remove.path()
-            # Check if it's a form field value
-            field_match = search(field_pattern, path)
-            if (field_match):
-                # Get the field index
-                field_index = field_match.group(1)
-                # First things first -- check if the entire field was removed
-                field_root_match = search(field_root_pattern, path)
-                if (field_root_match):
-                    field = getField(field_index)
-                    removed_fields.append({ 'name': field.get('name'), 'fieldType': field.get('fieldType'), 'index': field_index, 'fieldId': field.get('fieldId') })
-                else:
-                    # Populate some useful field info into field_changes object
-                    if field_index not in field_changes:
-                        populate_field_changes_object(field_index)
-                    # Add a removedProperties arr if the field does not have it
-                    if ('removedProperties' not in field_changes[field_index]):
-                        field_changes[field_index]['removedProperties'] = []
-                    field_setting_changed_match = search(field_setting_changed_pattern, path)
-                    field_properties_changed_match = search(field_properties_changed_pattern, path)
-                    if (field_setting_changed_match or field_properties_changed_match):
-                        # can be a top level field setting or a setting inside 'properties'
-                        matchObj = field_setting_changed_match or field_properties_changed_match
-                        setting_name = matchObj.group(2)
-                        field_changes[field_index]['removedProperties'].append({ 'propertyName': setting_name })
-                    else:
-                        # No match we found in field setting, field properties, field rules - return to the client the full path
-                        path_split = split(path_deconstructor_pattern, path)
-                        path_arr = path_split[1:-1]
-                        field_changes[field_index]['removedProperties'].append({ 'propertyName': path, 'pathArray': path_arr })
-            else:
-                # This is a form setting
-                if ('removedProperties' not in form_changes):
-                    form_changes['removedProperties'] = []
-                path_split = split(path_deconstructor_pattern, path)
-                path_arr = path_split[1:-1]
-                form_changes['removedProperties'].append({ 'propertyName': path, 'pathArray': path_arr })
+@app.route('/compare/stream', methods=["POST", "OPTIONS"])
+def compare_stream():
+    if request.method == "OPTIONS": # CORS preflight
+        return _build_cors_preflight_response()
+    # Same body as /compare, parsed and diffed a field at a time - see stream_compare.py
+    if stream_compare.ijson is None:
+        return _corsify_actual_response(make_response(jsonify({ 'error': 'Streaming compares need the ijson package' }), 501))
+    try:
+        serving.acquire_slot()
+    except serving.Saturated as e:
+        response = make_response(jsonify({ 'error': str(e) }), 503)
+        response.headers['Retry-After'] = '1'
+        return _corsify_actual_response(response)
+    forms = None
+    try:
+        with spans.stage('parse'):
+            forms = stream_compare.SpooledForms(request.stream)
+        engine, distance_mode = compare.resolve_options(forms.options.get('engine') or request.args.get('engine') or 'fields',
+                                                        forms.options.get('distance') or request.args.get('distance'))
+        if engine != 'fields':
+            raise compare.CompareOptionError('Streaming compares only support the fields engine')
+        if compare.resolve_format(forms.options.get('format') or request.args.get('format'))[0] != compare.CHANGES:
+            raise compare.CompareOptionError('Streaming compares only return fieldChanges')
+        rule_alignment = compare.resolve_rule_alignment(engine, forms.options.get('rule_alignment') or request.args.get('rule_alignment'))
+        baseline = None
+        if 'baseline_id' in forms.options:
+            version = forms.options.get('baseline_version')
+            baseline = baseline_store.get(str(forms.options['baseline_id']), None if version is None else str(version))
+            if baseline is None:
+                raise LookupError('Unknown baseline {}'.format(forms.options['baseline_id']))
+        chunks = stream_compare.stream_diff(forms, distance_mode, baseline, rule_alignment)
+    except Exception as e:
+        if forms is not None:
+            forms.close()
+        serving.release_slot()
+        if isinstance(e, LookupError):
+            return _corsify_actual_response(make_response(jsonify({ 'error': str(e) }), 404))
+        if isinstance(e, ValueError):
+            return _corsify_actual_response(make_response(jsonify({ 'error': str(e) }), 400))
+        raise
 
-        # Added Field Properties
-        for add in dic_items_added:
-            path = add.path()
-            # Check if it's a form field value
-            field_match = search(field_pattern, path)
-            if (field_match):
-                # Get the field index
-                field_index = field_match.group(1)
-                # First things first -- check if an entire field was added
-                field_root_match = search(field_root_pattern, path)
-                if (field_root_match):
-                    field = getField(field_index)
-                    added_fields.append({ 'name': field.get('name'), 'fieldType': field.get('fieldType'), 'index': field_index, 'fieldId': field.get('fieldId') })
-                else:
-                    # Populate some useful field info into field_changes object
-                    if field_index not in field_changes:
-                        populate_field_changes_object(field_index)
-                    # Add a addedProperties arr if the field does not have it
-                    if ('addedProperties' not in field_changes[field_index]):
-                        field_changes[field_index]['addedProperties'] = [] 
-                    field_setting_changed_match = search(field_setting_changed_pattern, path)
-                    field_properties_changed_match = search(field_properties_changed_pattern, path)
-                    if (field_setting_changed_match or field_properties_changed_match):
-                        # can be a top level field setting or a setting inside 'properties'
-                        matchObj = field_setting_changed_match or field_properties_changed_match
-                        setting_name = matchObj.group(2)
-                        field_changes[field_index]['addedProperties'].append({ 'propertyName': setting_name })
-                    else:
-                        # No match we found in field setting, field properties, field rules - return to the client the full path
-                        path_split = split(path_deconstructor_pattern, path)
-                        path_arr = path_split[1:-1]
-                        field_changes[field_index]['addedProperties'].append({ 'propertyName': path, 'pathArray': path_arr })
-            else:
-                # This is a form setting
-                if ('addedProperties' not in form_changes):
-                    form_changes['addedProperties'] = []
-                path_split = split(path_deconstructor_pattern, path)
-                path_arr = path_split[1:-1]
-                form_changes['addedProperties'].append({ 'propertyName': path, 'pathArray': path_arr })
+    # Cleaned up when the response is closed, which happens even if the body is never
+    # read (HEAD, a client that went away)
+    response = app.response_class(chunks, mimetype=app.json.mimetype)
+    response.call_on_close(forms.close)
+    response.call_on_close(serving.release_slot)
+    return _corsify_actual_response(response)
 
-        # Changed Field Properties
-        for change in dic_items_changed:
-            path = change.path()
-            # Check if it's a form field value
-            field_match = search(field_pattern, path)
-            if (field_match):
-                # Get the field index
-                field_index = field_match.group(1)
-                # Populate some useful field info into field_changes object
-                if field_index not in field_changes:
-                    populate_field_changes_object(field_index)
-                # Add a changedProperties arr if the field does not have it
-                if ('changedProperties' not in field_changes[field_index]):
-                    field_changes[field_index]['changedProperties'] = [] 
-                field_setting_changed_match = search(field_setting_changed_pattern, path)
-                field_properties_changed_match = search(field_properties_changed_pattern, path)
-                field_rules_changed_match = search(field_rules_changed_pattern, path)
-                if (field_setting_changed_match or field_properties_changed_match):
-                    # can be a top level field setting or a setting inside 'properties'
-                    matchObj = field_setting_changed_match or field_properties_changed_match
-                    setting_name = matchObj.group(2)
-                    field_changes[field_index]['changedProperties'].append({ 'propertyName': setting_name, 'oldValue': change.t1, 'newValue': change.t2 })
-                elif (field_rules_changed_match):
-                    # Add a changedRules arr if the field does not have it
-                    if ('changedRules' not in field_changes[field_index]):
-                        field_changes[field_index]['changedRules'] = {}
-                    # Get the rule details
-                    rule_index = field_rules_changed_match.group(2)
-                    rule_setting = field_rules_changed_match.group(3)
-                    rule = getRule(rule_index, field_index)
-                    if (rule_index not in field_changes[field_index]['changedRules']):
-                        field_changes[field_index]['changedRules'][rule_index] = {
-                            'ruleIndex': rule_index,
-                            'type': rule.get('type'),
-                            'changedProperties': [],
-                            'addedProperties': [],
-                            'removedProperties': [],
-                        }
-                    field_changes[field_index]['changedRules'][rule_index]['changedProperties'].append({ 'propertyName': rule_setting, 'oldValue': change.t1, 'newValue': change.t2 })
-                else:
-                    # No match we found in field setting, field properties, field rules - return to the client the full path
-                    path_split = split(path_deconstructor_pattern, path)
-                    path_arr = path_split[1:-1]
-                    field_changes[field_index]['changedProperties'].append({ 'propertyName': path, 'oldValue': change.t1, 'newValue': change.t2, 'pathArray': path_arr })
-            else:
-                # This is a form setting
-                if ('changedProperties' not in form_changes):
-                    form_changes['changedProperties'] = []
-                path_split = split(path_deconstructor_pattern, path)
-                path_arr = path_split[1:-1]
-                form_changes['changedProperties'].append({ 'propertyName': path, 'oldValue': change.t1, 'newValue': change.t2, 'pathArray': path_arr })
+@app.route('/baselines/<baseline_id>', methods=["GET", "PUT", "OPTIONS"])
+def baseline(baseline_id):
+    if request.method == "OPTIONS": # CORS preflight
+        return _build_cors_preflight_response()
+    elif request.method == "PUT": # { structure, version? } - version defaults to the next integer
+        post_data = request.json
+        version = post_data.get('version')
+        try:
+            version = baseline_store.put(baseline_id, post_data['structure'], None if version is None else str(version))
+        except baselines.VersionExists as e:
+            return _corsify_actual_response(make_response(jsonify({ 'error': str(e) }), 409))
+        except ValueError as e:
+            return _corsify_actual_response(make_response(jsonify({ 'error': str(e) }), 413))
+        return _corsify_actual_response(make_response(jsonify({ 'baseline_id': baseline_id, 'version': version }), 201))
+    else:
+        stored = baseline_store.get(baseline_id, request.args.get('version'))
+        if stored is None:
+            return _corsify_actual_response(make_response(jsonify({ 'error': 'Unknown baseline {}'.format(baseline_id) }), 404))
+        return _corsify_actual_response(jsonify({ 'baseline_id': stored.baseline_id, 'version': stored.version, 'structure': stored.structure }))
 
-        for change in types_changed:
-            path = change.path()
-            # Check if it's a form field value
-            field_match = search(field_pattern, path)
-            if (field_match):
-                # Get the field index
-                field_index = field_match.group(1)
-                # Populate some useful field info into field_changes object
-                if field_index not in field_changes:
-                    populate_field_changes_object(field_index)
-                # Add a changedProperties arr if the field does not have it
-                if ('changedProperties' not in field_changes[field_index]):
-                    field_changes[field_index]['changedProperties'] = [] 
-                field_setting_changed_match = search(field_setting_changed_pattern, path)
-                field_properties_changed_match = search(field_properties_changed_pattern, path)
-                field_rules_changed_match = search(field_rules_changed_pattern, path)
-                if (field_setting_changed_match or field_properties_changed_match):
-                    # can be a top level field setting or a setting inside 'properties'
-                    matchObj = field_setting_changed_match or field_properties_changed_match
-                    setting_name = matchObj.group(2)
-                    field_changes[field_index]['changedProperties'].append({ 'propertyName': setting_name, 'oldValue': change.t1, 'newValue': change.t2 })
-                elif (field_rules_changed_match):
-                    # Add a changedRules arr if the field does not have it
-                    if ('changedRules' not in field_changes[field_index]):
-                        field_changes[field_index]['changedRules'] = {}
-                    # Get the rule details
-                    rule_index = field_rules_changed_match.group(2)
-                    rule_setting = field_rules_changed_match.group(3)
-                    rule = getRule(rule_index, field_index)
-                    if (rule_index not in field_changes[field_index]['changedRules']):
-                        field_changes[field_index]['changedRules'][rule_index] = {
-                            'ruleIndex': rule_index,
-                            'type': rule.get('type'),
-                            'changedProperties': [],
-                            'addedProperties': [],
-                            'removedProperties': [],
-                        }
-                    field_changes[field_index]['changedRules'][rule_index]['changedProperties'].append({ 'propertyName': rule_setting, 'oldValue': change.t1, 'newValue': change.t2 })
-                else:
-                    # No match we found in field setting, field properties, field rules - return to the client the full path
-                    path_split = split(path_deconstructor_pattern, path)
-                    path_arr = path_split[1:-1]
-                    field_changes[field_index]['changedProperties'].append({ 'propertyName': path, 'oldValue': change.t1, 'newValue': change.t2, 'pathArray': path_arr })
-            else:
-                # This is a form setting
-                if ('changedProperties' not in form_changes):
-                    form_changes['changedProperties'] = []
-                path_split = split(path_deconstructor_pattern, path)
-                path_arr = path_split[1:-1]
-                form_changes['changedProperties'].append({ 'propertyName': path, 'oldValue': change.t1, 'newValue': change.t2, 'pathArray': path_arr })
-                
+@app.route('/metrics')
+def prometheus_metrics():
+    body, content_type = metrics.render()
+    return Response(body, content_type=content_type)
 
-        return _corsify_actual_response(jsonify({ 'fieldChanges': field_changes, 'changeDistance': round(distance * 100, 2) }))
-    else:
-        raise RuntimeError("Weird - don't know how to handle method {}".format(request.method))
+@app.route('/compare/cache')
+def cache_stats():
+    return _corsify_actual_response(jsonify(result_cache.stats() if result_cache else { 'backend': None }))
 
 if __name__ == '__main__':
     app.run(debug=True, host="0.0.0.0", port=5000)
@@ -0,0 +1,157 @@
+# Stored baseline revisions for /compare.
+#
+# The original structure is nearly always a published revision, so clients can store
+# it once (PUT /baselines/<id>) and then send { baseline_id, modified_structure }.
+# A stored version can't be changed (PUTting it again is a 409); the latest is the
+# one stored last.
+# Baselines live in a local SQLite file bounded by entry count and bytes (least
+# recently used are dropped first). The most recently used ones are also kept parsed
+# in memory, together with their digest and form_index.FormIndex, so a hot baseline costs
+# neither a JSON parse nor a rehash. When a revision was last used is only written
+# back once it's COMPARE_BASELINE_TOUCH seconds old, so reads don't queue up behind
+# each other for SQLite's one writer.
+#
+#   COMPARE_BASELINE_PATH     sqlite file (default /tmp/compare-baselines.sqlite3)
+#   COMPARE_BASELINE_ENTRIES  max stored revisions (default 1000)
+#   COMPARE_BASELINE_BYTES    max total size of stored revisions (default 256MB)
+#   COMPARE_BASELINE_HOT      revisions kept parsed in memory per worker (default 32)
+#   COMPARE_BASELINE_TOUCH    seconds between writes of a revision's last use (default 60)
+from collections import OrderedDict
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import cache
+import form_index
+
+
+class VersionExists(Exception):
+    pass
+
+
+class Baseline(object):
+
+    def __init__(self, baseline_id, version, structure, created):
+        self.baseline_id = baseline_id
+        self.version = version
+        self.structure = structure
+        # When the row was stored, to tell it from one stored under the same version
+        # after it was evicted
+        self.created = created
+        self.digest = cache.structure_digest(structure)
+        self.index = form_index.FormIndex(structure)
+
+
+class BaselineStore(object):
+
+    def __init__(self, path, max_entries, max_bytes, hot_entries, touch_interval=60):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hot_entries = hot_entries
+        self.touch_interval = touch_interval
+        self.hot = OrderedDict()
+        self.hot_lock = threading.Lock()
+        self.local = threading.local()
+        db = self.connection()
+        db.execute('CREATE TABLE IF NOT EXISTS baselines (baseline_id TEXT, version TEXT, body BLOB, size INTEGER, '
+                   'created REAL, used REAL, PRIMARY KEY (baseline_id, version))')
+        db.execute('CREATE INDEX IF NOT EXISTS baselines_used ON baselines (used)')
+
+    def connection(self):
+        # sqlite3 connections can't be shared between threads
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self.local.db = db
+        return db
+
+    def put(self, baseline_id, structure, version=None):
+        # Stores a revision and returns its version, by default the next integer.
+        # Revisions can't be changed, storing a version that exists raises
+        # VersionExists.
+        body = json.dumps(structure, separators=(',', ':')).encode()
+        if len(body) > self.max_bytes:
+            raise ValueError('Baseline is larger than COMPARE_BASELINE_BYTES')
+        db = self.connection()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            if version is None:
+                versions = [row[0] for row in db.execute('SELECT version FROM baselines WHERE baseline_id = ?', (baseline_id,))]
+                version = str(max([int(v) for v in versions if v.isdigit()] or [0]) + 1)
+            now = time.time()
+            try:
+                db.execute('INSERT INTO baselines (baseline_id, version, body, size, created, used) VALUES (?, ?, ?, ?, ?, ?)',
+                           (baseline_id, version, sqlite3.Binary(body), len(body), now, now))
+            except sqlite3.IntegrityError:
+                raise VersionExists('Baseline {} version {} is already stored'.format(baseline_id, version))
+            self._evict(db)
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+        return version
+
+    def _evict(self, db):
+        count, total = db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM baselines').fetchone()
+        if count <= self.max_entries and total <= self.max_bytes:
+            return
+        for baseline_id, version, size in db.execute('SELECT baseline_id, version, size FROM baselines ORDER BY used').fetchall():
+            if count <= self.max_entries and total <= self.max_bytes:
+                break
+            db.execute('DELETE FROM baselines WHERE baseline_id = ? AND version = ?', (baseline_id, version))
+            with self.hot_lock:
+                self.hot.pop((baseline_id, version), None)
+            count -= 1
+            total -= size
+
+    def get(self, baseline_id, version=None):
+        # Returns the Baseline, the latest stored version if none is given, or None.
+        # A parsed copy is only used while it's of the row stored now: another worker
+        # may have evicted it and stored the same version again since.
+        db = self.connection()
+        if version is None:
+            # Rows are only ever inserted, so the last one has the highest rowid
+            row = db.execute('SELECT version, created, used FROM baselines WHERE baseline_id = ? ORDER BY rowid DESC LIMIT 1',
+                             (baseline_id,)).fetchone()
+        else:
+            row = db.execute('SELECT version, created, used FROM baselines WHERE baseline_id = ? AND version = ?',
+                             (baseline_id, version)).fetchone()
+        key = (baseline_id, row[0] if row else version)
+        with self.hot_lock:
+            baseline = self.hot.get(key)
+            if baseline is not None and (row is None or baseline.created != row[1]):
+                del self.hot[key]
+                baseline = None
+            elif baseline is not None:
+                self.hot.move_to_end(key)
+        if row is None:
+            return None
+        version, created, used = row
+        if baseline is None:
+            row = db.execute('SELECT body FROM baselines WHERE baseline_id = ? AND version = ? AND created = ?',
+                             (baseline_id, version, created)).fetchone()
+            if row is None:
+                return None
+            baseline = Baseline(baseline_id, version, json.loads(bytes(row[0])), created)
+            with self.hot_lock:
+                self.hot[key] = baseline
+                while len(self.hot) > self.hot_entries:
+                    self.hot.popitem(last=False)
+        now = time.time()
+        if now - used >= self.touch_interval:
+            db.execute('UPDATE baselines SET used = ? WHERE baseline_id = ? AND version = ? AND created = ?',
+                       (now, baseline_id, version, created))
+        return baseline
+
+
+def from_env():
+    return BaselineStore(os.environ.get('COMPARE_BASELINE_PATH', '/tmp/compare-baselines.sqlite3'),
+                         int(os.environ.get('COMPARE_BASELINE_ENTRIES', 1000)),
+                         int(os.environ.get('COMPARE_BASELINE_BYTES', 256 * 1024 * 1024)),
+                         int(os.environ.get('COMPARE_BASELINE_HOT', 32)),
+                         float(os.environ.get('COMPARE_BASELINE_TOUCH', 60)))
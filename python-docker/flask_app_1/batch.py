@@ -0,0 +1,135 @@
+# Batch compares for /compare/batch, run on a process pool.
+#
+# Diffs are CPU bound, so a batch is spread over worker processes and each result is
+# handed back as soon as it is done, in completion order. The pool is created on
+# first use and reused by every later batch.
+#
+#   COMPARE_POOL_SIZE      worker processes (default: one per CPU)
+#   COMPARE_POOL_INFLIGHT  pairs queued per worker at a time (default 2), bounds how
+#                          much of a big batch is pickled and in flight at once
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+import os
+import threading
+
+import compare
+
+POOL_SIZE = int(os.environ.get('COMPARE_POOL_SIZE', 0)) or os.cpu_count() or 1
+INFLIGHT_PER_WORKER = int(os.environ.get('COMPARE_POOL_INFLIGHT', 2))
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn rather than fork - the web server is multi-threaded
+            _pool = ProcessPoolExecutor(max_workers=POOL_SIZE, mp_context=multiprocessing.get_context('spawn'))
+        return _pool
+
+
+def reset_pool():
+    # After a worker died the executor refuses new work, start a fresh one
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+def shutdown_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=True, cancel_futures=True)
+        _pool = None
+
+
+def _result(index, pair):
+    # Every result line carries the pair's position and, if the client sent one, its id
+    result = { 'index': index }
+    if isinstance(pair, dict) and 'id' in pair:
+        result['id'] = pair['id']
+    return result
+
+
+def _error(index, pair, message):
+    result = _result(index, pair)
+    result['error'] = message
+    return result
+
+
+def compare_pair(index, pair, engine=None, distance_mode=None, rule_alignment=None, output_format=None, old_values=None):
+    # Runs in a worker process. Errors are reported per pair, never raised.
+    result = _result(index, pair)
+    try:
+        if not isinstance(pair, dict):
+            raise compare.CompareOptionError('Each pair must be an object')
+        if 'original_structure' not in pair or 'modified_structure' not in pair:
+            raise compare.CompareOptionError('Each pair needs original_structure and modified_structure')
+        result.update(compare.compare_structures(pair['original_structure'], pair['modified_structure'],
+                                                 pair.get('engine') or engine, pair.get('distance') or distance_mode,
+                                                 output_format=pair.get('format') or output_format,
+                                                 old_values=pair.get('old_values', old_values),
+                                                 rule_alignment=pair.get('rule_alignment') or rule_alignment))
+    except compare.CompareOptionError as e:
+        result['error'] = str(e)
+    except Exception as e:
+        result['error'] = '{}: {}'.format(type(e).__name__, e)
+    return result
+
+
+def run_batch(pairs, engine=None, distance_mode=None, rule_alignment=None, output_format=None, old_values=None,
+              slots=None):
+    # Yields one result per pair as they complete. slots: a semaphore each pair in
+    # the pool holds while it is there. Pairs only take free ones, and wait for one
+    # only when none of theirs is in the pool.
+    pool = get_pool()
+    window = max(1, POOL_SIZE * INFLIGHT_PER_WORKER)
+    pending = {}
+    items = iter(enumerate(pairs))
+    exhausted = False
+    while pending or not exhausted:
+        while not exhausted and len(pending) < window:
+            if slots is not None and not slots.acquire(blocking=not pending):
+                break
+            try:
+                index, pair = next(items)
+            except StopIteration:
+                if slots is not None:
+                    slots.release()
+                exhausted = True
+                break
+            try:
+                future = pool.submit(compare_pair, index, pair, engine, distance_mode, rule_alignment, output_format,
+                                     old_values)
+            except Exception:
+                if slots is not None:
+                    slots.release()
+                raise
+            if slots is not None:
+                future.add_done_callback(lambda future: slots.release())
+            pending[future] = (index, pair)
+        if not pending:
+            break
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        broken = False
+        for future in done:
+            index, pair = pending.pop(future)
+            try:
+                yield future.result()
+            except BrokenProcessPool:
+                broken = True
+                yield _error(index, pair, 'Worker process died while comparing this pair')
+            except Exception as e:
+                yield _error(index, pair, '{}: {}'.format(type(e).__name__, e))
+        if broken:
+            # A worker died (e.g. killed for memory) - fail what was in flight and carry on with a new pool
+            for index, pair in pending.values():
+                yield _error(index, pair, 'Worker process died while comparing this pair')
+            pending.clear()
+            reset_pool()
+            pool = get_pool()
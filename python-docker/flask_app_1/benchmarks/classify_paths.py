@@ -0,0 +1,64 @@
+# Per-item cost of classifying DeepDiff paths: the old uncompiled re.search() chain
+# against paths.parse_path().
+#
+# Run from flask_app_1/:  python -m benchmarks.classify_paths
+from re import search, split
+import timeit
+
+import paths
+
+# The patterns /compare used before paths.py
+field_pattern = '^root\\[\'fields\'\\]\\[\'(\\d+)\'\\]'
+field_root_pattern = '^root\\[\'fields\'\\]\\[\'(\\d+)\'\\]$'
+field_setting_changed_pattern = '^root\\[\'fields\'\\]\\[\'(\\d+)\'\\]\\[\'([a-zA-Z0-9-_]+)\'\\]$'
+field_properties_changed_pattern = '^root\\[\'fields\'\\]\\[\'(\\d+)\'\\]\\[\'properties\'\\]\\[\'([a-z\\-?\\d?A-Z09]+)\'\\]$'
+field_rules_changed_pattern = '^root\\[\'fields\'\\]\\[\'(\\d+)\'\\]\\[\'rules\'\\]\\[(\\d+)\\]\\[\'([a-zA-Z09]+)\'\\]$'
+field_uuid_pattern = '^root\\[\'fields\'\\]\\[\'(\\d+)\'\\]\\[\'uuid\'\\]$'
+path_deconstructor_pattern = r"[^a-zA-Z0-9-_]+"
+
+SAMPLE_PATHS = [
+    "root['fields']['12']['name']",
+    "root['fields']['12']['properties']['label']",
+    "root['fields']['130']['rules'][4]['value']",
+    "root['fields']['7']['rules'][2]",
+    "root['fields']['7']['properties']['options'][3]['text']",
+    "root['fields']['1042']",
+    "root['settings']['theme']",
+]
+
+
+def legacy_changed(path):
+    # What the values_changed / type_changes loops did for every item
+    if search(field_pattern, path):
+        search(field_root_pattern, path)
+        setting = search(field_setting_changed_pattern, path)
+        prop = search(field_properties_changed_pattern, path)
+        rule = search(field_rules_changed_pattern, path)
+        if not (setting or prop or rule):
+            split(path_deconstructor_pattern, path)
+    else:
+        split(path_deconstructor_pattern, path)
+
+
+def parsed_changed(path):
+    info = paths.parse_path(path)
+    if info.kind in (paths.FORM, paths.OTHER):
+        paths.path_array(path)
+
+
+def legacy_exclude(path):
+    return True if search(field_uuid_pattern, path) else False
+
+
+def per_item_ns(fn, number=20000):
+    total = timeit.timeit(lambda: [fn(p) for p in SAMPLE_PATHS], number=number)
+    return total / (number * len(SAMPLE_PATHS)) * 1e9
+
+
+if __name__ == '__main__':
+    print('classify (per diff item)')
+    print('  re.search chain    %8.0f ns' % per_item_ns(legacy_changed))
+    print('  paths.parse_path   %8.0f ns' % per_item_ns(parsed_changed))
+    print('exclude_obj_callback (per visited node)')
+    print('  re.search          %8.0f ns' % per_item_ns(legacy_exclude))
+    print('  paths.is_field_uuid%8.0f ns' % per_item_ns(paths.is_field_uuid))
@@ -0,0 +1,28 @@
+# Time /compare's changeDistance modes on large synthetic forms.
+#
+# Run from flask_app_1/:  python -m benchmarks.distance_modes [fields ...]
+import sys
+import time
+
+from benchmarks.forms import edited, synthetic_form
+import compare
+
+
+def best_of(fn, repeat=3):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+if __name__ == '__main__':
+    sizes = [int(arg) for arg in sys.argv[1:]] or [500, 2000]
+    for size in sizes:
+        original = synthetic_form(size)
+        modified = edited(original)
+        for engine, modes in compare.ENGINE_DISTANCES.items():
+            for mode in modes:
+                seconds = best_of(lambda: compare.compare_structures(original, modified, engine, mode))
+                print('%6d fields  %-8s  %-11s  %8.3fs' % (size, engine, mode, seconds))
@@ -0,0 +1,270 @@
+# End-to-end /compare benchmark: latency percentiles, throughput and peak RSS per
+# scenario, saved as JSON so runs can be compared.
+#
+# Run from flask_app_1/:
+#   python -m benchmarks.endpoint                         in-process, Flask test client
+#   python -m benchmarks.endpoint --url http://host:5000  against a running server
+#   python -m benchmarks.endpoint --out new.json --compare old.json
+#
+# Every request sends a differently edited form, so the result cache never answers
+# it. In-process runs also switch the cache off. Peak RSS is read from /proc
+# (VmHWM, reset before each scenario). Against a server it's only reported when
+# --server-pid names a process on this host.
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import http.client
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlsplit
+
+from benchmarks.forms import DEFAULT_MIX, edit_form, generate_form
+
+# name, fields, rules per field, edits per request, engine, distance, response format,
+# edit mix, and whether the original is stored once as a baseline
+SCENARIOS = [
+    {'name': 'small', 'fields': 50, 'rules': 5, 'edits': 5},
+    {'name': 'medium', 'fields': 500, 'rules': 10, 'edits': 20},
+    {'name': 'medium-fields', 'fields': 500, 'rules': 10, 'edits': 20, 'engine': 'fields'},
+    {'name': 'medium-approximate', 'fields': 500, 'rules': 10, 'edits': 20, 'distance': 'approximate'},
+    {'name': 'medium-uuid-churn', 'fields': 500, 'rules': 10, 'edits': 100, 'mix': {'uuid': 1}},
+    {'name': 'medium-type-changes', 'fields': 500, 'rules': 10, 'edits': 20, 'mix': {'type_change': 1}},
+    {'name': 'large', 'fields': 2000, 'rules': 10, 'edits': 50},
+    {'name': 'large-fields', 'fields': 2000, 'rules': 10, 'edits': 50, 'engine': 'fields'},
+    {'name': 'large-patch', 'fields': 2000, 'rules': 10, 'edits': 50, 'format': 'patch'},
+    {'name': 'large-fields-patch', 'fields': 2000, 'rules': 10, 'edits': 50, 'engine': 'fields', 'format': 'patch'},
+    {'name': 'large-fields-baseline', 'fields': 2000, 'rules': 10, 'edits': 50, 'engine': 'fields', 'baseline': True},
+]
+
+
+class InProcessClient(object):
+
+    def __init__(self):
+        # Before app is imported: no result cache, and a throwaway baseline store
+        os.environ['COMPARE_CACHE'] = 'off'
+        os.environ.setdefault('COMPARE_BASELINE_PATH', os.path.join(tempfile.mkdtemp(), 'baselines.sqlite3'))
+        import app
+        self.app = app.app
+        self.local = threading.local()
+
+    def request(self, method, path, body):
+        # One test client per thread
+        client = getattr(self.local, 'client', None)
+        if client is None:
+            client = self.local.client = self.app.test_client()
+        response = client.open(path, method=method, data=body, content_type='application/json')
+        return response.status_code, response.get_data()
+
+
+class HTTPClient(object):
+
+    def __init__(self, url):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port
+        self.https = parts.scheme == 'https'
+        self.prefix = parts.path.rstrip('/')
+        self.local = threading.local()
+
+    def request(self, method, path, body):
+        # One keep-alive connection per thread
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection_class = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+            connection = self.local.connection = connection_class(self.host, self.port, timeout=300)
+        try:
+            connection.request(method, self.prefix + path, body, {'Content-Type': 'application/json'})
+            response = connection.getresponse()
+            return response.status, response.read()
+        except Exception:
+            connection.close()
+            self.local.connection = None
+            raise
+
+
+def percentile(sorted_values, percent):
+    # Nearest rank
+    if not sorted_values:
+        return None
+    rank = max(1, int(math.ceil(percent / 100.0 * len(sorted_values))))
+    return sorted_values[rank - 1]
+
+
+def _proc_status(pid, name):
+    try:
+        with open('/proc/%s/status' % pid) as status:
+            for line in status:
+                if line.startswith(name + ':'):
+                    return int(line.split()[1]) / 1024.0
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def reset_peak_rss(pid):
+    try:
+        with open('/proc/%s/clear_refs' % pid, 'w') as clear_refs:
+            clear_refs.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss_mb(pid):
+    peak = _proc_status(pid, 'VmHWM')
+    if peak is None and pid == os.getpid():
+        try:
+            import resource
+            # Linux reports KB, macOS bytes; the peak of the whole run either way
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024.0 * 1024 if sys.platform == 'darwin' else 1024.0)
+        except ImportError:
+            pass
+    return peak
+
+
+def build_bodies(scenario, count, seed):
+    original = generate_form(scenario['fields'], scenario['rules'], seed=seed)
+    bodies = []
+    for n in range(count):
+        modified = edit_form(original, scenario['edits'], seed=seed * 100003 + n, mix=scenario.get('mix') or DEFAULT_MIX)
+        body = {'modified_structure': modified}
+        if scenario.get('baseline'):
+            body['baseline_id'] = 'benchmark-%s-%d' % (scenario['name'], seed)
+        else:
+            body['original_structure'] = original
+        for option in ('engine', 'distance', 'format'):
+            if scenario.get(option):
+                body[option] = scenario[option]
+        bodies.append(json.dumps(body).encode())
+    return original, bodies
+
+
+def run_scenario(client, scenario, requests, concurrency, seed, pid):
+    original, bodies = build_bodies(scenario, requests + 1, seed)
+    if scenario.get('baseline'):
+        status, body = client.request('PUT', '/baselines/benchmark-%s-%d' % (scenario['name'], seed),
+                                      json.dumps({'structure': original}).encode())
+        if status not in (200, 201):
+            raise RuntimeError('Could not store the baseline: %s %s' % (status, body[:200]))
+    # Warm up (imports, connection, hot baseline) outside the timings
+    client.request('POST', '/compare', bodies.pop())
+
+    def timed(body):
+        start = time.perf_counter()
+        try:
+            status, _ = client.request('POST', '/compare', body)
+        except Exception:
+            status = None
+        return time.perf_counter() - start, status == 200
+
+    if pid:
+        reset_peak_rss(pid)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(timed, bodies))
+    elapsed = time.perf_counter() - start
+    latencies = sorted(seconds * 1000 for seconds, ok in results if ok)
+    return {
+        'requests': len(results),
+        'errors': sum(1 for seconds, ok in results if not ok),
+        'request_bytes': sum(len(body) for body in bodies) // len(bodies),
+        'p50_ms': percentile(latencies, 50),
+        'p95_ms': percentile(latencies, 95),
+        'p99_ms': percentile(latencies, 99),
+        'mean_ms': sum(latencies) / len(latencies) if latencies else None,
+        'throughput_rps': len(latencies) / elapsed if elapsed else None,
+        'peak_rss_mb': peak_rss_mb(pid) if pid else None,
+    }
+
+
+def _commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_runs(old, new, tolerance):
+    # Prints the change per scenario, returns the names of scenarios whose p50 or
+    # p95 latency grew by more than tolerance
+    regressions = []
+    for name, result in new['scenarios'].items():
+        before = old['scenarios'].get(name)
+        if before is None:
+            continue
+        changes = []
+        for metric in ('p50_ms', 'p95_ms', 'p99_ms', 'throughput_rps', 'peak_rss_mb'):
+            if before.get(metric) and result.get(metric) is not None:
+                change = result[metric] / before[metric] - 1
+                changes.append('%s %+.1f%%' % (metric, change * 100))
+                if metric in ('p50_ms', 'p95_ms') and change > tolerance:
+                    regressions.append(name)
+        print('%-24s %s' % (name, '  '.join(changes)))
+    return sorted(set(regressions))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', help='benchmark a running server instead of the app in-process')
+    parser.add_argument('--server-pid', type=int, help='pid of the server, for peak RSS with --url')
+    parser.add_argument('--scenario', action='append', help='only run these scenarios (repeatable)')
+    parser.add_argument('--requests', type=int, default=20, help='timed requests per scenario (default 20)')
+    parser.add_argument('--concurrency', type=int, default=1, help='requests in flight at once (default 1)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='compare against the results in this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.10,
+                        help='p50/p95 growth that counts as a regression with --compare (default 0.10)')
+    args = parser.parse_args(argv)
+
+    scenarios = [scenario for scenario in SCENARIOS if not args.scenario or scenario['name'] in args.scenario]
+    if args.url:
+        client = HTTPClient(args.url)
+        pid = args.server_pid
+    else:
+        client = InProcessClient()
+        pid = os.getpid()
+
+    results = {
+        'meta': {
+            'target': args.url or 'in-process',
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+            'seed': args.seed,
+            'commit': _commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        },
+        'scenarios': {},
+    }
+    print('%-24s %8s %8s %8s %9s %9s %6s' % ('scenario', 'p50 ms', 'p95 ms', 'p99 ms', 'req/s', 'peak MB', 'errors'))
+    for scenario in scenarios:
+        result = run_scenario(client, scenario, args.requests, args.concurrency, args.seed, pid)
+        results['scenarios'][scenario['name']] = dict(result, scenario=scenario)
+        print('%-24s %8s %8s %8s %9s %9s %6d' % (scenario['name'], _fmt(result['p50_ms']), _fmt(result['p95_ms']),
+                                                 _fmt(result['p99_ms']), _fmt(result['throughput_rps']),
+                                                 _fmt(result['peak_rss_mb']), result['errors']))
+    if args.out:
+        with open(args.out, 'w') as out:
+            json.dump(results, out, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as previous:
+            regressions = compare_runs(json.load(previous), results, args.tolerance)
+        if regressions:
+            print('regressed: %s' % ', '.join(regressions))
+            return 1
+    return 0
+
+
+def _fmt(value):
+    return '-' if value is None else '%.1f' % value
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,139 @@
+# Deterministic synthetic forms for the benchmarks.
+#
+# generate_form() builds a form shaped like the ones /compare gets from the editor:
+# a 'fields' dict of { fieldId, uuid, name, fieldType, properties, rules } with
+# nested properties. edit_form() then applies a mix of edits to a copy of it. The
+# same arguments always give the same forms, so runs can be compared.
+import copy
+import random
+
+FIELD_TYPES = ('text', 'number', 'email', 'date', 'select', 'checkbox')
+RULE_TYPES = ('required', 'min', 'max', 'pattern', 'showIf', 'hideIf')
+
+# Edit kinds and how often edit_form() picks each one by default
+EDIT_KINDS = ('change', 'add', 'remove', 'type_change', 'uuid')
+DEFAULT_MIX = {'change': 4, 'add': 1, 'remove': 1, 'type_change': 1, 'uuid': 2}
+
+
+def _uuid(rng):
+    return '%08x-%04x-%04x-%04x-%012x' % (rng.getrandbits(32), rng.getrandbits(16), rng.getrandbits(16),
+                                          rng.getrandbits(16), rng.getrandbits(48))
+
+
+def _properties(rng, index, depth):
+    properties = {
+        'label': 'Label %d' % index,
+        'placeholder': 'Enter value %d' % index,
+        'required': rng.random() < 0.5,
+        'width': rng.choice((25, 50, 100)),
+        'options': ['option-%d' % n for n in range(rng.randint(0, 5))],
+    }
+    nested = properties
+    for level in range(depth):
+        nested['validation'] = {'min': rng.randint(0, 10), 'max': rng.randint(10, 1000),
+                                'message': 'Invalid value (level %d)' % level}
+        nested = nested['validation']
+    return properties
+
+
+def _rule(rng, field_count):
+    return {'type': rng.choice(RULE_TYPES), 'value': rng.randint(0, 100),
+            'field_id': 'field-%d' % rng.randrange(max(1, field_count)), 'message': 'Rule failed'}
+
+
+def _field(rng, index, field_count, rule_count, depth):
+    return {
+        'fieldId': 'field-%d' % index,
+        'uuid': _uuid(rng),
+        'name': 'Field %d' % index,
+        'fieldType': rng.choice(FIELD_TYPES),
+        'properties': _properties(rng, index, depth),
+        'rules': [_rule(rng, field_count) for _ in range(rule_count)],
+    }
+
+
+def generate_form(field_count, rule_count=5, depth=2, seed=0):
+    # depth: how many levels of nested 'validation' dicts each field's properties get
+    rng = random.Random(seed)
+    return {
+        'title': 'Benchmark form',
+        'settings': {'theme': 'light', 'submitLabel': 'Send', 'steps': [1, 2, 3]},
+        'fields': {str(i): _field(rng, i, field_count, rule_count, depth) for i in range(field_count)},
+    }
+
+
+def edit_form(form, edits, seed=0, mix=None):
+    # A copy of form with `edits` random edits, picked by the weights in mix
+    # (see DEFAULT_MIX). uuid edits only churn field uuids, which /compare ignores.
+    rng = random.Random(seed)
+    mix = mix or DEFAULT_MIX
+    kinds = [kind for kind in EDIT_KINDS if mix.get(kind)]
+    weights = [mix[kind] for kind in kinds]
+    modified = copy.deepcopy(form)
+    fields = modified['fields']
+    next_index = max([int(key) for key in fields] or [-1]) + 1
+    for _ in range(edits):
+        if not fields:
+            break
+        kind = rng.choices(kinds, weights)[0]
+        key = rng.choice(list(fields))
+        field = fields[key]
+        target = rng.random()
+        if kind == 'uuid':
+            field['uuid'] = _uuid(rng)
+        elif kind == 'change':
+            if target < 0.4:
+                field['properties']['label'] += ' (edited)'
+            elif target < 0.7 and field['rules']:
+                rng.choice(field['rules'])['value'] = rng.randint(0, 100)
+            else:
+                field['name'] += ' (edited)'
+        elif kind == 'type_change':
+            if target < 0.5:
+                field['properties']['width'] = str(field['properties']['width'])
+            else:
+                field['properties']['required'] = int(field['properties']['required'])
+        elif kind == 'add':
+            if target < 0.3:
+                fields[str(next_index)] = _field(rng, next_index, len(fields), len(field['rules']), 1)
+                next_index += 1
+            elif target < 0.6:
+                field['rules'].append(_rule(rng, len(fields)))
+            else:
+                field['properties']['hint'] = 'Hint for %s' % key
+        elif kind == 'remove':
+            if target < 0.2:
+                del fields[key]
+            elif target < 0.6 and field['rules']:
+                field['rules'].pop(rng.randrange(len(field['rules'])))
+            else:
+                field['properties'].pop('placeholder', None)
+    return modified
+
+
+def synthetic_form(field_count, rule_count=10):
+    # The uniform form the micro benchmarks use
+    return {
+        'title': 'Benchmark form',
+        'fields': {
+            str(i): {
+                'fieldId': 'field-%d' % i,
+                'uuid': 'uuid-%d' % i,
+                'name': 'Field %d' % i,
+                'fieldType': 'text',
+                'properties': {'label': 'Label %d' % i, 'required': i % 2 == 0, 'options': ['a', 'b', 'c']},
+                'rules': [{'type': 'max', 'value': j} for j in range(rule_count)],
+            }
+            for i in range(field_count)
+        },
+    }
+
+
+def edited(form):
+    # synthetic_form() with every 50th field's name and first rule changed
+    modified = copy.deepcopy(form)
+    for i, field in enumerate(modified['fields'].values()):
+        if i % 50 == 0:
+            field['name'] += ' (edited)'
+            field['rules'][0]['value'] = -1
+    return modified
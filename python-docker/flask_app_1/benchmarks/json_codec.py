@@ -0,0 +1,58 @@
+# Bytes on the wire and (de)serialisation time for /compare bodies: Flask's default
+# jsonify path against codec.py (orjson when installed) and response compression.
+#
+# Run from flask_app_1/:  python -m benchmarks.json_codec [fields]
+import gzip
+import json
+import sys
+import time
+
+from flask import Flask
+from flask.json.provider import DefaultJSONProvider
+
+from benchmarks.forms import edited, synthetic_form
+import codec
+import compare
+
+
+def best_of(fn, repeat=5):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+def report(label, seconds, size):
+    print('  %-28s %9.1f ms  %10d bytes' % (label, seconds * 1000, size))
+
+
+if __name__ == '__main__':
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    original = synthetic_form(size)
+    modified = edited(original)
+    for field in modified['fields'].values():
+        field['properties']['label'] += ' (edited)'
+    request_body = json.dumps({'original_structure': original, 'modified_structure': modified}).encode()
+    result = compare.compare_structures(original, modified, 'fields', 'approximate')
+
+    print('request body, %d fields (orjson %s)' % (size, 'on' if codec.USE_ORJSON else 'not installed'))
+    seconds, _ = best_of(lambda: json.loads(request_body))
+    report('parse: json.loads', seconds, len(request_body))
+    seconds, _ = best_of(lambda: codec.loads(request_body))
+    report('parse: codec.loads', seconds, len(request_body))
+
+    print('response body')
+    flask_app = Flask(__name__)
+    default_provider = DefaultJSONProvider(flask_app)
+    seconds, body = best_of(lambda: default_provider.response(result).get_data())
+    report('jsonify (stdlib json)', seconds, len(body))
+    seconds, body = best_of(lambda: codec.dumps_bytes(result))
+    report('codec.dumps_bytes', seconds, len(body))
+    seconds, compressed = best_of(lambda: gzip.compress(body, compresslevel=codec.GZIP_LEVEL, mtime=0))
+    report('+ gzip level %d' % codec.GZIP_LEVEL, seconds, len(compressed))
+    if codec.zstandard:
+        compressor = codec.zstandard.ZstdCompressor(level=codec.ZSTD_LEVEL)
+        seconds, compressed = best_of(lambda: compressor.compress(body))
+        report('+ zstd level %d' % codec.ZSTD_LEVEL, seconds, len(compressed))
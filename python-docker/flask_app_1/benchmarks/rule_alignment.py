@@ -0,0 +1,61 @@
+# Time /compare on fields with long rule lists, rules lined up by position (DeepDiff,
+# and the fields engine's default) against rule_alignment=content.
+#
+# Run from flask_app_1/:  python -m benchmarks.rule_alignment [rules per field ...]
+import copy
+import json
+import sys
+
+from benchmarks.distance_modes import best_of
+from benchmarks.forms import generate_form
+import compare
+
+FIELDS = 50
+
+# (engine, rule alignment) - DeepDiff with the approximate distance, the exact one
+# would dominate the timings
+RUNS = [('deepdiff', 'index'), ('fields', 'index'), ('fields', 'content')]
+
+
+def _insert_first(rules):
+    rules.insert(0, {'type': 'required', 'value': -1, 'field_id': 'field-0', 'message': 'New rule'})
+
+
+def _remove_first(rules):
+    rules.pop(0)
+
+
+def _move_to_end(rules):
+    rules.append(rules.pop(0))
+
+
+def _change_middle(rules):
+    rules[len(rules) // 2]['value'] = -1
+
+
+# Each edit is made to the rules of every tenth field
+EDITS = [('insert first', _insert_first), ('remove first', _remove_first), ('move to end', _move_to_end),
+         ('change middle', _change_middle)]
+
+
+def edited_rules(original, edit):
+    modified = copy.deepcopy(original)
+    for index, field in enumerate(modified['fields'].values()):
+        if index % 10 == 0:
+            edit(field['rules'])
+    return modified
+
+
+if __name__ == '__main__':
+    rule_counts = [int(arg) for arg in sys.argv[1:]] or [50, 200]
+    for rule_count in rule_counts:
+        original = generate_form(FIELDS, rule_count)
+        for name, edit in EDITS:
+            modified = edited_rules(original, edit)
+            for engine, rule_alignment in RUNS:
+                distance_mode = 'approximate' if engine == 'deepdiff' else None
+                compare_once = lambda: compare.compare_structures(original, modified, engine, distance_mode,
+                                                                  rule_alignment=rule_alignment)
+                seconds = best_of(compare_once)
+                size = len(json.dumps(compare_once(), separators=(',', ':')))
+                print('%4d rules  %-14s %-8s %-8s %8.3fs %10d bytes' % (rule_count, name, engine, rule_alignment, seconds, size))
@@ -0,0 +1,68 @@
+# Latency of one big fields engine diff, in one process against split across the
+# pool (COMPARE_SHARD_FIELDS, see serving.py) with different pool sizes.
+#
+# Run from flask_app_1/:
+#   python -m benchmarks.sharded_diff
+#   python -m benchmarks.sharded_diff --fields 20000 --edits 2000 --workers 1 2 4 8
+#
+# Each pool size runs in a fresh process, as the pool size is read at import. Timings
+# are the median of --repeat diffs after one to start the pool up.
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from benchmarks.forms import edit_form, generate_form
+
+
+def measure(fields, rules, edits, repeat, sharded):
+    # In the child process: the median seconds of serving.compare_body()
+    os.environ['COMPARE_SHARD_FIELDS'] = '1' if sharded else '0'
+    import serving
+    import batch
+    original = generate_form(fields, rules, seed=0)
+    modified = edit_form(original, edits, seed=1)
+    compare_once = lambda: serving.compare_body(None, original, modified, 'fields', 'approximate', 'index', 'changes', True)
+    body = compare_once()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        compare_once()
+        timings.append(time.perf_counter() - start)
+    batch.shutdown_pool()
+    return {'seconds': statistics.median(timings), 'response_bytes': len(body)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--fields', type=int, default=10000)
+    parser.add_argument('--rules', type=int, default=10)
+    parser.add_argument('--edits', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--measure', type=int, metavar='WORKERS', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.measure is not None:
+        print(json.dumps(measure(args.fields, args.rules, args.edits, args.repeat, args.measure > 0)))
+        return 0
+
+    print('%d fields, %d edits, %d CPUs' % (args.fields, args.edits, os.cpu_count() or 1))
+    print('%-22s %9s %9s' % ('run', 'seconds', 'speedup'))
+    runs = [('one process', 0)] + [('split, %d workers' % workers, workers) for workers in args.workers]
+    baseline = None
+    for name, workers in runs:
+        env = dict(os.environ, COMPARE_POOL_SIZE=str(max(1, workers)))
+        command = [sys.executable, '-m', 'benchmarks.sharded_diff', '--fields', str(args.fields), '--rules', str(args.rules),
+                   '--edits', str(args.edits), '--repeat', str(args.repeat), '--measure', str(workers)]
+        result = json.loads(subprocess.check_output(command, env=env).decode().strip().splitlines()[-1])
+        baseline = baseline or result['seconds']
+        print('%-22s %9.3f %8.2fx' % (name, result['seconds'], baseline / result['seconds']))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,118 @@
+# Peak memory of one large compare: POST /compare (engine=fields) against
+# POST /compare/stream.
+#
+# Run from flask_app_1/:
+#   python -m benchmarks.stream_memory
+#   python -m benchmarks.stream_memory --fields 20000 --rules 20 --edits 500
+#
+# The request body is generated once and written to a temporary file. Each endpoint
+# then runs in a fresh process that imports the app, resets its peak RSS (VmHWM, see
+# benchmarks.endpoint) and sends the file without reading it into memory, so the
+# peak is the app's own. Diffs run on the request thread (COMPARE_DIFF_POOL=inline)
+# so they're measured in the same process.
+#
+# Each endpoint's time to its first response byte is shown too. /compare/stream has
+# to send its first bytes before it has diffed every field; the run fails if it
+# doesn't.
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.endpoint import peak_rss_mb, reset_peak_rss
+from benchmarks.forms import edit_form, generate_form
+
+ENDPOINTS = ('/compare', '/compare/stream')
+
+
+def write_body(path, fields, rules, edits, seed):
+    original = generate_form(fields, rules, seed=seed)
+    modified = edit_form(original, edits, seed=seed + 1)
+    with open(path, 'w') as body:
+        json.dump({'original_structure': original, 'modified_structure': modified, 'engine': 'fields'}, body)
+
+
+def measure(path, endpoint):
+    # In the child process: returns the status, time, peak RSS and response size
+    os.environ['COMPARE_CACHE'] = 'off'
+    os.environ['COMPARE_DIFF_POOL'] = 'inline'
+    os.environ.setdefault('COMPARE_BASELINE_PATH', os.path.join(tempfile.mkdtemp(), 'baselines.sqlite3'))
+    import app
+    import stream_compare
+    # Notes when the streamed diff has sent its last chunk
+    finished = []
+    stream_diff = stream_compare.stream_diff
+
+    def tracked_stream_diff(*args, **kwargs):
+        for chunk in stream_diff(*args, **kwargs):
+            yield chunk
+        finished.append(True)
+
+    stream_compare.stream_diff = tracked_stream_diff
+    client = app.app.test_client()
+    before = peak_rss_mb(os.getpid())
+    reset_peak_rss(os.getpid())
+    start = time.perf_counter()
+    with open(path, 'rb') as body:
+        response = client.open(endpoint, method='POST', input_stream=body, content_type='application/json',
+                               content_length=os.path.getsize(path), buffered=False)
+        chunks = iter(response.response)
+        first = next(chunks, b'')
+        first_byte = time.perf_counter() - start
+        streamed = not finished
+        size = len(first) + sum(len(chunk) for chunk in chunks)
+        response.close()
+    return {
+        'status': response.status_code,
+        'seconds': time.perf_counter() - start,
+        'first_byte_seconds': first_byte,
+        'streamed': streamed,
+        'response_bytes': size,
+        'rss_before_mb': before,
+        'peak_rss_mb': peak_rss_mb(os.getpid()),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--fields', type=int, default=10000)
+    parser.add_argument('--rules', type=int, default=10)
+    parser.add_argument('--edits', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--measure', nargs=2, metavar=('BODY', 'ENDPOINT'), help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.measure:
+        print(json.dumps(measure(*args.measure)))
+        return 0
+
+    fd, path = tempfile.mkstemp(suffix='.json')
+    os.close(fd)
+    try:
+        write_body(path, args.fields, args.rules, args.edits, args.seed)
+        print('%d fields, %.1f MB body' % (args.fields, os.path.getsize(path) / 1024.0 / 1024))
+        print('%-18s %6s %9s %12s %12s %12s' % ('endpoint', 'status', 'seconds', 'first byte s', 'peak MB',
+                                                  'response KB'))
+        buffered = False
+        for endpoint in ENDPOINTS:
+            output = subprocess.check_output([sys.executable, '-m', 'benchmarks.stream_memory', '--measure', path, endpoint])
+            result = json.loads(output.decode().strip().splitlines()[-1])
+            print('%-18s %6d %9.2f %12.2f %12s %12.1f' % (endpoint, result['status'], result['seconds'],
+                                                          result['first_byte_seconds'],
+                                                          '-' if result['peak_rss_mb'] is None else '%.1f' % result['peak_rss_mb'],
+                                                          result['response_bytes'] / 1024.0))
+            if endpoint == '/compare/stream' and result['status'] == 200 and not result['streamed']:
+                buffered = True
+        if buffered:
+            print('/compare/stream was diffed to the end before its first byte was sent')
+            return 1
+    finally:
+        os.remove(path)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
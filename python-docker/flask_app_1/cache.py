@@ -0,0 +1,183 @@
+# Result cache for /compare.
+#
+# The editor posts the same original/modified pair over and over (autosave, tab
+# switches, retries). Results are stored as the serialised response body, keyed by a
+# hash of the canonicalised request, and evicted least recently used first once the
+# cache holds too many entries or bytes. The key doubles as the response ETag.
+#
+# Configured from the environment:
+#   COMPARE_CACHE          memory (default), sqlite or off
+#   COMPARE_CACHE_ENTRIES  max entries (default 256)
+#   COMPARE_CACHE_BYTES    max total size of the stored bodies (default 64MB)
+#   COMPARE_CACHE_PATH     sqlite file, shared by every worker that points at it
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# Bump when a change to the diff code changes responses, so old entries and
+# ETags stop matching
+KEY_VERSION = '2'
+
+
+def structure_digest(structure):
+    # Hash of the canonicalised structure, key order doesn't matter
+    return hashlib.sha256(json.dumps(structure, sort_keys=True, separators=(',', ':')).encode()).hexdigest()
+
+
+def cache_key(original_digest, modified_digest, *options):
+    digest = hashlib.sha256(KEY_VERSION.encode())
+    for part in (original_digest, modified_digest) + options:
+        digest.update(b'\0')
+        digest.update(str(part).encode())
+    return digest.hexdigest()
+
+
+class MemoryBackend(object):
+    # In-process LRU, one per worker
+
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        # Returns how many entries were evicted to make room
+        evicted = 0
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.bytes -= len(old)
+            self.entries[key] = value
+            self.bytes += len(value)
+            while self.entries and (len(self.entries) > self.max_entries or self.bytes > self.max_bytes):
+                _, dropped = self.entries.popitem(last=False)
+                self.bytes -= len(dropped)
+                evicted += 1
+        return evicted
+
+    def size(self):
+        with self.lock:
+            return len(self.entries), self.bytes
+
+
+class SQLiteBackend(object):
+    # LRU in a local SQLite file, shared by all workers on the host
+
+    def __init__(self, path, max_entries, max_bytes):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.local = threading.local()
+        db = self.connection()
+        db.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value BLOB, size INTEGER, used REAL)')
+        db.execute('CREATE INDEX IF NOT EXISTS results_used ON results (used)')
+
+    def connection(self):
+        # sqlite3 connections can't be shared between threads
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self.local.db = db
+        return db
+
+    def get(self, key):
+        db = self.connection()
+        row = db.execute('SELECT value FROM results WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        db.execute('UPDATE results SET used = ? WHERE key = ?', (time.time(), key))
+        return bytes(row[0])
+
+    def set(self, key, value):
+        db = self.connection()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.execute('INSERT OR REPLACE INTO results (key, value, size, used) VALUES (?, ?, ?, ?)',
+                       (key, sqlite3.Binary(value), len(value), time.time()))
+            count, total = db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results').fetchone()
+            evicted = 0
+            if count > self.max_entries or total > self.max_bytes:
+                for old_key, size in db.execute('SELECT key, size FROM results ORDER BY used').fetchall():
+                    if count <= self.max_entries and total <= self.max_bytes:
+                        break
+                    db.execute('DELETE FROM results WHERE key = ?', (old_key,))
+                    count -= 1
+                    total -= size
+                    evicted += 1
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+        return evicted
+
+    def size(self):
+        count, total = self.connection().execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results').fetchone()
+        return count, total
+
+
+class ResultCache(object):
+    # Wraps a backend with hit/miss/eviction counters (per worker)
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        value = self.backend.get(key)
+        with self.lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key, value):
+        if len(value) > self.backend.max_bytes:
+            return
+        evicted = self.backend.set(key, value)
+        with self.lock:
+            self.evictions += evicted
+
+    def stats(self):
+        entries, size = self.backend.size()
+        with self.lock:
+            return {
+                'backend': type(self.backend).__name__,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': entries,
+                'bytes': size,
+            }
+
+
+def from_env():
+    kind = os.environ.get('COMPARE_CACHE', 'memory')
+    max_entries = int(os.environ.get('COMPARE_CACHE_ENTRIES', 256))
+    max_bytes = int(os.environ.get('COMPARE_CACHE_BYTES', 64 * 1024 * 1024))
+    if kind == 'off':
+        return None
+    if kind == 'memory':
+        return ResultCache(MemoryBackend(max_entries, max_bytes))
+    if kind == 'sqlite':
+        path = os.environ.get('COMPARE_CACHE_PATH', '/tmp/compare-cache.sqlite3')
+        return ResultCache(SQLiteBackend(path, max_entries, max_bytes))
+    raise ValueError('Unknown COMPARE_CACHE backend {}'.format(kind))
@@ -0,0 +1,201 @@
+# JSON codec and HTTP compression for the compare service.
+#
+# Big forms make for multi-MB request and response bodies, so:
+# - JSON is parsed and serialised with orjson when it's installed (COMPARE_JSON=auto,
+#   the default), or always with the stdlib (COMPARE_JSON=json)
+# - request bodies may be sent with Content-Encoding gzip, deflate or zstd
+# - responses are compressed with zstd or gzip when the client's Accept-Encoding
+#   allows it and the body is at least COMPARE_COMPRESS_MIN_BYTES (default 1024)
+#
+# zstd needs the optional zstandard package. COMPARE_MAX_BODY_BYTES (default 256MB)
+# caps how large a request body may get once decompressed. Decompressed bodies over
+# COMPARE_SPOOL_BYTES (default 16MB) are spooled to a temporary file.
+import gzip
+import io
+import json
+import os
+import tempfile
+import zlib
+
+from flask.json.provider import JSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CODEC = os.environ.get('COMPARE_JSON', 'auto')
+USE_ORJSON = orjson is not None and CODEC in ('auto', 'orjson')
+if CODEC == 'orjson' and orjson is None:
+    raise ImportError('COMPARE_JSON=orjson but orjson is not installed')
+
+COMPRESS_MIN_BYTES = int(os.environ.get('COMPARE_COMPRESS_MIN_BYTES', 1024))
+GZIP_LEVEL = int(os.environ.get('COMPARE_GZIP_LEVEL', 5))
+ZSTD_LEVEL = int(os.environ.get('COMPARE_ZSTD_LEVEL', 3))
+MAX_BODY_BYTES = int(os.environ.get('COMPARE_MAX_BODY_BYTES', 256 * 1024 * 1024))
+SPOOL_BYTES = int(os.environ.get('COMPARE_SPOOL_BYTES', 16 * 1024 * 1024))
+
+# Compressed response types, most preferred first
+RESPONSE_ENCODINGS = (('zstd', 'gzip') if zstandard else ('gzip',))
+_COMPRESSIBLE = ('application/json', 'application/x-ndjson')
+
+
+def dumps_bytes(obj):
+    # Compact, sorted keys - the same output shape as Flask's default provider
+    if USE_ORJSON:
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS)
+        except TypeError:
+            # e.g. integers wider than 64 bits
+            pass
+    return json.dumps(obj, sort_keys=True, separators=(',', ':')).encode()
+
+
+def body_bytes(obj):
+    # A JSON response body, as FastJSONProvider.response() sends it
+    return dumps_bytes(obj) + b'\n'
+
+
+def loads(data):
+    if USE_ORJSON:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+class FastJSONProvider(JSONProvider):
+    # Used for request.json, jsonify and app.json
+
+    mimetype = 'application/json'
+
+    def dumps(self, obj, **kwargs):
+        return dumps_bytes(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(body_bytes(obj), mimetype=self.mimetype)
+
+
+class UnsupportedEncoding(ValueError):
+    pass
+
+
+class BodyTooLarge(ValueError):
+    pass
+
+
+def decompress(data, encoding):
+    # Returns (file, size) - the decompressed body, in memory up to SPOOL_BYTES and in
+    # a temporary file past that. Raises UnsupportedEncoding, BodyTooLarge (over
+    # MAX_BODY_BYTES once decompressed) or ValueError for a corrupt body.
+    if encoding == 'gzip' or encoding == 'x-gzip':
+        stream = gzip.GzipFile(fileobj=io.BytesIO(data))
+    elif encoding == 'deflate':
+        stream = _ZlibReader(data)
+    elif encoding == 'zstd':
+        if zstandard is None:
+            raise UnsupportedEncoding('zstd request bodies need the zstandard package')
+        stream = zstandard.ZstdDecompressor().stream_reader(io.BytesIO(data))
+    else:
+        raise UnsupportedEncoding('Unsupported Content-Encoding {}'.format(encoding))
+    body = tempfile.SpooledTemporaryFile(max_size=SPOOL_BYTES)
+    try:
+        size = _copy_limited(stream, body, MAX_BODY_BYTES + 1)
+    except (OSError, EOFError, zlib.error) as e:
+        raise ValueError('Could not decompress request body: {}'.format(e))
+    except Exception as e:
+        if zstandard is not None and isinstance(e, zstandard.ZstdError):
+            raise ValueError('Could not decompress request body: {}'.format(e))
+        raise
+    if size > MAX_BODY_BYTES:
+        raise BodyTooLarge('Request body is larger than COMPARE_MAX_BODY_BYTES once decompressed')
+    body.seek(0)
+    return body, size
+
+
+def _copy_limited(stream, out, limit):
+    size = 0
+    while size < limit:
+        chunk = stream.read(min(1024 * 1024, limit - size))
+        if not chunk:
+            break
+        out.write(chunk)
+        size += len(chunk)
+    return size
+
+
+class _ZlibReader(object):
+
+    def __init__(self, data):
+        self.data = data
+        self.decompressor = zlib.decompressobj()
+
+    def read(self, limit):
+        while not self.decompressor.eof:
+            if not self.data:
+                raise zlib.error('truncated deflate stream')
+            chunk = self.decompressor.decompress(self.data, limit)
+            self.data = self.decompressor.unconsumed_tail
+            if chunk:
+                return chunk
+        return b''
+
+
+class DecompressRequestMiddleware(object):
+    # WSGI middleware that swaps a compressed request body for the plain one, so
+    # Flask's request.json never sees the encoding
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        encoding = environ.get('HTTP_CONTENT_ENCODING', '').strip().lower()
+        if encoding and encoding != 'identity':
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+            try:
+                if length > MAX_BODY_BYTES:
+                    raise BodyTooLarge('Request body is larger than COMPARE_MAX_BODY_BYTES')
+                body, size = decompress(environ['wsgi.input'].read(length), encoding)
+            except ValueError as e:
+                if isinstance(e, UnsupportedEncoding):
+                    status = '415 Unsupported Media Type'
+                elif isinstance(e, BodyTooLarge):
+                    status = '413 Request Entity Too Large'
+                else:
+                    status = '400 Bad Request'
+                error = json.dumps({ 'error': str(e) }).encode()
+                start_response(status, [('Content-Type', 'application/json'), ('Content-Length', str(len(error))),
+                                        ('Access-Control-Allow-Origin', '*')])
+                return [error]
+            environ['wsgi.input'] = body
+            environ['CONTENT_LENGTH'] = str(size)
+            del environ['HTTP_CONTENT_ENCODING']
+        return self.wsgi_app(environ, start_response)
+
+
+def compress_response(response, accept_encoding):
+    # after_request hook body: compress a finished JSON response if the client accepts it
+    if (response.direct_passthrough or response.is_streamed or response.status_code != 200
+            or response.mimetype not in _COMPRESSIBLE or 'Content-Encoding' in response.headers):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = next((name for name in RESPONSE_ENCODINGS if accept_encoding[name]), None)
+    if encoding is None:
+        return response
+    body = response.get_data()
+    if len(body) < COMPRESS_MIN_BYTES:
+        return response
+    if encoding == 'zstd':
+        body = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(body)
+    else:
+        body = gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+    response.set_data(body)
+    response.headers['Content-Encoding'] = encoding
+    return response
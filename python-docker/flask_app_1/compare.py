@@ -0,0 +1,416 @@
+# Turn a diff of two form structures into the /compare response.
+#
+# An engine produces a stream of paths.Change items grouped the way DeepDiff reports them
+# (dictionary_item_added, values_changed, ...). classify() then files each change
+# under the field it belongs to, so every engine returns the same fieldChanges schema.
+# With format=patch, patch.py turns the changes into a JSON Patch instead.
+import os
+
+from deepdiff import DeepDiff
+
+import distance
+import field_diff
+import form_index
+import patch
+import paths
+import spans
+
+DEFAULT_ENGINE = os.environ.get('COMPARE_ENGINE', 'deepdiff')
+# Unset means the engine's own default, see ENGINE_DISTANCES
+DEFAULT_DISTANCE = os.environ.get('COMPARE_DISTANCE')
+# How rules are lined up, see field_diff.RULE_ALIGNMENTS
+DEFAULT_RULE_ALIGNMENT = os.environ.get('COMPARE_RULE_ALIGNMENT')
+
+# Response formats
+CHANGES = 'changes'  # fieldChanges, grouped by field (default)
+PATCH = 'patch'      # RFC 6902 JSON Patch, see patch.py
+FORMATS = (CHANGES, PATCH)
+
+
+class CompareOptionError(ValueError):
+    pass
+
+
+def deepdiff_changes(original_structure, modified_structure, distance_mode=distance.EXACT, original_index=None, modified_index=None,
+                     rule_alignment=field_diff.INDEX):
+    if rule_alignment != field_diff.INDEX:
+        raise ValueError('DeepDiff compares rules by position only')
+    # Skip over changes in FIELD UUID { fields: 0: { uuid: 123-6543-2332 } } --- root['fields']['0']['uuid']
+    def exclude_obj_callback(obj, path):
+        return paths.is_field_uuid(path)
+
+    diff_original, diff_modified = original_structure, modified_structure
+    if distance_mode != distance.EXACT:
+        # The deep distance needs all of both structures, anything else only needs what changed
+        with spans.stage('prune'):
+            diff_original, diff_modified = prune_unchanged(original_structure, modified_structure,
+                                                           original_index or form_index.FormIndex(original_structure),
+                                                           modified_index or form_index.FormIndex(modified_structure))
+
+    diff = DeepDiff(diff_original, diff_modified, view='tree', get_deep_distance=distance_mode == distance.EXACT, exclude_obj_callback=exclude_obj_callback)
+
+    changes = {}
+    for report_type in paths.REPORT_TYPES:
+        changes[report_type] = []
+        # Just get the changes from the diff object in a tree structure so we can traverse/manipulate it
+        for level in diff.get(report_type) or []:
+            path = level.path()
+            changes[report_type].append(paths.Change(path, paths.parse_path(path), level.t1, level.t2))
+
+    if distance_mode == distance.EXACT:
+        return changes, diff.get('deep_distance') or 0
+    if distance_mode == distance.APPROXIMATE:
+        with spans.stage('distance'):
+            return changes, distance.approximate_distance(changes, original_structure, modified_structure)
+    return changes, None
+
+
+def prune_unchanged(original_structure, modified_structure, original_index, modified_index):
+    # Copies of both structures with every field, properties block and rule that is
+    # the same on both sides swapped for {} - DeepDiff compares two empty dicts for
+    # free. Keys and list lengths are kept, so DeepDiff's own heuristics (key overlap,
+    # pairing list items) see the same shape and report the same changes. Nothing is
+    # pruned below a node DeepDiff could report as a whole.
+    original_fields = original_index.fields
+    modified_fields = modified_index.fields
+    if (not original_fields or not modified_fields or field_diff.too_different(original_structure, modified_structure, ())
+            or field_diff.too_different(original_fields, modified_fields, ())):
+        return original_structure, modified_structure
+    pruned_original = dict(original_fields)
+    pruned_modified = dict(modified_fields)
+    for key, field in original_fields.items():
+        if key not in modified_index.field_hashes or key not in original_index.field_hashes:
+            continue
+        other = modified_fields[key]
+        if original_index.field_hash(key) == modified_index.field_hash(key):
+            pruned_original[key] = {}
+            pruned_modified[key] = {}
+        elif (type(field) is dict and type(other) is dict and not field_diff.too_different(field, other, ())
+                and not field_diff.too_different(field, other, ('uuid',))):
+            pruned_original[key], pruned_modified[key] = _prune_field(key, field, other, original_index, modified_index)
+    pruned_original_structure = dict(original_structure)
+    pruned_original_structure['fields'] = pruned_original
+    pruned_modified_structure = dict(modified_structure)
+    pruned_modified_structure['fields'] = pruned_modified
+    return pruned_original_structure, pruned_modified_structure
+
+
+def _prune_field(key, field, other, original_index, modified_index):
+    field = dict(field)
+    other = dict(other)
+    if type(field.get('properties')) is dict and type(other.get('properties')) is dict:
+        if original_index.properties_hash(key) == modified_index.properties_hash(key):
+            field['properties'] = {}
+            other['properties'] = {}
+    rules = field.get('rules')
+    other_rules = other.get('rules')
+    # Only lists DeepDiff compares item by item, lists of plain values get aligned
+    if type(rules) is list and type(other_rules) is list and not _basic_list(rules) and not _basic_list(other_rules):
+        original_hashes = original_index.rule_hashes(key)
+        modified_hashes = modified_index.rule_hashes(key)
+        rules = list(rules)
+        other_rules = list(other_rules)
+        for rule_index in range(min(len(rules), len(other_rules))):
+            if original_hashes[rule_index] == modified_hashes[rule_index]:
+                rules[rule_index] = {}
+                other_rules[rule_index] = {}
+        field['rules'] = rules
+        other['rules'] = other_rules
+    return field, other
+
+
+def _basic_list(items):
+    return all(isinstance(item, form_index.BASIC_TYPES) for item in items)
+
+
+ENGINES = {
+    'deepdiff': deepdiff_changes,
+    'fields': field_diff.diff_structures,
+}
+
+# Distance modes each engine supports, the first one is its default
+ENGINE_DISTANCES = {
+    'deepdiff': (distance.EXACT, distance.APPROXIMATE, distance.NONE),
+    'fields': (distance.APPROXIMATE, distance.NONE),
+}
+
+# Rule alignments each engine supports
+ENGINE_RULE_ALIGNMENTS = {
+    'deepdiff': (field_diff.INDEX,),
+    'fields': field_diff.RULE_ALIGNMENTS,
+}
+
+
+def resolve_options(engine=None, distance_mode=None):
+    # Fill in defaults and check the combination, returns (engine, distance_mode)
+    engine = engine or DEFAULT_ENGINE
+    if engine not in ENGINES:
+        raise CompareOptionError('Unknown engine {}'.format(engine))
+    distance_mode = distance_mode or DEFAULT_DISTANCE or ENGINE_DISTANCES[engine][0]
+    if distance_mode not in ENGINE_DISTANCES[engine]:
+        raise CompareOptionError('Distance {} is not supported by the {} engine'.format(distance_mode, engine))
+    return engine, distance_mode
+
+
+def resolve_rule_alignment(engine, rule_alignment=None):
+    # engine as returned by resolve_options()
+    rule_alignment = rule_alignment or DEFAULT_RULE_ALIGNMENT or field_diff.INDEX
+    if rule_alignment not in ENGINE_RULE_ALIGNMENTS[engine]:
+        raise CompareOptionError('Rule alignment {} is not supported by the {} engine'.format(rule_alignment, engine))
+    return rule_alignment
+
+
+def resolve_format(output_format=None, old_values=None):
+    # Returns (output_format, old_values). old_values may come from a query string.
+    output_format = output_format or CHANGES
+    if output_format not in FORMATS:
+        raise CompareOptionError('Unknown format {}'.format(output_format))
+    if old_values is None:
+        return output_format, True
+    if isinstance(old_values, str):
+        if old_values.lower() not in ('true', 'false', '1', '0'):
+            raise CompareOptionError('old_values must be true or false')
+        return output_format, old_values.lower() in ('true', '1')
+    return output_format, bool(old_values)
+
+
+# original_index: form_index.FormIndex of the original, if the caller already has it
+# old_values: whether a patch tests the old values before changing them
+# run_pairs: where the fields engine diffs the fields it paired up, see field_diff.diff_structures.
+#   Other engines run as usual.
+def compare_structures(original_structure, modified_structure, engine=None, distance_mode=None, original_index=None,
+                       output_format=None, old_values=None, rule_alignment=None, run_pairs=None):
+    engine, distance_mode = resolve_options(engine, distance_mode)
+    rule_alignment = resolve_rule_alignment(engine, rule_alignment)
+    output_format, old_values = resolve_format(output_format, old_values)
+    with spans.stage('diff'):
+        if engine == 'fields' and run_pairs is not None:
+            changes, change_distance = field_diff.diff_structures(original_structure, modified_structure, distance_mode, original_index,
+                                                                  rule_alignment=rule_alignment, run_pairs=run_pairs)
+        else:
+            changes, change_distance = ENGINES[engine](original_structure, modified_structure, distance_mode, original_index,
+                                                       rule_alignment=rule_alignment)
+    spans.count('diff_items', { report_type: len(changes[report_type]) for report_type in paths.REPORT_TYPES })
+    if change_distance is not None:
+        change_distance = round(change_distance * 100, 2)
+    if output_format == PATCH:
+        with spans.stage('patch'):
+            # The fields engine pairs fields up by fieldId, even when they changed key
+            moves = field_diff.field_moves(original_structure, modified_structure, original_index) if engine == 'fields' else ()
+            field_keys = set(original_structure.get('fields') or ()) | set(modified_structure.get('fields') or ())
+            operations = patch.patch_operations(changes, old_values, moves, field_keys)
+        return { 'patch': operations, 'changeDistance': change_distance }
+    with spans.stage('classify'):
+        field_changes, form_changes, removed_fields, added_fields = classify(changes, original_structure, modified_structure)
+    spans.count('fields_touched', len(field_changes))
+    return { 'fieldChanges': field_changes, 'changeDistance': change_distance }
+
+
+def classify(changes, original_structure, modified_structure):
+    field_changes = {}
+    form_changes = {}
+    removed_fields = []
+    added_fields = []
+
+    dic_items_added = changes['dictionary_item_added']
+    dic_items_removed = changes['dictionary_item_removed']
+    dic_items_changed = changes['values_changed']
+    arr_items_added = changes['iterable_item_added']
+    arr_items_removed = changes['iterable_item_removed']
+    types_changed = changes['type_changes']
+    arr_items_moved = changes['iterable_item_moved']
+
+    # if its not in the original structure, its in the modified one
+    def getField(f_index):
+        try:
+            return original_structure['fields'][f_index]
+        except:
+            return modified_structure['fields'][f_index]
+
+
+    def populate_field_changes_object(f_index):
+        field = getField(f_index)
+        field_changes[f_index] = {
+            'name': field.get('name'),
+            'fieldType': field.get('fieldType'),
+            'index': f_index,
+            'fieldId': field.get('fieldId')
+        }
+
+    def getRule(r_index, f_index):
+        field = getField(f_index)
+        rule_index = int(r_index)
+        return field['rules'][rule_index]
+
+    # Added iterable Items
+    for arr_add in arr_items_added:
+        path = arr_add.path
+        path_info = arr_add.info
+        # Check if it's a form field value
+        if (path_info.kind != paths.FORM):
+            field_index = path_info.field_index
+            # Populate some useful field info into field_changes object
+            if field_index not in field_changes:
+                populate_field_changes_object(field_index)
+            if (path_info.kind == paths.RULE):
+                # Add a addedRules arr if the field does not have it
+                if ('addedRules' not in field_changes[field_index]):
+                    field_changes[field_index]['addedRules'] = []
+                field_changes[field_index]['addedRules'].append({ 'ruleIndex': path_info.rule_index, 'rule': arr_add.t2 })
+            else:
+                # Not a rule? Add it to 'iterableAdded'
+                if ('iterableAdded' not in field_changes[field_index]):
+                    field_changes[field_index]['iterableAdded'] = []
+                # No match we found in field setting, field properties, field rules - return to the client the full path
+                field_changes[field_index]['iterableAdded'].append({ 'propertyName': path, 'value': arr_add.t2, 'action': 'ADDED', 'pathArray': paths.path_array(path) })
+        else:
+            # This is a form setting
+            if ('iterableAdded' not in form_changes):
+                form_changes['iterableAdded'] = []
+            form_changes['iterableAdded'].append({ 'propertyName': path, 'value': arr_add.t2, 'pathArray': paths.path_array(path) })
+
+    # Removed iterable Items
+    for arr_remove in arr_items_removed:
+        path = arr_remove.path
+        path_info = arr_remove.info
+        # Check if it's a form field value
+        if (path_info.kind != paths.FORM):
+            field_index = path_info.field_index
+            # Populate some useful field info into field_changes object
+            if field_index not in field_changes:
+                populate_field_changes_object(field_index)
+            if (path_info.kind == paths.RULE):
+                # Add a removedRules arr if the field does not have it
+                if ('removedRules' not in field_changes[field_index]):
+                    field_changes[field_index]['removedRules'] = []
+                field_changes[field_index]['removedRules'].append({ 'ruleIndex': path_info.rule_index, 'rule': arr_remove.t1 })
+            else:
+                # Could not parse rules? add it to iterableRemoved
+                if ('iterableRemoved' not in field_changes[field_index]):
+                    field_changes[field_index]['iterableRemoved'] = []
+                # No match we found in field setting, field properties, field rules - return to the client the full path
+                field_changes[field_index]['iterableRemoved'].append({ 'propertyName': path, 'value': arr_remove.t1, 'action': 'REMOVED', 'pathArray': paths.path_array(path) })
+        else:
+            # This is a form setting
+            if ('iterableRemoved' not in form_changes):
+                form_changes['iterableRemoved'] = []
+            form_changes['iterableRemoved'].append({ 'propertyName': path, 'value': arr_remove.t1, 'pathArray': paths.path_array(path) })
+
+    # Moved iterable Items - only rules are moved, see field_diff.CONTENT
+    for arr_move in arr_items_moved:
+        path_info = arr_move.info
+        field_index = path_info.field_index
+        if field_index not in field_changes:
+            populate_field_changes_object(field_index)
+        if ('movedRules' not in field_changes[field_index]):
+            field_changes[field_index]['movedRules'] = []
+        rule = arr_move.t2
+        field_changes[field_index]['movedRules'].append({
+            'ruleIndex': path_info.rule_index,
+            'newIndex': paths.parse_path(arr_move.new_path).rule_index,
+            'type': rule.get('type') if isinstance(rule, dict) else None,
+        })
+
+    # Removed Field Properties
+    for remove in dic_items_removed:
+        path = remove.path
+        path_info = remove.info
+        # Check if it's a form field value
+        if (path_info.kind != paths.FORM):
+            field_index = path_info.field_index
+            # First things first -- check if the entire field was removed
+            if (path_info.kind == paths.FIELD):
+                field = remove.t1
+                removed_fields.append({ 'name': field.get('name'), 'fieldType': field.get('fieldType'), 'index': field_index, 'fieldId': field.get('fieldId') })
+            else:
+                # Populate some useful field info into field_changes object
+                if field_index not in field_changes:
+                    populate_field_changes_object(field_index)
+                # Add a removedProperties arr if the field does not have it
+                if ('removedProperties' not in field_changes[field_index]):
+                    field_changes[field_index]['removedProperties'] = []
+                if (path_info.kind in (paths.SETTING, paths.PROPERTY)):
+                    # can be a top level field setting or a setting inside 'properties'
+                    field_changes[field_index]['removedProperties'].append({ 'propertyName': path_info.name })
+                else:
+                    # No match we found in field setting, field properties, field rules - return to the client the full path
+                    field_changes[field_index]['removedProperties'].append({ 'propertyName': path, 'pathArray': paths.path_array(path) })
+        else:
+            # This is a form setting
+            if ('removedProperties' not in form_changes):
+                form_changes['removedProperties'] = []
+            form_changes['removedProperties'].append({ 'propertyName': path, 'pathArray': paths.path_array(path) })
+
+    # Added Field Properties
+    for add in dic_items_added:
+        path = add.path
+        path_info = add.info
+        # Check if it's a form field value
+        if (path_info.kind != paths.FORM):
+            field_index = path_info.field_index
+            # First things first -- check if an entire field was added
+            if (path_info.kind == paths.FIELD):
+                field = add.t2
+                added_fields.append({ 'name': field.get('name'), 'fieldType': field.get('fieldType'), 'index': field_index, 'fieldId': field.get('fieldId') })
+            else:
+                # Populate some useful field info into field_changes object
+                if field_index not in field_changes:
+                    populate_field_changes_object(field_index)
+                # Add a addedProperties arr if the field does not have it
+                if ('addedProperties' not in field_changes[field_index]):
+                    field_changes[field_index]['addedProperties'] = [] 
+                if (path_info.kind in (paths.SETTING, paths.PROPERTY)):
+                    # can be a top level field setting or a setting inside 'properties'
+                    field_changes[field_index]['addedProperties'].append({ 'propertyName': path_info.name })
+                else:
+                    # No match we found in field setting, field properties, field rules - return to the client the full path
+                    field_changes[field_index]['addedProperties'].append({ 'propertyName': path, 'pathArray': paths.path_array(path) })
+        else:
+            # This is a form setting
+            if ('addedProperties' not in form_changes):
+                form_changes['addedProperties'] = []
+            form_changes['addedProperties'].append({ 'propertyName': path, 'pathArray': paths.path_array(path) })
+
+    # Changed Field Properties - value changes and type changes are reported the same way
+    for group in (dic_items_changed, types_changed):
+        for change in group:
+            path = change.path
+            path_info = change.info
+            # Check if it's a form field value
+            if (path_info.kind != paths.FORM):
+                field_index = path_info.field_index
+                # Populate some useful field info into field_changes object
+                if field_index not in field_changes:
+                    populate_field_changes_object(field_index)
+                # Add a changedProperties arr if the field does not have it
+                if ('changedProperties' not in field_changes[field_index]):
+                    field_changes[field_index]['changedProperties'] = [] 
+                if (path_info.kind in (paths.SETTING, paths.PROPERTY)):
+                    # can be a top level field setting or a setting inside 'properties'
+                    field_changes[field_index]['changedProperties'].append({ 'propertyName': path_info.name, 'oldValue': change.t1, 'newValue': change.t2 })
+                elif (path_info.kind == paths.RULE_SETTING):
+                    # Add a changedRules arr if the field does not have it
+                    if ('changedRules' not in field_changes[field_index]):
+                        field_changes[field_index]['changedRules'] = {}
+                    # Get the rule details
+                    rule_index = path_info.rule_index
+                    if (rule_index not in field_changes[field_index]['changedRules']):
+                        rule = getRule(rule_index, field_index)
+                        field_changes[field_index]['changedRules'][rule_index] = {
+                            'ruleIndex': rule_index,
+                            'type': rule.get('type'),
+                            'changedProperties': [],
+                            'addedProperties': [],
+                            'removedProperties': [],
+                        }
+                    field_changes[field_index]['changedRules'][rule_index]['changedProperties'].append({ 'propertyName': path_info.name, 'oldValue': change.t1, 'newValue': change.t2 })
+                else:
+                    # No match we found in field setting, field properties, field rules - return to the client the full path
+                    field_changes[field_index]['changedProperties'].append({ 'propertyName': path, 'oldValue': change.t1, 'newValue': change.t2, 'pathArray': paths.path_array(path) })
+            else:
+                # This is a form setting
+                if ('changedProperties' not in form_changes):
+                    form_changes['changedProperties'] = []
+                form_changes['changedProperties'].append({ 'propertyName': path, 'oldValue': change.t1, 'newValue': change.t2, 'pathArray': paths.path_array(path) })
+
+    return field_changes, form_changes, removed_fields, added_fields
@@ -0,0 +1,39 @@
+# changeDistance modes for /compare.
+#
+# exact       - DeepDiff's deep distance (deepdiff engine only). Hashes the whole of
+#               both structures, so it is the expensive part of a DeepDiff compare.
+# approximate - changed leaves / total leaves of both structures, in [0, 1]
+# none        - not computed, changeDistance comes back as null
+from deepdiff.helper import notpresent
+
+EXACT = 'exact'
+APPROXIMATE = 'approximate'
+NONE = 'none'
+
+MODES = (EXACT, APPROXIMATE, NONE)
+
+
+def count_leaves(obj):
+    # Scalars and empty containers count as one leaf, a missing value as none
+    if obj is notpresent:
+        return 0
+    if isinstance(obj, dict):
+        return sum(count_leaves(value) for value in obj.values()) or 1
+    if isinstance(obj, list):
+        return sum(count_leaves(value) for value in obj) or 1
+    return 1
+
+
+def leaf_ratio(changed_leaves, total_leaves):
+    if not total_leaves:
+        return 0
+    return min(1.0, changed_leaves / total_leaves)
+
+
+def approximate_distance(changes, original_structure, modified_structure):
+    # For engines that can't count leaves while they diff
+    changed_leaves = 0
+    for report_type in changes:
+        for change in changes[report_type]:
+            changed_leaves += count_leaves(change.t1) + count_leaves(change.t2)
+    return leaf_ratio(changed_leaves, count_leaves(original_structure) + count_leaves(modified_structure))
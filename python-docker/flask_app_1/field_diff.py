@@ -0,0 +1,406 @@
+# Field-aware diff engine for /compare (engine='fields').
+#
+# DeepDiff walks the whole form generically and we then work out which field a
+# change belongs to from its path. Forms have a known shape though - a 'fields' dict
+# of { fieldId, name, fieldType, properties, rules } - so this engine matches fields
+# by fieldId through a dict, diffs 'properties' and 'rules' directly and emits the
+# same paths.Change stream as compare.deepdiff_changes, in one linear pass.
+#
+# Differences from the DeepDiff engine:
+# - a field that moved to another index is matched by its fieldId and reported under
+#   its original index, instead of as a cascade of changes
+# - 'fields' is always diffed field by field; DeepDiff reports the whole dict as one
+#   changed value when under a third of the indexes are in both forms
+# - only the approximate changeDistance is available, counted during the walk
+# - entries inside one list of the response can come out in a different order
+# - with rule_alignment=content, rules are lined up by ruleId or content instead of
+#   by position, see _Walker.align_rules()
+#
+# Fields, properties blocks and rules whose form_index hashes match are skipped
+# without being walked. The fields paired up by fieldId can be diffed elsewhere, a
+# slice at a time (run_pairs, see serving.py), and the results merged back in order.
+import difflib
+
+from deepdiff.helper import notpresent
+
+import distance
+import form_index
+import paths
+
+# How the rules of a field are lined up
+INDEX = 'index'      # by position, like DeepDiff (default)
+CONTENT = 'content'  # by ruleId or content, so an inserted or moved rule is one change
+RULE_ALIGNMENTS = (INDEX, CONTENT)
+
+
+class _Walker(object):
+
+    def __init__(self, original_index, modified_index, rule_alignment=INDEX, run_pairs=None):
+        self.original_index = original_index
+        self.modified_index = modified_index
+        self.rule_alignment = rule_alignment
+        self.run_pairs = run_pairs
+        self.changes = {report_type: [] for report_type in paths.REPORT_TYPES}
+        self.changed_leaves = 0
+        self.total_leaves = 0
+
+    def report(self, report_type, path, info, t1, t2):
+        self.changes[report_type].append(paths.Change(path, info, t1, t2))
+        leaves = distance.count_leaves(t1) + distance.count_leaves(t2)
+        self.changed_leaves += leaves
+        self.total_leaves += leaves
+
+    def report_move(self, path, new_path, info, t1, t2):
+        # A move changes where the item is, one leaf on each side. Changes to the item
+        # itself are reported on their own.
+        self.changes['iterable_item_moved'].append(paths.Change(path, info, t1, t2, new_path))
+        self.changed_leaves += 2
+        self.total_leaves += 2
+
+    def merge(self, changes, changed_leaves, total_leaves):
+        # Adds the results of a walk over the next part of the structure
+        for report_type in paths.REPORT_TYPES:
+            self.changes[report_type].extend(changes[report_type])
+        self.changed_leaves += changed_leaves
+        self.total_leaves += total_leaves
+
+    def unchanged(self, t1, t2):
+        self.total_leaves += distance.count_leaves(t1) + distance.count_leaves(t2)
+
+    # info is the PathInfo reported for this node, child_info the one for anything below it
+    def diff(self, t1, t2, path, info, child_info):
+        if t1 is t2:
+            self.unchanged(t1, t2)
+        elif type(t1) is not type(t2):
+            self.report('type_changes', path, info, t1, t2)
+        elif isinstance(t1, dict):
+            self.diff_dict(t1, t2, path, info, lambda key: child_info, child_info)
+        elif isinstance(t1, list):
+            self.diff_list(t1, t2, path, lambda index: child_info, child_info)
+        elif t1 != t2:
+            self.report('values_changed', path, info, t1, t2)
+        else:
+            self.unchanged(t1, t2)
+
+    # Keys in skip are ignored altogether, keys in handled are left to the caller
+    def diff_dict(self, t1, t2, path, info, key_info, child_info, skip=(), handled=()):
+        if not t1 and not t2:
+            self.unchanged(t1, t2)
+            return
+        if too_different(t1, t2, skip):
+            self.report('values_changed', path, info, t1, t2)
+            return
+        for key, value in t1.items():
+            if key not in t2 and key not in skip and key not in handled:
+                self.report('dictionary_item_removed', paths.child_path(path, key), key_info(key), value, notpresent)
+        for key, value in t2.items():
+            if key not in t1 and key not in skip and key not in handled:
+                self.report('dictionary_item_added', paths.child_path(path, key), key_info(key), notpresent, value)
+        for key, value in t2.items():
+            if key in t1 and key not in skip and key not in handled:
+                self.diff(t1[key], value, paths.child_path(path, key), key_info(key), child_info)
+
+    def diff_list(self, t1, t2, path, item_info, child_info, diff_item=None):
+        if not t1 and not t2:
+            self.unchanged(t1, t2)
+        elif all(isinstance(item, form_index.BASIC_TYPES) for item in t1) and all(isinstance(item, form_index.BASIC_TYPES) for item in t2):
+            self.diff_basic_list(t1, t2, path, item_info)
+        else:
+            self.diff_pairs(t1, t2, path, item_info, child_info, diff_item, 0, len(t1), 0, len(t2))
+
+    def diff_pairs(self, t1, t2, path, item_info, child_info, diff_item, t1_from, t1_to, t2_from, t2_to):
+        # Compare items by position, like DeepDiff does for ordered lists
+        for offset in range(max(t1_to - t1_from, t2_to - t2_from)):
+            i = t1_from + offset
+            j = t2_from + offset
+            if j >= t2_to:
+                self.report('iterable_item_removed', paths.child_path(path, i), item_info(i), t1[i], notpresent)
+            elif i >= t1_to:
+                self.report('iterable_item_added', paths.child_path(path, j), item_info(j), notpresent, t2[j])
+            elif diff_item:
+                diff_item(i, j, t1[i], t2[j], paths.child_path(path, i))
+            else:
+                self.diff(t1[i], t2[j], paths.child_path(path, i), item_info(i), child_info)
+
+    def diff_basic_list(self, t1, t2, path, item_info):
+        # Lists of plain values are aligned with difflib, falling back to comparing by
+        # position when that reports fewer changes - the same choice DeepDiff makes
+        aligned = []
+        matcher = difflib.SequenceMatcher(isjunk=None, a=t1, b=t2, autojunk=False)
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag == 'replace':
+                aligned.extend(_basic_pairs(t1, t2, i1, i2, j1, j2))
+            elif tag == 'delete':
+                aligned.extend(('iterable_item_removed', i, t1[i], notpresent) for i in range(i1, i2))
+            elif tag == 'insert':
+                aligned.extend(('iterable_item_added', j, notpresent, t2[j]) for j in range(j1, j2))
+        if len(aligned) > 1:
+            by_position = _basic_pairs(t1, t2, 0, len(t1), 0, len(t2))
+            if len(aligned) >= len(by_position):
+                aligned = by_position
+        changed_leaves = self.changed_leaves
+        for report_type, index, old, new in aligned:
+            self.report(report_type, paths.child_path(path, index), item_info(index), old, new)
+        # Items that lined up unchanged
+        self.total_leaves += len(t1) + len(t2) - (self.changed_leaves - changed_leaves)
+
+    def diff_fields(self, t1, t2, path):
+        pairs, removed, added, shared = pair_fields(self.original_index.field_ids, self.modified_index.field_ids,
+                                                    self.original_index.by_id, self.modified_index.by_id)
+        form = paths.form_info()
+        for key in removed:
+            info = paths.field_info(key) if paths.is_field_index(key) else form
+            self.report('dictionary_item_removed', paths.child_path(path, key), info, t1[key], notpresent)
+        for key in added:
+            info = paths.field_info(key) if paths.is_field_index(key) else form
+            self.report('dictionary_item_added', paths.child_path(path, key), info, notpresent, t2[key])
+        for key in shared:
+            self.diff(t1[key], t2[key], paths.child_path(path, key), form, form)
+        if self.run_pairs is None:
+            self.diff_field_pairs(t1, t2, path, pairs)
+        else:
+            for changes, changed_leaves, total_leaves in self.run_pairs(t1, t2, pairs, self.rule_alignment):
+                self.merge(changes, changed_leaves, total_leaves)
+
+    def diff_field_pairs(self, t1, t2, path, pairs):
+        for original_key, key in pairs:
+            field_path = paths.child_path(path, original_key)
+            if type(t1[original_key]) is dict and type(t2[key]) is dict:
+                if self.original_index.field_hash(original_key) != self.modified_index.field_hash(key):
+                    self.diff_field(original_key, key, t1[original_key], t2[key], field_path)
+                elif not t1[original_key] and not t2[key]:
+                    self.unchanged(t1[original_key], t2[key])
+                else:
+                    # Same apart from the uuid
+                    self.total_leaves += 2 * self.original_index.field_leaves(original_key)
+            else:
+                self.diff(t1[original_key], t2[key], field_path, paths.field_info(original_key), paths.other_info(original_key))
+
+    # field_index is the field's key in the original, modified_key its key in the modified form
+    def diff_field(self, field_index, modified_key, t1, t2, path):
+        other = paths.other_info(field_index)
+        setting = lambda key: paths.setting_info(field_index, key)
+        # Changes to the field uuid are never reported
+        if too_different(t1, t2, ('uuid',)):
+            self.report('values_changed', path, paths.field_info(field_index), t1, t2)
+            return
+        self.diff_dict(t1, t2, path, None, setting, other, skip=('uuid',), handled=('properties', 'rules'))
+        for key in ('properties', 'rules'):
+            if key not in t1 and key not in t2:
+                continue
+            child = paths.child_path(path, key)
+            if key not in t2:
+                self.report('dictionary_item_removed', child, setting(key), t1[key], notpresent)
+            elif key not in t1:
+                self.report('dictionary_item_added', child, setting(key), notpresent, t2[key])
+            elif key == 'properties' and type(t1[key]) is dict and type(t2[key]) is dict:
+                if self.original_index.properties_hash(field_index) == self.modified_index.properties_hash(modified_key):
+                    self.total_leaves += 2 * self.original_index.properties_leaves(field_index)
+                    continue
+                self.diff_dict(t1[key], t2[key], child, setting(key), lambda name: paths.property_info(field_index, name), other)
+            elif key == 'rules' and type(t1[key]) is list and type(t2[key]) is list:
+                self.diff_rules(field_index, modified_key, t1[key], t2[key], child)
+            else:
+                self.diff(t1[key], t2[key], child, setting(key), other)
+
+    def diff_rules(self, field_index, modified_key, t1, t2, path):
+        other = paths.other_info(field_index)
+        original_hashes = self.original_index.rule_hashes(field_index)
+        modified_hashes = self.modified_index.rule_hashes(modified_key)
+
+        # rule_index is the rule's index in the original, modified_index in the modified list
+        def diff_rule(rule_index, modified_index, r1, r2, rule_path):
+            if original_hashes[rule_index] == modified_hashes[modified_index]:
+                self.total_leaves += 2 * self.original_index.rule_leaves(field_index, rule_index)
+            elif type(r1) is dict and type(r2) is dict:
+                self.diff_dict(r1, r2, rule_path, paths.rule_info(field_index, rule_index), lambda name: paths.rule_setting_info(field_index, rule_index, name), other)
+            else:
+                self.diff(r1, r2, rule_path, paths.rule_info(field_index, rule_index), other)
+
+        item_info = lambda rule_index: paths.rule_info(field_index, rule_index)
+        if (self.rule_alignment == CONTENT and t1 and t2 and not all(isinstance(rule, form_index.BASIC_TYPES) for rule in t1)
+                and not all(isinstance(rule, form_index.BASIC_TYPES) for rule in t2)):
+            self.align_rules(t1, t2, path, item_info, diff_rule, self.original_index.rule_keys(field_index),
+                             self.modified_index.rule_keys(modified_key))
+        else:
+            self.diff_list(t1, t2, path, item_info, other, diff_rule)
+
+    def align_rules(self, t1, t2, path, item_info, diff_rule, original_keys, modified_keys):
+        # Lines the rules up by the longest common subsequence of their keys (ruleId or
+        # hash, see FormIndex.rule_keys), so one inserted rule is one added rule rather
+        # than a change to every rule after it. Then:
+        # - a rule that is gone from one place and turns up with the same key in another
+        #   has moved
+        # - what's left between two lined up stretches is compared by position, like
+        #   DeepDiff does, the extra rules on either side being removed or added. Rules
+        #   with a ruleId are never paired with another rule that way.
+        # Paths are those of the original rule, except for added rules.
+        opcodes = difflib.SequenceMatcher(isjunk=None, a=original_keys, b=modified_keys, autojunk=False).get_opcodes()
+        unmatched = {}
+        for tag, i1, i2, j1, j2 in opcodes:
+            if tag != 'equal':
+                for i in range(i1, i2):
+                    unmatched.setdefault(original_keys[i], []).append(i)
+        moved = {}  # modified index -> original index
+        for tag, i1, i2, j1, j2 in opcodes:
+            if tag != 'equal':
+                for j in range(j1, j2):
+                    if unmatched.get(modified_keys[j]):
+                        moved[j] = unmatched[modified_keys[j]].pop(0)
+        moved_from = set(moved.values())
+
+        for tag, i1, i2, j1, j2 in opcodes:
+            if tag == 'equal':
+                for offset in range(i2 - i1):
+                    diff_rule(i1 + offset, j1 + offset, t1[i1 + offset], t2[j1 + offset], paths.child_path(path, i1 + offset))
+                continue
+            left = [i for i in range(i1, i2) if i not in moved_from]
+            right = [j for j in range(j1, j2) if j not in moved]
+            pairs = list(zip([i for i in left if original_keys[i][0] == 'hash'], [j for j in right if modified_keys[j][0] == 'hash']))
+            for i, j in pairs:
+                diff_rule(i, j, t1[i], t2[j], paths.child_path(path, i))
+            paired_left = set(i for i, j in pairs)
+            paired_right = set(j for i, j in pairs)
+            for i in left:
+                if i not in paired_left:
+                    self.report('iterable_item_removed', paths.child_path(path, i), item_info(i), t1[i], notpresent)
+            for j in right:
+                if j not in paired_right:
+                    self.report('iterable_item_added', paths.child_path(path, j), item_info(j), notpresent, t2[j])
+        for j, i in sorted(moved.items()):
+            self.report_move(paths.child_path(path, i), paths.child_path(path, j), item_info(i), t1[i], t2[j])
+            # Rules matched by ruleId may have changed too
+            diff_rule(i, j, t1[i], t2[j], paths.child_path(path, i))
+
+
+def pair_fields(original_ids, modified_ids, by_id, modified_by_id):
+    # Pairs the fields of two forms by fieldId, then by index where a field has no
+    # (unique) fieldId. Takes the FormIndex field_ids and by_id maps of both, returns
+    # ([(original key, modified key)], removed keys, added keys, keys that aren't field
+    # indexes but are in both)
+    pairs = []
+    matched = set()
+    for key, id_ in modified_ids.items():
+        if not paths.is_field_index(key):
+            continue
+        original_key = by_id.get(id_)
+        if original_key is not None and modified_by_id.get(id_) == key:
+            pairs.append((original_key, key))
+            matched.add(original_key)
+    matched_modified = set(modified for original, modified in pairs)
+    for key, modified_id in modified_ids.items():
+        if key in matched_modified or key not in original_ids or key in matched or not paths.is_field_index(key):
+            continue
+        original_id = original_ids[key]
+        if original_id is None or modified_id is None or original_id == modified_id:
+            pairs.append((key, key))
+            matched.add(key)
+            matched_modified.add(key)
+    removed = [key for key in original_ids if key not in matched and (key not in modified_ids or paths.is_field_index(key))]
+    added = [key for key in modified_ids if key not in matched_modified and (key not in original_ids or paths.is_field_index(key))]
+    shared = [key for key in modified_ids if key in original_ids and not paths.is_field_index(key)]
+    return pairs, removed, added, shared
+
+
+def field_moves(original_structure, modified_structure, original_index=None):
+    # [(original key, modified key)] of the fields diff_structures() pairs up under
+    # different keys. Changes inside them are reported under the original key.
+    if (type(original_structure) is not dict or type(modified_structure) is not dict
+            or too_different(original_structure, modified_structure, ())):
+        return []
+    original_fields = original_structure.get('fields')
+    modified_fields = modified_structure.get('fields')
+    if type(original_fields) is not dict or type(modified_fields) is not dict:
+        return []
+    if original_index is not None:
+        original_ids, original_by_id = original_index.field_ids, original_index.by_id
+    else:
+        original_ids = { key: form_index.field_id(field) for key, field in original_fields.items() }
+        original_by_id = form_index.index_field_ids(original_ids)
+    modified_ids = { key: form_index.field_id(field) for key, field in modified_fields.items() }
+    pairs = pair_fields(original_ids, modified_ids, original_by_id, form_index.index_field_ids(modified_ids))[0]
+    return [(original_key, key) for original_key, key in pairs if original_key != key]
+
+
+def _basic_pairs(t1, t2, t1_from, t1_to, t2_from, t2_to):
+    pairs = []
+    for offset in range(max(t1_to - t1_from, t2_to - t2_from)):
+        i = t1_from + offset
+        j = t2_from + offset
+        if j >= t2_to:
+            pairs.append(('iterable_item_removed', i, t1[i], notpresent))
+        elif i >= t1_to:
+            pairs.append(('iterable_item_added', j, notpresent, t2[j]))
+        elif type(t1[i]) is not type(t2[j]):
+            pairs.append(('type_changes', i, t1[i], t2[j]))
+        elif t1[i] != t2[j]:
+            pairs.append(('values_changed', i, t1[i], t2[j]))
+    return pairs
+
+
+def too_different(t1, t2, skip):
+    # DeepDiff reports two dicts that share under a third of their keys as one
+    # changed value instead of diffing them key by key
+    keys = (set(t1) | set(t2)).difference(skip)
+    if len(keys) <= 1:
+        return False
+    common = sum(1 for key in keys if key in t1 and key in t2)
+    return common / len(keys) < 0.33
+
+
+# original_index/modified_index: form_index.FormIndex of each structure, if the caller already has them
+# run_pairs(original fields, modified fields, [(original key, modified key)], rule_alignment):
+#   diffs the paired fields instead of this walk, returning diff_field_pairs() results
+#   for consecutive slices of the pairs
+def diff_structures(original_structure, modified_structure, distance_mode=distance.APPROXIMATE, original_index=None, modified_index=None,
+                    rule_alignment=INDEX, run_pairs=None):
+    if distance_mode == distance.EXACT:
+        raise ValueError("The fields engine can't compute the exact distance")
+    walker = _walk(original_structure, modified_structure, original_index, modified_index, rule_alignment, run_pairs)
+    if distance_mode == distance.NONE:
+        return walker.changes, None
+    return walker.changes, distance.leaf_ratio(walker.changed_leaves, walker.total_leaves)
+
+
+def diff_parts(original_part, modified_part, rule_alignment=INDEX):
+    # Diffs a slice of two forms, e.g. { fields: { one field } } - see stream_compare.py.
+    # Returns the changes with the changed and total leaf counts, for the caller to add up.
+    walker = _walk(original_part, modified_part, None, None, rule_alignment)
+    return walker.changes, walker.changed_leaves, walker.total_leaves
+
+
+def diff_field_pairs(original_fields, modified_fields, pairs, rule_alignment=INDEX):
+    # Diffs some of the fields pair_fields() paired up, taking just those fields - for
+    # run_pairs. Returns the changes with the changed and total leaf counts.
+    walker = _Walker(form_index.FormIndex({ 'fields': original_fields }), form_index.FormIndex({ 'fields': modified_fields }),
+                     rule_alignment)
+    walker.diff_field_pairs(original_fields, modified_fields, paths.child_path('root', 'fields'), pairs)
+    return walker.changes, walker.changed_leaves, walker.total_leaves
+
+
+def _walk(original_structure, modified_structure, original_index, modified_index, rule_alignment, run_pairs=None):
+    # With run_pairs the fields are hashed where they are diffed
+    hash_fields = run_pairs is None
+    walker = _Walker(original_index or form_index.FormIndex(original_structure, hash_fields),
+                     modified_index or form_index.FormIndex(modified_structure, hash_fields), rule_alignment, run_pairs)
+    form = paths.form_info()
+    if type(original_structure) is dict and type(modified_structure) is dict:
+        walker.diff_dict(original_structure, modified_structure, 'root', form, lambda key: form, form, handled=('fields',))
+        if too_different(original_structure, modified_structure, ()):
+            return walker
+        fields_path = paths.child_path('root', 'fields')
+        original_fields = original_structure.get('fields', notpresent)
+        modified_fields = modified_structure.get('fields', notpresent)
+        if original_fields is notpresent and modified_fields is notpresent:
+            pass
+        elif modified_fields is notpresent:
+            walker.report('dictionary_item_removed', fields_path, form, original_fields, notpresent)
+        elif original_fields is notpresent:
+            walker.report('dictionary_item_added', fields_path, form, notpresent, modified_fields)
+        elif type(original_fields) is dict and type(modified_fields) is dict:
+            walker.diff_fields(original_fields, modified_fields, fields_path)
+        else:
+            walker.diff(original_fields, modified_fields, fields_path, form, form)
+    else:
+        walker.diff(original_structure, modified_structure, 'root', form, form)
+    return walker
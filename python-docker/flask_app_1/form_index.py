@@ -0,0 +1,129 @@
+# Per-field subtree hashes of a form, used to skip unchanged fields before diffing.
+#
+# Most edits touch a handful of fields in a form of hundreds, yet both engines walk
+# every one of them. A FormIndex hashes each field (minus its uuid, which is never
+# reported) and, on demand, each field's 'properties' block and rules. Two subtrees
+# with the same hash are identical, so the engines can skip them.
+#
+# Hashes are taken over the canonical JSON of the subtree, which keeps types apart:
+# 1, 1.0 and true all hash differently, as they diff differently. Stored baselines
+# keep their FormIndex (see baselines.py), so a hot baseline is never rehashed.
+import hashlib
+
+import codec
+import distance
+import paths
+
+BASIC_TYPES = (str, int, float, bool, type(None))
+
+
+def subtree_hash(obj):
+    return hashlib.blake2b(codec.dumps_bytes(obj), digest_size=16).digest()
+
+
+def field_id(field):
+    field_id = field.get('fieldId') if isinstance(field, dict) else None
+    return field_id if isinstance(field_id, BASIC_TYPES) else None
+
+
+def rule_id(rule):
+    rule_id = rule.get('ruleId') if isinstance(rule, dict) else None
+    return rule_id if isinstance(rule_id, BASIC_TYPES) else None
+
+
+def index_fields(fields):
+    return index_field_ids({ key: field_id(field) for key, field in fields.items() })
+
+
+def index_field_ids(field_ids):
+    # fieldId -> index, for fieldIds that appear exactly once. field_ids maps each
+    # key of a 'fields' dict to its field_id().
+    by_id = {}
+    duplicates = set()
+    for key, id_ in field_ids.items():
+        if id_ is None or not paths.is_field_index(key):
+            continue
+        if id_ in by_id:
+            duplicates.add(id_)
+        by_id[id_] = key
+    for id_ in duplicates:
+        del by_id[id_]
+    return by_id
+
+
+class FormIndex(object):
+
+    # hash_fields=False leaves field_hashes empty, for callers that only pair fields up
+    def __init__(self, structure, hash_fields=True):
+        fields = structure.get('fields') if isinstance(structure, dict) else None
+        self.fields = fields if isinstance(fields, dict) else {}
+        self.field_ids = { key: field_id(field) for key, field in self.fields.items() }
+        self.by_id = index_field_ids(self.field_ids)
+        self.field_hashes = {}
+        for key, field in self.fields.items():
+            if hash_fields and paths.is_field_index(key):
+                if isinstance(field, dict):
+                    field = { name: value for name, value in field.items() if name != 'uuid' }
+                self.field_hashes[key] = subtree_hash(field)
+        # Filled in lazily, per field
+        self._part_hashes = {}
+        self._rule_keys = {}
+        self._leaves = {}
+
+    def field_hash(self, key):
+        return self.field_hashes.get(key)
+
+    def _parts(self, key):
+        # (properties hash, [rule hashes]) of a field, None where it has no such dict/list
+        parts = self._part_hashes.get(key)
+        if parts is None:
+            field = self.fields[key]
+            properties = field.get('properties') if isinstance(field, dict) else None
+            rules = field.get('rules') if isinstance(field, dict) else None
+            parts = (subtree_hash(properties) if isinstance(properties, dict) else None,
+                     [subtree_hash(rule) for rule in rules] if isinstance(rules, list) else None)
+            self._part_hashes[key] = parts
+        return parts
+
+    def properties_hash(self, key):
+        return self._parts(key)[0]
+
+    def rule_hashes(self, key):
+        return self._parts(key)[1]
+
+    def rule_keys(self, key):
+        # What the fields engine lines rules up by with rule_alignment=content: a rule's
+        # ruleId where it has one, its hash otherwise
+        rule_keys = self._rule_keys.get(key)
+        if rule_keys is None:
+            rules = self.fields[key]['rules']
+            rule_keys = [('hash', rule_hash) if rule_id(rule) is None else ('id', rule_id(rule))
+                         for rule, rule_hash in zip(rules, self.rule_hashes(key))]
+            self._rule_keys[key] = rule_keys
+        return rule_keys
+
+    # Leaf counts, as distance.count_leaves() - the fields engine still has to count
+    # what it skips for the approximate distance
+
+    def field_leaves(self, key):
+        # A field's leaves, not counting its uuid
+        leaves = self._leaves.get(key)
+        if leaves is None:
+            field = self.fields[key]
+            leaves = sum(distance.count_leaves(value) for name, value in field.items() if name != 'uuid')
+            self._leaves[key] = leaves
+        return leaves
+
+    def properties_leaves(self, key):
+        leaves = self._leaves.get((key, 'properties'))
+        if leaves is None:
+            leaves = distance.count_leaves(self.fields[key]['properties'])
+            self._leaves[(key, 'properties')] = leaves
+        return leaves
+
+    def rule_leaves(self, key, rule_index):
+        leaves = self._leaves.get((key, rule_index))
+        if leaves is None:
+            leaves = distance.count_leaves(self.fields[key]['rules'][rule_index])
+            self._leaves[(key, rule_index)] = leaves
+        return leaves
@@ -0,0 +1,52 @@
+# Production server settings:  gunicorn --config gunicorn.conf.py app:app
+#
+# Pre-forked workers, each serving requests on a few threads while diffs run on its
+# process pool (see serving.py), so a big diff never holds up preflights or cache hits.
+#
+#   COMPARE_BIND              address to listen on (default 0.0.0.0:5000)
+#   COMPARE_WORKERS           web worker processes (default 2)
+#   COMPARE_THREADS           request threads per worker (default 8)
+#   COMPARE_WORKER_TIMEOUT    seconds a silent worker is given before it's restarted (default 120)
+#   COMPARE_GRACEFUL_TIMEOUT  seconds in-flight requests get to finish on shutdown (default 70)
+#   COMPARE_MAX_REQUESTS      restart a worker after this many requests, 0 never (default 0)
+#
+# COMPARE_POOL_SIZE defaults to the CPUs shared out between the workers.
+# PROMETHEUS_MULTIPROC_DIR (default: a fresh temporary directory) is where workers
+# leave their metrics for /metrics to add up, see metrics.py.
+import glob
+import multiprocessing
+import os
+import tempfile
+
+bind = os.environ.get('COMPARE_BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('COMPARE_WORKERS', 2))
+worker_class = 'gthread'
+threads = int(os.environ.get('COMPARE_THREADS', 8))
+timeout = int(os.environ.get('COMPARE_WORKER_TIMEOUT', 120))
+graceful_timeout = int(os.environ.get('COMPARE_GRACEFUL_TIMEOUT', 70))
+max_requests = int(os.environ.get('COMPARE_MAX_REQUESTS', 0))
+max_requests_jitter = max_requests // 10
+accesslog = '-'
+
+# Read by batch.py when a worker imports the app
+os.environ.setdefault('COMPARE_POOL_SIZE', str(max(1, multiprocessing.cpu_count() // workers)))
+# Must be set before a worker imports prometheus_client
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', tempfile.mkdtemp(prefix='compare-metrics-'))
+
+
+def on_starting(server):
+    # Metrics files left over from an earlier run would be counted again
+    os.makedirs(os.environ['PROMETHEUS_MULTIPROC_DIR'], exist_ok=True)
+    for path in glob.glob(os.path.join(os.environ['PROMETHEUS_MULTIPROC_DIR'], '*.db')):
+        os.remove(path)
+
+
+def worker_exit(server, worker):
+    # Let running diffs finish and stop the worker's pool processes with it
+    import batch
+    batch.shutdown_pool()
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,72 @@
+# Prometheus metrics and the slow request log for the compare service.
+#
+# Every request to /compare, /compare/batch and /compare/stream is timed as a whole
+# and, through spans.py, stage by stage. Streamed responses are timed until they
+# have been sent and have no response size. GET /metrics serves the lot in the Prometheus
+# text format. Under gunicorn, PROMETHEUS_MULTIPROC_DIR (set up by gunicorn.conf.py)
+# lets /metrics add up the numbers of every worker, whichever one answers the scrape.
+#
+#   COMPARE_SLOW_MS  log the stage breakdown of requests slower than this (default 0, off)
+import json
+import logging
+import os
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest
+from prometheus_client import multiprocess
+
+SLOW_MS = float(os.environ.get('COMPARE_SLOW_MS', 0))
+
+slow_log = logging.getLogger('compare.slow')
+
+_SECONDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+_BYTES = tuple(4 ** n for n in range(5, 15))
+_ITEMS = (0, 1, 5, 10, 50, 100, 500, 1000, 5000, 10000)
+
+requests_total = Counter('compare_requests_total', 'Requests handled', ['endpoint', 'status'])
+request_seconds = Histogram('compare_request_seconds', 'Request latency', ['endpoint'], buckets=_SECONDS)
+stage_seconds = Histogram('compare_stage_seconds', 'Time spent in each stage of a request', ['stage'], buckets=_SECONDS)
+request_bytes = Histogram('compare_request_bytes', 'Request body size, once decompressed', ['endpoint'], buckets=_BYTES)
+response_bytes = Histogram('compare_response_bytes', 'Response body size, after compression', ['endpoint'], buckets=_BYTES)
+diff_items = Histogram('compare_diff_items', 'Changes per diff by DeepDiff report type', ['type'], buckets=_ITEMS)
+fields_touched = Histogram('compare_fields_touched', 'Fields with changes per diff', buckets=_ITEMS)
+cache_lookups = Counter('compare_cache_lookups_total', 'Result cache lookups', ['result'])
+
+
+def observe(endpoint, status, seconds, request_size, response_size, request_spans):
+    requests_total.labels(endpoint, str(status)).inc()
+    request_seconds.labels(endpoint).observe(seconds)
+    if request_size is not None:
+        request_bytes.labels(endpoint).observe(request_size)
+    if response_size is not None:
+        response_bytes.labels(endpoint).observe(response_size)
+    if request_spans is None:
+        return
+    for stage, stage_time in request_spans.stages.items():
+        stage_seconds.labels(stage).observe(stage_time)
+    for report_type, items in request_spans.counts.get('diff_items', {}).items():
+        diff_items.labels(report_type).observe(items)
+    if 'fields_touched' in request_spans.counts:
+        fields_touched.observe(request_spans.counts['fields_touched'])
+    if 'cache' in request_spans.tags:
+        cache_lookups.labels(request_spans.tags['cache']).inc()
+    if SLOW_MS and seconds * 1000 >= SLOW_MS:
+        slow_log.warning('slow request %s', json.dumps({
+            'endpoint': endpoint,
+            'status': status,
+            'ms': round(seconds * 1000, 1),
+            'stages_ms': { stage: round(stage_time * 1000, 1) for stage, stage_time in request_spans.stages.items() },
+            'request_bytes': request_size,
+            'response_bytes': response_size,
+            'counts': request_spans.counts,
+            'tags': request_spans.tags,
+        }, sort_keys=True))
+
+
+def render():
+    # Returns (body, content type) for GET /metrics
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,114 @@
+# RFC 6902 JSON Patch output for /compare (format=patch).
+#
+# fieldChanges is written for people: every change repeats its path as a string and
+# as an array, whole rules and old values. A client that only applies changes is
+# better off with a patch that turns the original into the modified structure, built
+# straight from the engine's changes without going through classify(). It covers the
+# whole structure, form-level changes included. Field uuid changes are left out, as
+# they are from fieldChanges.
+#
+# Old values come as "test" operations before each "remove" and "replace", so
+# applying the patch to anything but the original fails instead of corrupting it.
+# old_values=False leaves them out.
+#
+# Paths in the changes point into the original, except that items added to a list
+# are at their index in the modified list and fields added to the form at their key
+# in the modified form. So:
+# 1. everything that doesn't add, remove or move list items or add fields, in place,
+#    in report order
+# 2. per list, innermost lists first: removed items from the last one back, then
+#    added items from the first one on. A moved item is removed from its old index
+#    and added at its new one.
+# 3. fields the fields engine paired up under a new key are moved there
+# 4. added fields
+import paths
+
+_ITEM_REPORTS = ('iterable_item_removed', 'iterable_item_added', 'iterable_item_moved')
+
+
+# moves: [(original key, modified key)] of fields that changed key, see field_diff.field_moves()
+# field_keys: every key of the original and modified fields, for picking spare keys
+def patch_operations(changes, old_values=True, moves=(), field_keys=()):
+    operations = []
+    added_fields = []
+    for report_type in paths.REPORT_TYPES:
+        if report_type in _ITEM_REPORTS:
+            continue
+        for change in changes[report_type]:
+            elements = paths.path_elements(change.path)
+            pointer = paths.json_pointer(elements)
+            if report_type == 'dictionary_item_added':
+                operation = { 'op': 'add', 'path': pointer, 'value': change.t2 }
+                if len(elements) == 2 and elements[0] == 'fields':
+                    added_fields.append(operation)
+                else:
+                    operations.append(operation)
+                continue
+            if old_values:
+                operations.append({ 'op': 'test', 'path': pointer, 'value': change.t1 })
+            if report_type == 'dictionary_item_removed':
+                operations.append({ 'op': 'remove', 'path': pointer })
+            else:
+                operations.append({ 'op': 'replace', 'path': pointer, 'value': change.t2 })
+
+    # list path -> ([(index, old value)], [(index, new value)])
+    lists = {}
+    for change in changes['iterable_item_removed']:
+        elements = paths.path_elements(change.path)
+        lists.setdefault(tuple(elements[:-1]), ([], []))[0].append((elements[-1], change.t1))
+    for change in changes['iterable_item_added']:
+        elements = paths.path_elements(change.path)
+        lists.setdefault(tuple(elements[:-1]), ([], []))[1].append((elements[-1], change.t2))
+    for change in changes['iterable_item_moved']:
+        # Changes to the item itself were made in place already
+        elements = paths.path_elements(change.path)
+        items = lists.setdefault(tuple(elements[:-1]), ([], []))
+        items[0].append((elements[-1], change.t2))
+        items[1].append((paths.path_elements(change.new_path)[-1], change.t2))
+    for list_path in sorted(lists, key=len, reverse=True):
+        removed, added = lists[list_path]
+        pointer = paths.json_pointer(list_path)
+        for index, value in sorted(removed, key=lambda item: item[0], reverse=True):
+            item_pointer = '%s/%d' % (pointer, index)
+            if old_values:
+                operations.append({ 'op': 'test', 'path': item_pointer, 'value': value })
+            operations.append({ 'op': 'remove', 'path': item_pointer })
+        for index, value in sorted(added, key=lambda item: item[0]):
+            operations.append({ 'op': 'add', 'path': '%s/%d' % (pointer, index), 'value': value })
+
+    operations.extend(_move_fields(moves, field_keys))
+    operations.extend(added_fields)
+    return operations
+
+
+def _move_fields(moves, field_keys=()):
+    # A move overwrites whatever is at its target, and by now the only fields left
+    # where another one should go are fields still to be moved. So a field moves once
+    # the one at its new key has moved on. Fields that swap keys wait on each other;
+    # one of them is parked under a spare key first, one no field has in either form.
+    operations = []
+    pending = dict(moves)
+    targets = set(pending.values())
+    keys = set(field_keys)
+    while pending:
+        ready = [key for key, target in pending.items() if target not in pending]
+        if not ready:
+            key = next(iter(pending))
+            parked = _spare_key(key, set(pending) | targets | keys)
+            operations.append(_move(key, parked))
+            pending[parked] = pending.pop(key)
+            continue
+        for key in ready:
+            operations.append(_move(key, pending.pop(key)))
+    return operations
+
+
+def _spare_key(key, taken):
+    spare = key + '-moving'
+    while spare in taken:
+        spare += '-'
+    return spare
+
+
+def _move(key, target):
+    return { 'op': 'move', 'from': paths.json_pointer(('fields', key)), 'path': paths.json_pointer(('fields', target)) }
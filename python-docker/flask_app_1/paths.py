@@ -0,0 +1,155 @@
+# Parse DeepDiff paths once instead of re-running a regex per change type.
+#
+# A DeepDiff path looks like root['fields']['0']['rules'][3]['type']. Every path is
+# split into the field index (if any) and what the rest of the path points at, and
+# the /compare loops dispatch on that instead of calling re.search() up to six times.
+import ast
+from collections import namedtuple
+import re
+
+# What a path points at
+FORM = 'form'                  # root['title'] - not under a field
+FIELD = 'field'                # root['fields']['0']
+SETTING = 'setting'            # root['fields']['0']['name']
+PROPERTY = 'property'          # root['fields']['0']['properties']['label']
+RULE = 'rule'                  # root['fields']['0']['rules'][3]
+RULE_SETTING = 'rule_setting'  # root['fields']['0']['rules'][3]['type']
+OTHER = 'other'                # anything else under a field
+
+PathInfo = namedtuple('PathInfo', ['kind', 'field_index', 'name', 'rule_index'])
+
+# One reported difference - path: DeepDiff style path string, info: its PathInfo,
+# t1/t2: the old/new value at that path, new_path: where a moved item is in the
+# modified structure
+Change = namedtuple('Change', ['path', 'info', 't1', 't2', 'new_path'], defaults=(None,))
+
+# How changes are grouped, using DeepDiff's report type names
+REPORT_TYPES = (
+    'dictionary_item_added',
+    'dictionary_item_removed',
+    'values_changed',
+    'iterable_item_added',
+    'iterable_item_removed',
+    'type_changes',
+    'iterable_item_moved',
+)
+
+# The character classes are the ones the original per-type patterns used, so the
+# classification (and the response) is unchanged.
+_FIELD_INDEX = r"\d+"
+_SETTING_NAME = r"[a-zA-Z0-9-_]+"
+_PROPERTY_NAME = r"[a-zA-Z0-9\-?]+"
+_RULE_SETTING_NAME = r"[a-zA-Z09]+"
+
+_field_prefix = re.compile(r"root\['fields'\]\['(%s)'\]" % _FIELD_INDEX)
+_field_rest = re.compile(
+    r"(?P<root>)$"
+    r"|\['(?P<setting>%s)'\]$"
+    r"|\['properties'\]\['(?P<property>%s)'\]$"
+    r"|\['rules'\]\[(?P<rule>\d+)\](?:\['(?P<rule_setting>%s)'\])?$"
+    % (_SETTING_NAME, _PROPERTY_NAME, _RULE_SETTING_NAME)
+)
+_field_index = re.compile(_FIELD_INDEX)
+_setting_name = re.compile(_SETTING_NAME)
+_property_name = re.compile(_PROPERTY_NAME)
+_rule_setting_name = re.compile(_RULE_SETTING_NAME)
+_field_uuid = re.compile(r"root\['fields'\]\['\d+'\]\['uuid'\]$")
+_path_deconstructor = re.compile(r"[^a-zA-Z0-9-_]+")
+_path_element = re.compile(r"\[('(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"|-?\d+)\]")
+
+_form_path = PathInfo(FORM, None, None, None)
+
+
+def parse_path(path):
+    field_match = _field_prefix.match(path)
+    if not field_match:
+        return _form_path
+    field_index = field_match.group(1)
+    rest = _field_rest.match(path, field_match.end())
+    if not rest:
+        return PathInfo(OTHER, field_index, None, None)
+    root, setting, prop, rule, rule_setting = rest.groups()
+    if root is not None:
+        return PathInfo(FIELD, field_index, None, None)
+    if setting is not None:
+        return PathInfo(SETTING, field_index, setting, None)
+    if prop is not None:
+        return PathInfo(PROPERTY, field_index, prop, None)
+    if rule_setting is not None:
+        return PathInfo(RULE_SETTING, field_index, rule_setting, rule)
+    return PathInfo(RULE, field_index, None, rule)
+
+
+def path_array(path):
+    # root['fields']['0']['x'] -> ['fields', '0', 'x']
+    return _path_deconstructor.split(path)[1:-1]
+
+
+def path_elements(path):
+    # root['fields']['0']['rules'][3] -> ['fields', '0', 'rules', 3]. Unlike path_array()
+    # keys come back whole, whatever characters they hold.
+    elements = []
+    for match in _path_element.finditer(path, len('root')):
+        token = match.group(1)
+        if token[0] not in '\'"':
+            elements.append(int(token))
+        elif '\\' in token:
+            elements.append(ast.literal_eval(token))
+        else:
+            elements.append(token[1:-1])
+    return elements
+
+
+def json_pointer(elements):
+    # RFC 6901: ['fields', 'a/b'] -> /fields/a~1b, the whole document is ''
+    return ''.join('/' + str(element).replace('~', '~0').replace('/', '~1') for element in elements)
+
+
+def is_field_uuid(path):
+    # Cheap suffix check first - this runs for every node DeepDiff visits
+    return path.endswith("['uuid']") and _field_uuid.match(path) is not None
+
+
+# Engines that walk the structure themselves know where they are, so they build the
+# PathInfo directly with these instead of formatting a path and parsing it back.
+def form_info():
+    return _form_path
+
+
+def is_field_index(key):
+    return isinstance(key, str) and _field_index.fullmatch(key) is not None
+
+
+def field_info(field_index):
+    return PathInfo(FIELD, field_index, None, None)
+
+
+def other_info(field_index):
+    return PathInfo(OTHER, field_index, None, None)
+
+
+def setting_info(field_index, key):
+    if isinstance(key, str) and _setting_name.fullmatch(key):
+        return PathInfo(SETTING, field_index, key, None)
+    return PathInfo(OTHER, field_index, None, None)
+
+
+def property_info(field_index, key):
+    if isinstance(key, str) and _property_name.fullmatch(key):
+        return PathInfo(PROPERTY, field_index, key, None)
+    return PathInfo(OTHER, field_index, None, None)
+
+
+def rule_info(field_index, rule_index):
+    return PathInfo(RULE, field_index, None, str(rule_index))
+
+
+def rule_setting_info(field_index, rule_index, key):
+    if isinstance(key, str) and _rule_setting_name.fullmatch(key):
+        return PathInfo(RULE_SETTING, field_index, key, str(rule_index))
+    return PathInfo(OTHER, field_index, None, None)
+
+
+def child_path(path, key):
+    # Same format DeepDiff uses: root['fields']['0']['rules'][3]
+    return '%s[%r]' % (path, key)
@@ -0,0 +1,202 @@
+# Runs /compare diffs off the request threads.
+#
+# A big diff is seconds of pure Python, so done on a request thread it holds the GIL
+# and stalls every other request the worker is serving, CORS preflights included.
+# Diffs are handed to the process pool from batch.py instead, and at most
+# COMPARE_MAX_DIFFS of them may be running or queued per web worker. Past that
+# /compare answers 503 straight away rather than queueing without bound. Pairs of a
+# /compare/batch count against the same cap, but only take free slots: a batch
+# slows down rather than making /compare wait behind it.
+#
+#   COMPARE_DIFF_POOL     process (default) or inline - run on the request thread,
+#                         for debugging
+#   COMPARE_MAX_DIFFS     diffs in flight per web worker (default: 2 per pool process)
+#   COMPARE_QUEUE_WAIT    seconds to wait for a free slot before the 503 (default 0)
+#   COMPARE_DIFF_TIMEOUT  seconds before /compare gives up on a diff with a 504
+#                         (default 60). The diff itself can't be interrupted, it keeps
+#                         its slot until it finishes.
+#   COMPARE_SHARD_FIELDS  split fields engine diffs of forms with at least this many
+#                         fields across the pool (default 0, never)
+#   COMPARE_SHARDS        slices such a diff is split into (default: 2 per pool process)
+#
+# A split diff pairs the fields up on the request thread, diffs consecutive slices of
+# the pairs on the pool at once and merges the changes back in order, so the response
+# is the same byte for byte as from one process.
+from concurrent.futures import TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+import os
+import threading
+import time
+
+import baselines
+import batch
+import codec
+import compare
+import field_diff
+import spans
+
+DIFF_POOL = os.environ.get('COMPARE_DIFF_POOL', 'process')
+MAX_DIFFS = int(os.environ.get('COMPARE_MAX_DIFFS', 0)) or batch.POOL_SIZE * 2
+QUEUE_WAIT = float(os.environ.get('COMPARE_QUEUE_WAIT', 0))
+DIFF_TIMEOUT = float(os.environ.get('COMPARE_DIFF_TIMEOUT', 60))
+SHARD_FIELDS = int(os.environ.get('COMPARE_SHARD_FIELDS', 0))
+SHARDS = int(os.environ.get('COMPARE_SHARDS', 0)) or batch.POOL_SIZE * 2
+
+if DIFF_POOL not in ('process', 'inline'):
+    raise ValueError('Unknown COMPARE_DIFF_POOL {}'.format(DIFF_POOL))
+
+_slots = threading.BoundedSemaphore(MAX_DIFFS)
+# Pool processes open the baseline store themselves
+_worker_baselines = None
+
+
+class Saturated(Exception):
+    pass
+
+
+class DiffTimeout(Exception):
+    pass
+
+
+class BaselineGone(LookupError):
+    pass
+
+
+def run_compare(original_structure, modified_structure, engine, distance_mode, rule_alignment, output_format, old_values,
+                baseline_key=None, original_index=None):
+    # Returns the serialised response body, with the stage timings and counts of its
+    # own spans.Spans. In a pool process the original of a stored baseline is loaded
+    # there by baseline_key, (baseline_id, version, created), rather than pickled over.
+    global _worker_baselines
+    run_spans = spans.Spans()
+    token = spans.activate(run_spans)
+    try:
+        if baseline_key is not None:
+            with spans.stage('baseline'):
+                if _worker_baselines is None:
+                    _worker_baselines = baselines.from_env()
+                baseline = _worker_baselines.get(*baseline_key[:2])
+            # Not the row the web worker read (and made the ETag from) if it was
+            # stored again since
+            if baseline is None or baseline.created != baseline_key[2]:
+                raise BaselineGone('Baseline {} version {} is no longer stored'.format(*baseline_key))
+            original_structure = baseline.structure
+            original_index = baseline.index
+        result = compare.compare_structures(original_structure, modified_structure, engine, distance_mode, original_index,
+                                            output_format, old_values, rule_alignment)
+        with spans.stage('serialise'):
+            body = codec.body_bytes(result)
+    finally:
+        spans.deactivate(token)
+    return body, run_spans.stages, run_spans.counts
+
+
+def run_batch(pairs, engine=None, distance_mode=None, rule_alignment=None, output_format=None, old_values=None):
+    # batch.run_batch() with each pair holding a slot while it is in the pool
+    return batch.run_batch(pairs, engine, distance_mode, rule_alignment, output_format, old_values, slots=_slots)
+
+
+def acquire_slot():
+    # For diffs run outside the pool (stream_compare.py), which count against the cap too
+    if not _slots.acquire(timeout=QUEUE_WAIT):
+        raise Saturated('Too many compares in progress, retry shortly')
+
+
+def release_slot():
+    _slots.release()
+
+
+def compare_body(baseline, original_structure, modified_structure, engine, distance_mode, rule_alignment, output_format, old_values):
+    # Raises Saturated when every slot is taken, DiffTimeout after DIFF_TIMEOUT
+    acquire_slot()
+    if SHARD_FIELDS and engine == 'fields' and _field_count(modified_structure) >= SHARD_FIELDS:
+        try:
+            return _sharded_body(baseline, original_structure, modified_structure, engine, distance_mode, rule_alignment,
+                                 output_format, old_values)
+        finally:
+            _slots.release()
+    start = time.perf_counter()
+    if DIFF_POOL == 'inline':
+        try:
+            return _timed(start, run_compare(original_structure, modified_structure, engine, distance_mode, rule_alignment,
+                                             output_format, old_values, original_index=baseline.index if baseline else None))
+        finally:
+            _slots.release()
+
+    if baseline is not None:
+        args = (None, modified_structure, engine, distance_mode, rule_alignment, output_format, old_values,
+                (baseline.baseline_id, baseline.version, baseline.created))
+    else:
+        args = (original_structure, modified_structure, engine, distance_mode, rule_alignment, output_format, old_values)
+    try:
+        future = _submit(run_compare, *args)
+    except Exception:
+        _slots.release()
+        raise
+    # The slot is freed when the diff finishes, even if the request timed out first
+    future.add_done_callback(lambda future: _slots.release())
+    try:
+        return _timed(start, future.result(timeout=DIFF_TIMEOUT))
+    except TimeoutError:
+        raise DiffTimeout('Compare took longer than {:g}s'.format(DIFF_TIMEOUT))
+    except BrokenProcessPool:
+        batch.reset_pool()
+        raise
+
+
+def _submit(fn, *args):
+    try:
+        return batch.get_pool().submit(fn, *args)
+    except BrokenProcessPool:
+        # A worker died since the last diff, start over with a new pool
+        batch.reset_pool()
+        return batch.get_pool().submit(fn, *args)
+
+
+def _field_count(structure):
+    fields = structure.get('fields') if isinstance(structure, dict) else None
+    return len(fields) if isinstance(fields, dict) else 0
+
+
+def _sharded_body(baseline, original_structure, modified_structure, engine, distance_mode, rule_alignment, output_format, old_values):
+    # Runs on the request thread, which mostly waits for the slices
+    deadline = time.monotonic() + DIFF_TIMEOUT
+    result = compare.compare_structures(original_structure, modified_structure, engine, distance_mode,
+                                        baseline.index if baseline else None, output_format, old_values, rule_alignment,
+                                        run_pairs=lambda *args: _run_pairs(deadline, *args))
+    with spans.stage('serialise'):
+        return codec.body_bytes(result)
+
+
+def _run_pairs(deadline, original_fields, modified_fields, pairs, rule_alignment):
+    # field_diff run_pairs: each slice goes to the pool with just its own fields
+    size = max(1, -(-len(pairs) // SHARDS))
+    slices = []
+    for start in range(0, len(pairs), size):
+        slice_pairs = pairs[start:start + size]
+        slices.append(({ original_key: original_fields[original_key] for original_key, _ in slice_pairs },
+                       { key: modified_fields[key] for _, key in slice_pairs }, slice_pairs, rule_alignment))
+    spans.count('shards', len(slices))
+    if DIFF_POOL == 'inline':
+        return [field_diff.diff_field_pairs(*args) for args in slices]
+    futures = [_submit(field_diff.diff_field_pairs, *args) for args in slices]
+    try:
+        return [future.result(timeout=max(0.0, deadline - time.monotonic())) for future in futures]
+    except TimeoutError:
+        for future in futures:
+            future.cancel()
+        raise DiffTimeout('Compare took longer than {:g}s'.format(DIFF_TIMEOUT))
+    except BrokenProcessPool:
+        batch.reset_pool()
+        raise
+
+
+def _timed(start, run):
+    # Adds a run's stages to the request's, and the time outside them - pickling,
+    # waiting for a pool process - as 'pool'
+    body, stages, counts = run
+    request_spans = spans.current()
+    if request_spans is not None:
+        request_spans.merge(stages, counts)
+        request_spans.add('pool', max(0.0, time.perf_counter() - start - sum(stages.values())))
+    return body
@@ -0,0 +1,77 @@
+# Per-request stage timings for /compare.
+#
+# A Spans collects how long each stage of one request took (parse, digest, diff,
+# classify, ...) plus a few counts and tags. Code anywhere below the request marks
+# its stage with `with spans.stage('diff'):`, which does nothing when no Spans is
+# active, e.g. in the benchmarks. Stages can nest; each one is charged its own time
+# only, so the stages of a request add up to at most its total.
+#
+# Diffs that run in a pool process time themselves in a Spans of their own, which
+# travels back with the result (see serving.py).
+from contextlib import contextmanager
+import contextvars
+import time
+
+_current = contextvars.ContextVar('compare_spans', default=None)
+
+
+class Spans(object):
+
+    def __init__(self):
+        self.stages = {}
+        self.counts = {}
+        self.tags = {}
+        self._nested = 0.0
+
+    def add(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def merge(self, stages, counts):
+        for stage, seconds in stages.items():
+            self.add(stage, seconds)
+        self.counts.update(counts)
+
+    def total(self):
+        return sum(self.stages.values())
+
+
+def activate(spans):
+    # Returns a token for deactivate()
+    return _current.set(spans)
+
+
+def deactivate(token):
+    _current.reset(token)
+
+
+def current():
+    return _current.get()
+
+
+@contextmanager
+def stage(name):
+    spans = _current.get()
+    if spans is None:
+        yield
+        return
+    outer_nested = spans._nested
+    spans._nested = 0.0
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        spans.add(name, elapsed - spans._nested)
+        spans._nested = outer_nested + elapsed
+
+
+def count(name, value):
+    spans = _current.get()
+    if spans is not None:
+        spans.counts[name] = value
+
+
+def tag(name, value):
+    spans = _current.get()
+    if spans is not None:
+        spans.tags[name] = value
@@ -0,0 +1,252 @@
+# Memory-bounded compare for very large forms (POST /compare/stream).
+#
+# /compare holds both parsed forms, the diff and the whole response in memory at
+# once, so a few multi-MB forms in flight can run a worker out of memory. Here:
+# - the request body is parsed incrementally (ijson) as it is read, and each field is
+#   written to a temporary SQLite file as soon as it has been parsed
+# - fields are paired exactly like the fields engine pairs them (see
+#   field_diff.pair_fields), from their keys and fieldIds alone
+# - one pair of fields is loaded and diffed at a time, and its entry of fieldChanges
+#   is sent as soon as it's ready
+# so peak memory follows the largest field rather than the whole form.
+#
+# The response is what /compare returns with engine=fields, except that fieldChanges
+# comes first and changeDistance last, once every field has been counted. Only the
+# fields engine is available, and results aren't cached. Needs the optional ijson
+# package.
+#
+# The status and headers go out before the first field is diffed, so a diff that
+# fails halfway can't turn into an error response. The body is closed with an
+# "error" member in place of changeDistance instead: a body that ends without either
+# was cut off.
+import logging
+import os
+import sqlite3
+import tempfile
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+import codec
+import compare
+import distance
+import field_diff
+import form_index
+
+SIDES = ('original_structure', 'modified_structure')
+
+log = logging.getLogger('compare.stream')
+
+
+class StreamError(ValueError):
+    pass
+
+
+class SpooledForms(object):
+    # Both forms of a request body, read from a binary file. Top-level values other
+    # than the forms end up in options, the fields of each form on disk.
+
+    def __init__(self, body):
+        self.options = {}
+        # Per form: its top-level values other than 'fields', and key -> fieldId of its fields
+        self.parts = { side: {} for side in SIDES }
+        self.field_ids = { side: {} for side in SIDES }
+        self.has_fields = set()
+        fd, self.path = tempfile.mkstemp(prefix='compare-stream-', suffix='.sqlite3')
+        os.close(fd)
+        self.db = sqlite3.connect(self.path, isolation_level=None)
+        try:
+            self.db.execute('PRAGMA journal_mode=OFF')
+            self.db.execute('PRAGMA synchronous=OFF')
+            self.db.execute('CREATE TABLE fields (side TEXT, key TEXT, body BLOB, PRIMARY KEY (side, key))')
+            self.db.execute('BEGIN')
+            self._parse(body)
+            self.db.execute('COMMIT')
+        except Exception:
+            self.close()
+            raise
+
+    def _parse(self, body):
+        # Walks the parser events down to the fields of each form and builds every
+        # value found on the way (top-level options, form parts, one field) on its own
+        opened = []  # keys of the objects descended into, None for the body itself
+        key = None
+        builder = None
+        try:
+            for _, event, value in ijson.parse(_Reader(body), use_float=True):
+                if builder is not None:
+                    builder.event(event, value)
+                    if event in ('start_map', 'start_array'):
+                        depth += 1
+                    elif event in ('end_map', 'end_array'):
+                        depth -= 1
+                        if depth == 0:
+                            self._store(location, builder.value)
+                            builder = None
+                    continue
+                if event == 'map_key':
+                    key = value
+                    continue
+                if event in ('end_map', 'end_array'):
+                    opened.pop()
+                    continue
+                if not opened:
+                    if event != 'start_map':
+                        raise StreamError('Expected a JSON object')
+                    opened.append(None)
+                    continue
+                location = tuple(opened[1:]) + (key,)
+                if event == 'start_map' and (len(location) == 1 and key in SIDES or location[1:] == ('fields',)):
+                    if len(location) == 2:
+                        self.has_fields.add(location[0])
+                    opened.append(key)
+                elif event in ('start_map', 'start_array'):
+                    builder = ijson.ObjectBuilder()
+                    builder.event(event, value)
+                    depth = 1
+                else:
+                    self._store(location, value)
+        except ijson.JSONError as e:
+            raise StreamError('Invalid JSON: {}'.format(e))
+
+    def _store(self, location, value):
+        if len(location) == 1:
+            self.options[location[0]] = value
+        elif len(location) == 2:
+            self.parts[location[0]][location[1]] = value
+        else:
+            side, _, key = location
+            self.field_ids[side][key] = form_index.field_id(value)
+            self.db.execute('INSERT OR REPLACE INTO fields (side, key, body) VALUES (?, ?, ?)',
+                            (side, key, sqlite3.Binary(codec.dumps_bytes(value))))
+
+    def field(self, side, key):
+        row = self.db.execute('SELECT body FROM fields WHERE side = ? AND key = ?', (side, key)).fetchone()
+        return codec.loads(bytes(row[0]))
+
+    def has(self, side):
+        return side in self.options or side in self.has_fields or bool(self.parts[side])
+
+    def streamable(self, side):
+        # A form object with a 'fields' object, the shape stream_diff() handles
+        return side not in self.options and side in self.has_fields and 'fields' not in self.parts[side]
+
+    def load(self, side):
+        # The whole form, for shapes that can't be streamed
+        if side in self.options:
+            return self.options[side]
+        structure = dict(self.parts[side])
+        if side in self.has_fields:
+            structure['fields'] = { key: self.field(side, key) for key in self.field_ids[side] }
+        return structure
+
+    def close(self):
+        self.db.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+class _Reader(object):
+    # ijson probes its input with read(0), which werkzeug's request stream takes for a
+    # client that went away
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def read(self, size=-1):
+        return self.stream.read(size) if size else b''
+
+
+class _Form(object):
+    # One side of a streamed compare: its top-level parts and its fields by key
+
+    def __init__(self, parts, field_ids, field):
+        self.parts = parts
+        self.field_ids = field_ids
+        self.by_id = form_index.index_field_ids(field_ids)
+        self.field = field
+
+
+def _spooled_form(forms, side):
+    return _Form(forms.parts[side], forms.field_ids[side], lambda key: forms.field(side, key))
+
+
+def _baseline_form(baseline):
+    fields = baseline.structure['fields']
+    parts = { key: value for key, value in baseline.structure.items() if key != 'fields' }
+    return _Form(parts, baseline.index.field_ids, lambda key: fields[key])
+
+
+def _streamable_baseline(baseline):
+    structure = baseline.structure
+    return isinstance(structure, dict) and isinstance(structure.get('fields'), dict)
+
+
+def stream_diff(forms, distance_mode, baseline=None, rule_alignment=field_diff.INDEX):
+    # Yields the response body in chunks. baseline: a baselines.Baseline to use as the
+    # original instead of the body's original_structure.
+    if not forms.has('modified_structure'):
+        raise StreamError('modified_structure is required')
+    if baseline is None and not forms.has('original_structure'):
+        raise StreamError('original_structure or baseline_id is required')
+    original_ok = _streamable_baseline(baseline) if baseline is not None else forms.streamable('original_structure')
+    if not original_ok or not forms.streamable('modified_structure'):
+        # Not a form with a fields object - nothing to stream, compare it whole
+        original_structure = baseline.structure if baseline is not None else forms.load('original_structure')
+        result = compare.compare_structures(original_structure, forms.load('modified_structure'), 'fields', distance_mode,
+                                            rule_alignment=rule_alignment)
+        return iter([codec.body_bytes(result)])
+    original = _baseline_form(baseline) if baseline is not None else _spooled_form(forms, 'original_structure')
+    modified = _spooled_form(forms, 'modified_structure')
+    return _stream(original, modified, distance_mode, rule_alignment)
+
+
+def _stream(original, modified, distance_mode, rule_alignment):
+    yield b'{"fieldChanges":{'
+    try:
+        change_distance = yield from _field_changes(original, modified, distance_mode, rule_alignment)
+    except Exception as e:
+        log.exception('Streamed compare failed')
+        yield b'},"error":' + codec.dumps_bytes('Compare failed: {!r}'.format(e)) + b'}\n'
+        return
+    yield b'},"changeDistance":' + codec.dumps_bytes(change_distance) + b'}\n'
+
+
+def _field_changes(original, modified, distance_mode, rule_alignment):
+    # Yields the entries of fieldChanges, comma separated, and returns changeDistance
+    changed_leaves = 0
+    total_leaves = 0
+    # The forms apart from their fields. Two roots that only hold 'fields' count no
+    # leaves of their own.
+    if original.parts or modified.parts:
+        _, changed, total = field_diff.diff_parts(original.parts, modified.parts, rule_alignment)
+        changed_leaves += changed
+        total_leaves += total
+
+    separator = b''
+    # The fields engine reports forms that share under a third of their top-level keys
+    # as a whole, without going into the fields
+    if not field_diff.too_different(dict.fromkeys(list(original.parts) + ['fields']),
+                                    dict.fromkeys(list(modified.parts) + ['fields']), ()):
+        pairs, removed, added, shared = field_diff.pair_fields(original.field_ids, modified.field_ids,
+                                                               original.by_id, modified.by_id)
+        slices = ([(original_key, key) for original_key, key in pairs] + [(key, None) for key in removed]
+                  + [(None, key) for key in added] + [(key, key) for key in shared])
+        for original_key, key in slices:
+            original_part = { 'fields': {} if original_key is None else { original_key: original.field(original_key) } }
+            modified_part = { 'fields': {} if key is None else { key: modified.field(key) } }
+            changes, changed, total = field_diff.diff_parts(original_part, modified_part, rule_alignment)
+            changed_leaves += changed
+            total_leaves += total
+            field_changes = compare.classify(changes, original_part, modified_part)[0]
+            for index, entry in field_changes.items():
+                yield separator + codec.dumps_bytes(index) + b':' + codec.dumps_bytes(entry)
+                separator = b','
+
+    if distance_mode == distance.NONE:
+        return None
+    return round(distance.leaf_ratio(changed_leaves, total_leaves) * 100, 2)
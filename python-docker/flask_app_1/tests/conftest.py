@@ -0,0 +1,5 @@
+# The modules sit next to app.py, in flask_app_1/
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,81 @@
+import json
+
+from werkzeug.test import EnvironBuilder
+
+import app
+import batch
+import metrics
+
+
+def test_batch_results_go_out_as_they_come(monkeypatch):
+    progress = []
+
+    def run_batch(pairs, *options, **kwargs):
+        for index, _ in enumerate(pairs):
+            progress.append(index)
+            yield { 'index': index }
+
+    observed = []
+    monkeypatch.setattr(batch, 'run_batch', run_batch)
+    monkeypatch.setattr(metrics, 'observe', lambda *args: observed.append(args))
+    response = app.app.test_client().post('/compare/batch', json={ 'pairs': [{}, {}, {}] }, buffered=False)
+    chunks = iter(response.response)
+    assert json.loads(next(chunks)) == { 'index': 0 }
+    assert progress == [0]
+    assert observed == []
+    assert [json.loads(chunk) for chunk in chunks] == [{ 'index': 1 }, { 'index': 2 }]
+    response.close()
+    # Timed once the body has been sent, its size unknown
+    assert [(args[0], args[1], args[4]) for args in observed] == [('batch', 200, None)]
+
+
+def _stream_body():
+    from benchmarks.forms import edit_form, generate_form
+    original = generate_form(200, seed=1)
+    return { 'original_structure': original, 'modified_structure': edit_form(original, 50, seed=2) }
+
+
+def test_streamed_compare_goes_out_before_its_diff_finishes(monkeypatch):
+    import stream_compare
+    finished = []
+    stream_diff = stream_compare.stream_diff
+
+    def tracked_stream_diff(*args, **kwargs):
+        for chunk in stream_diff(*args, **kwargs):
+            yield chunk
+        finished.append(True)
+
+    monkeypatch.setattr(stream_compare, 'stream_diff', tracked_stream_diff)
+    response = app.app.test_client().post('/compare/stream', json=_stream_body(), buffered=False)
+    chunks = iter(response.response)
+    first = next(chunks)
+    assert finished == []
+    body = json.loads(first + b''.join(chunks))
+    response.close()
+    assert finished == [True]
+    assert 'changeDistance' in body
+
+
+def test_a_streamed_compare_closed_unread_cleans_up(monkeypatch):
+    import os
+    import threading
+    import serving
+    import stream_compare
+    spooled = []
+
+    class SpooledForms(stream_compare.SpooledForms):
+        def __init__(self, body):
+            super(SpooledForms, self).__init__(body)
+            spooled.append(self.path)
+
+    monkeypatch.setattr(stream_compare, 'SpooledForms', SpooledForms)
+    monkeypatch.setattr(serving, '_slots', threading.BoundedSemaphore(1))
+    # Straight through WSGI: the test client would start the body to get the status
+    statuses = []
+    environ = EnvironBuilder('/compare/stream', method='POST', json=_stream_body()).get_environ()
+    body = app.app(environ, lambda status, headers, exc_info=None: statuses.append(status))
+    assert statuses == ['200 OK']
+    body.close()
+    assert not os.path.exists(spooled[0])
+    serving.acquire_slot()
+    serving.release_slot()
@@ -0,0 +1,75 @@
+import pytest
+
+import baselines
+
+
+@pytest.fixture
+def store(tmp_path):
+    return baselines.BaselineStore(str(tmp_path / 'baselines.sqlite3'), 1000, 1 << 20, 4)
+
+
+def test_stored_versions_cant_be_changed(store):
+    assert store.put('form', {'a': 1}, '1') == '1'
+    with pytest.raises(baselines.VersionExists):
+        store.put('form', {'a': 2}, '1')
+    assert store.get('form', '1').structure == {'a': 1}
+
+
+def test_latest_is_the_one_stored_last(store):
+    store.put('form', {'a': 1}, '2')
+    store.put('form', {'a': 2}, '1')
+    assert store.get('form').version == '1'
+    assert store.put('form', {'a': 3}) == '3'
+    assert store.get('form').structure == {'a': 3}
+
+
+def test_put_of_an_existing_version_is_a_conflict(store, monkeypatch):
+    import app
+    monkeypatch.setattr(app, 'baseline_store', store)
+    client = app.app.test_client()
+    assert client.put('/baselines/form', json={'structure': {'a': 1}, 'version': 1}).status_code == 201
+    response = client.put('/baselines/form', json={'structure': {'a': 2}, 'version': 1})
+    assert response.status_code == 409
+    assert client.get('/baselines/form?version=1').get_json()['structure'] == {'a': 1}
+
+
+def test_a_version_stored_again_after_eviction_isnt_served_stale(tmp_path):
+    # Two workers on the same file, only room for one revision
+    path = str(tmp_path / 'baselines.sqlite3')
+    web = baselines.BaselineStore(path, 1, 1 << 20, 4)
+    other = baselines.BaselineStore(path, 1, 1 << 20, 4)
+    web.put('form', {'a': 1}, '1')
+    assert other.get('form', '1').structure == {'a': 1}
+    web.put('other', {'b': 1}, '1')
+    assert other.get('form', '1') is None
+    web.put('form', {'a': 2}, '1')
+    assert other.get('form', '1').structure == {'a': 2}
+    assert other.get('form').structure == {'a': 2}
+
+
+def test_pool_refuses_a_baseline_stored_again_since(tmp_path, monkeypatch):
+    import serving
+    store = baselines.BaselineStore(str(tmp_path / 'baselines.sqlite3'), 1, 1 << 20, 4)
+    monkeypatch.setattr(serving, '_worker_baselines', store)
+    store.put('form', {'a': 1}, '1')
+    stale = store.get('form', '1')
+    store.put('other', {'b': 1}, '1')
+    store.put('form', {'a': 2}, '1')
+    with pytest.raises(serving.BaselineGone):
+        serving.run_compare(None, {'a': 1}, 'deepdiff', 'exact', 'index', 'changes', False,
+                            (stale.baseline_id, stale.version, stale.created))
+
+
+def test_reads_only_write_back_a_use_once_its_old(tmp_path):
+    store = baselines.BaselineStore(str(tmp_path / 'baselines.sqlite3'), 1000, 1 << 20, 4, touch_interval=60)
+    store.put('form', {'a': 1}, '1')
+    db = store.connection()
+    writes = db.total_changes
+    for _ in range(5):
+        assert store.get('form', '1').structure == {'a': 1}
+    assert db.total_changes == writes
+    db.execute("UPDATE baselines SET used = used - 120")
+    writes = db.total_changes
+    store.get('form')
+    store.get('form')
+    assert db.total_changes == writes + 1
@@ -0,0 +1,51 @@
+import pytest
+
+import compare
+from benchmarks.forms import edit_form, generate_form
+
+MIXES = [None, {'change': 1}, {'add': 1}, {'remove': 1}, {'type_change': 1}, {'uuid': 1}]
+
+
+def _forms(seed, mix):
+    original = generate_form(30, seed=seed)
+    modified = edit_form(original, 8, seed=seed + 10, mix=mix)
+    # Form-level changes, which edit_form() doesn't make
+    modified['title'] += ' (edited)'
+    modified['settings']['theme'] = 'dark'
+    modified['settings']['steps'].append(4)
+    modified['settings']['locale'] = 'en'
+    return original, modified
+
+
+def _classified(engine, distance_mode, original, modified):
+    # (fieldChanges, form changes, removed fields, added fields) from an engine's changes
+    changes = compare.ENGINES[engine](original, modified, distance_mode)[0]
+    return compare.classify(changes, original, modified)
+
+
+@pytest.mark.parametrize('mix', MIXES)
+@pytest.mark.parametrize('seed', range(3))
+def test_fields_engine_reports_what_deepdiff_does(seed, mix):
+    original, modified = _forms(seed, mix)
+    baseline = _classified('deepdiff', 'exact', original, modified)
+    assert baseline[1]
+    assert _classified('fields', 'approximate', original, modified) == baseline
+
+
+@pytest.mark.parametrize('mix', MIXES)
+@pytest.mark.parametrize('seed', range(3))
+def test_distance_modes_leave_the_changes_alone(seed, mix):
+    # approximate and none diff the structures with unchanged subtrees pruned,
+    # exact diffs them whole
+    original, modified = _forms(seed, mix)
+    exact = _classified('deepdiff', 'exact', original, modified)
+    for distance_mode in ('approximate', 'none'):
+        assert _classified('deepdiff', distance_mode, original, modified) == exact
+
+
+@pytest.mark.parametrize('engine', ['deepdiff', 'fields'])
+def test_change_distance(engine):
+    original, modified = _forms(0, None)
+    assert compare.compare_structures(original, modified, engine, 'none')['changeDistance'] is None
+    assert compare.compare_structures(original, original, engine, 'approximate')['changeDistance'] == 0
+    assert 0 < compare.compare_structures(original, modified, engine, 'approximate')['changeDistance'] <= 100
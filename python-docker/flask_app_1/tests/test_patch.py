@@ -0,0 +1,68 @@
+import copy
+
+import pytest
+
+import compare
+from benchmarks.forms import edit_form, generate_form
+
+# Every edit but uuid churn, which patches leave out
+EDITS = {'change': 4, 'add': 1, 'remove': 1, 'type_change': 1}
+
+
+def _resolve(document, pointer):
+    # (container, last key) of a JSON pointer
+    parts = [part.replace('~1', '/').replace('~0', '~') for part in pointer.split('/')[1:]]
+    for part in parts[:-1]:
+        document = document[int(part)] if isinstance(document, list) else document[part]
+    last = parts[-1]
+    if isinstance(document, list):
+        last = len(document) if last == '-' else int(last)
+    return document, last
+
+
+def apply_patch(document, operations):
+    # The RFC 6902 operations patch.py emits
+    document = copy.deepcopy(document)
+    for operation in operations:
+        container, key = _resolve(document, operation['path'])
+        if operation['op'] == 'test':
+            assert container[key] == operation['value'], operation
+        elif operation['op'] == 'remove':
+            del container[key]
+        elif operation['op'] == 'replace':
+            container[key] = operation['value']
+        elif operation['op'] == 'add':
+            if isinstance(container, list):
+                container.insert(key, operation['value'])
+            else:
+                container[key] = operation['value']
+        elif operation['op'] == 'move':
+            source, source_key = _resolve(document, operation['from'])
+            value = source.pop(source_key)
+            container, key = _resolve(document, operation['path'])
+            container[key] = value
+        else:
+            raise AssertionError('Unexpected operation %r' % operation)
+    return document
+
+
+@pytest.mark.parametrize('engine', sorted(compare.ENGINES))
+@pytest.mark.parametrize('seed', range(4))
+def test_patch_gives_the_modified_form(engine, seed):
+    original = generate_form(60, seed=seed)
+    modified = edit_form(original, 25, seed=seed, mix=EDITS)
+    result = compare.compare_structures(original, modified, engine, output_format=compare.PATCH)
+    assert apply_patch(original, result['patch']) == modified
+
+
+def test_swapped_fields_dont_overwrite_a_field_named_like_the_spare_key():
+    original = generate_form(10, seed=0)
+    # Whichever of the two is parked, its spare key is taken
+    original['fields']['0-moving'] = copy.deepcopy(original['fields']['8'])
+    original['fields']['1-moving'] = copy.deepcopy(original['fields']['9'])
+    modified = copy.deepcopy(original)
+    fields = modified['fields']
+    fields['0'], fields['1'] = fields['1'], fields['0']
+    result = compare.compare_structures(original, modified, 'fields', output_format=compare.PATCH)
+    assert any(operation['op'] == 'move' for operation in result['patch'])
+    assert apply_patch(original, result['patch']) == modified
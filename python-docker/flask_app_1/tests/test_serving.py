@@ -0,0 +1,62 @@
+import pytest
+
+import batch
+import serving
+from benchmarks.forms import edit_form, generate_form
+
+
+@pytest.fixture(scope='module')
+def forms():
+    original = generate_form(60, seed=5)
+    return original, edit_form(original, 20, seed=6)
+
+
+@pytest.mark.parametrize('diff_pool', ['inline', 'process'])
+@pytest.mark.parametrize('rule_alignment', ['index', 'content'])
+@pytest.mark.parametrize('output_format', ['changes', 'patch'])
+def test_sharded_body_is_the_serial_body(monkeypatch, forms, diff_pool, rule_alignment, output_format):
+    original, modified = forms
+    serial = serving.run_compare(original, modified, 'fields', 'approximate', rule_alignment, output_format, True)[0]
+    monkeypatch.setattr(serving, 'DIFF_POOL', diff_pool)
+    monkeypatch.setattr(serving, 'SHARDS', 7)
+    try:
+        sharded = serving._sharded_body(None, original, modified, 'fields', 'approximate', rule_alignment, output_format, True)
+    finally:
+        batch.shutdown_pool()
+    assert sharded == serial
+
+
+def test_batch_pairs_leave_room_for_a_compare_in_flight(monkeypatch):
+    import threading
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+
+    running = []
+    most = []
+    lock = threading.Lock()
+
+    def compare_pair(index, pair, *options):
+        with lock:
+            running.append(index)
+            most.append(len(running))
+        time.sleep(0.01)
+        with lock:
+            running.remove(index)
+        return { 'index': index }
+
+    pool = ThreadPoolExecutor(16)
+    monkeypatch.setattr(batch, 'get_pool', lambda: pool)
+    monkeypatch.setattr(batch, 'compare_pair', compare_pair)
+    monkeypatch.setattr(batch, 'POOL_SIZE', 8)
+    monkeypatch.setattr(serving, '_slots', threading.BoundedSemaphore(3))
+    # A /compare holds one of the three slots throughout
+    serving.acquire_slot()
+    try:
+        results = list(serving.run_batch([{}] * 20))
+    finally:
+        serving.release_slot()
+        pool.shutdown()
+    assert sorted(result['index'] for result in results) == list(range(20))
+    assert max(most) <= 2
+    for _ in range(3):
+        serving.acquire_slot()
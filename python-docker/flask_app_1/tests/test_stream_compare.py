@@ -0,0 +1,40 @@
+import json
+
+import codec
+import compare
+import field_diff
+import form_index
+import stream_compare
+from benchmarks.forms import edit_form, generate_form
+
+
+def _form(structure, fail_on=None):
+    fields = structure['fields']
+    parts = { key: value for key, value in structure.items() if key != 'fields' }
+
+    def field(key):
+        if key == fail_on:
+            raise RuntimeError('lost the spool')
+        return fields[key]
+
+    return stream_compare._Form(parts, { key: form_index.field_id(value) for key, value in fields.items() }, field)
+
+
+def _streamed(original, modified, fail_on=None):
+    chunks = stream_compare._stream(_form(original), _form(modified, fail_on), 'approximate', field_diff.INDEX)
+    return json.loads(b''.join(chunks))
+
+
+def test_streamed_body_matches_the_fields_engine():
+    original = generate_form(40, seed=3)
+    modified = edit_form(original, 10, seed=4)
+    expected = compare.compare_structures(original, modified, 'fields', 'approximate')
+    assert _streamed(original, modified) == codec.loads(codec.body_bytes(expected))
+
+
+def test_a_failure_halfway_closes_the_body_with_an_error():
+    original = generate_form(40, seed=3)
+    modified = edit_form(original, 10, seed=4)
+    body = _streamed(original, modified, fail_on=sorted(modified['fields'])[20])
+    assert 'changeDistance' not in body
+    assert 'lost the spool' in body['error']